@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+'''Benchmark job descriptions of the illuminati step.'''
+import os
+import shutil
+import tempfile
+import argparse
+import numpy as np
+
+from tmlib.readers import JsonReader
+from tmlib.writers import JsonWriter
+from tmlib.workflow.illuminati.api import _calc_hilbert_index
+from tmlib.workflow.illuminati.api import _encode_array
+from tmlib.workflow.illuminati.api import _decode_array
+from tmlib.workflow.illuminati.api import _expand_tile_range
+
+from common import time_call, run
+
+def benchmark_batches(n_sites, batch_size):
+    # Sites of 2160x2560 pixels are arranged in a square grid. Image files
+    # are ordered along a Hilbert curve like the jobs of the base level.
+    n = int(np.ceil(np.sqrt(n_sites)))
+    y, x = np.divmod(np.arange(n_sites), n)
+    file_ids = np.argsort(
+        _calc_hilbert_index(2 ** int(np.ceil(np.log2(n))), y, x)
+    ) + 1
+    dimensions = [(
+        int(np.ceil(n * 2160 / 256.0)), int(np.ceil(n * 2560 / 256.0))
+    )]
+    while dimensions[-1] != (1, 1):
+        dimensions.append(tuple(-(-d // 2) for d in dimensions[-1]))
+    print 'create job descriptions for %d sites (%d levels)' % (
+        n_sites, len(dimensions)
+    )
+
+    def create_batches(compact):
+        batches = list()
+        for i in range(0, n_sites, batch_size):
+            ids = file_ids[i:i+batch_size].tolist()
+            batches.append({
+                'image_file_ids': _encode_array(ids) if compact else ids
+            })
+        size = batch_size
+        for index, (n_rows, n_cols) in enumerate(dimensions[1:]):
+            size = size * 25 if index == 0 else max(size / 4, 1)
+            n_tiles = n_rows * n_cols
+            for i in range(0, n_tiles, size):
+                stop = min(i + size, n_tiles)
+                if compact:
+                    batches.append({
+                        'level': index + 1, 'tile_range': [i, stop]
+                    })
+                else:
+                    rows, cols = np.divmod(np.arange(i, stop), n_cols)
+                    batches.append({
+                        'level': index + 1,
+                        'coordinates': np.column_stack([rows, cols]).tolist()
+                    })
+        return batches
+
+    def load(filenames, compact):
+        n_items = 0
+        for filename in filenames:
+            with JsonReader(filename) as f:
+                batch = f.read()
+            if 'image_file_ids' in batch:
+                ids = batch['image_file_ids']
+                n_items += len(_decode_array(ids) if compact else ids)
+            elif compact:
+                n_cols = dimensions[batch['level']][1]
+                for coordinates in _expand_tile_range(
+                        batch['tile_range'], n_cols, 256):
+                    n_items += len(coordinates)
+            else:
+                n_items += len(batch['coordinates'])
+        return n_items
+
+    location = tempfile.mkdtemp()
+    try:
+        results = list()
+        for name, compact in (('lists', False), ('compact', True)):
+            batches = create_batches(compact)
+            filenames = list()
+            def write():
+                for i, batch in enumerate(batches):
+                    filename = os.path.join(
+                        location, '%s_%.7d.batch.json' % (name, i)
+                    )
+                    with JsonWriter(filename) as f:
+                        f.write(batch)
+                    filenames.append(filename)
+            _, t_write = time_call(write)
+            n_bytes = np.sum([os.path.getsize(f) for f in filenames])
+            n_items, t_load = time_call(load, filenames, compact)
+            results.append((n_items, n_bytes, t_write, t_load))
+            print (
+                '%s: %d files, %.2f MB, %.2f s (write), %.2f s (load)' % (
+                    name, len(filenames), n_bytes / 1024.0**2, t_write,
+                    t_load
+                )
+            )
+        if results[0][0] != results[1][0]:
+            raise AssertionError('Job descriptions don\'t match.')
+        print 'compact descriptions are %.0fx smaller, load %.1fx faster' % (
+            results[0][1] / float(results[1][1]),
+            results[0][3] / results[1][3]
+        )
+    finally:
+        shutil.rmtree(location)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark job descriptions of the illuminati step.'
+    )
+
+    subparsers = parser.add_subparsers(dest='routine', help='routine')
+    subparsers.required = True
+
+    batches_subparser = subparsers.add_parser(
+        'batches', help='job descriptions of the illuminati step'
+    )
+    batches_subparser.set_defaults(function='benchmark_batches')
+    batches_subparser.description = (
+        'Compare size and load time of job descriptions that list image file '
+        'IDs and tile coordinates against compact descriptions with encoded '
+        'arrays and tile ranges. Files are written into a temporary '
+        'directory.'
+    )
+    batches_subparser.add_argument(
+        '-n', '--n_sites', type=int, default=13824,
+        help='number of sites (default: 13824)'
+    )
+    batches_subparser.add_argument(
+        '-b', '--batch_size', type=int, default=100,
+        help='number of image files per job (default: 100)'
+    )
+
+    run(parser, globals())
@@ -0,0 +1,56 @@
+'''Helpers shared by the benchmarks of performance critical routines.
+
+The benchmarks are not installed with the package. They are run from a
+checkout, e.g. ``python benchmarks/tiles.py tilestore``, and some of them
+compare against private reference implementations of the library.
+'''
+import time
+import inspect
+
+from tmlib.log import configure_logging
+
+
+def time_call(func, *args, **kwargs):
+    '''Calls a function and measures the elapsed time.
+
+    Returns
+    -------
+    Tuple[object, float]
+        output of the function and elapsed time in seconds
+    '''
+    start = time.time()
+    output = func(*args, **kwargs)
+    return (output, time.time() - start)
+
+
+def run(parser, context):
+    '''Parses command line arguments and calls the benchmark function that
+    was selected by the subparser.
+
+    Parameters
+    ----------
+    parser: argparse.ArgumentParser
+        parser whose subparsers set the name of the function as default
+        value of "function"
+    context: dict
+        namespace in which the function is defined
+    '''
+    args = parser.parse_args()
+
+    configure_logging()
+
+    if args.function not in context:
+        raise ValueError('Unknown function "%s"' % args.function)
+    func = context[args.function]
+    kwargs = dict()
+    func_inputs = inspect.getargspec(func)
+    n_required = len(func_inputs.args) - len(func_inputs.defaults or [])
+    for i, param in enumerate(func_inputs.args):
+        if param not in vars(args):
+            if i < n_required:
+                raise ValueError(
+                    'Required argument "%s" not provided.' % param
+                )
+            continue
+        kwargs[param] = getattr(args, param)
+    func(**kwargs)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+'''Benchmark calculation and application of illumination statistics.'''
+import argparse
+import numpy as np
+
+from tmlib.image import ChannelImage
+from tmlib.image import IllumstatsImage
+from tmlib.image import IllumstatsContainer
+from tmlib.metadata import ChannelImageMetadata
+from tmlib.metadata import IllumstatsImageMetadata
+from tmlib.workflow.corilla.stats import OnlineStatistics
+
+from common import time_call, run
+
+def benchmark_percentiles(n_images, size, seed=0):
+    print 'create %d images (%dx%d pixels)' % (n_images, size, size)
+    random_state = np.random.RandomState(seed)
+    images = [
+        ChannelImage(
+            random_state.lognormal(6, 0.5, (size, size)).astype(np.uint16)
+        )
+        for i in range(n_images)
+    ]
+    stats = OnlineStatistics((size, size))
+    # Previous approach: percentiles of individual images were computed by
+    # sorting pixel values and averaged over images.
+    _, t_ref = time_call(
+        lambda: [np.percentile(img.array, stats._q) for img in images]
+    )
+    def compute_percentiles():
+        for img in images:
+            counts = np.bincount(img.array.ravel())
+            stats._histogram[:counts.shape[0]] += counts
+        return stats.percentiles
+    percentiles, t = time_call(compute_percentiles)
+    reference = np.percentile(
+        np.concatenate([img.array.ravel() for img in images]), stats._q
+    )
+    n_differ = np.sum([
+        percentiles[k] != int(r) for k, r in zip(stats._keys, reference)
+    ])
+    print 'percentiles: %d' % len(stats._q)
+    print 'per-image sorting: %.2f s' % t_ref
+    print 'histogram: %.2f s (%.1fx)' % (t, t_ref / t)
+    print 'percentiles that differ from sorting all pixels: %d' % n_differ
+
+
+def benchmark_illumstats(n_images, size, downsampling_factor, seed=0):
+    print 'create %d images (%dx%d pixels)' % (n_images, size, size)
+    random_state = np.random.RandomState(seed)
+    # Illumination varies smoothly from the center towards the corners of
+    # the field of view and gets multiplied with a noisy signal.
+    y, x = np.mgrid[0:size, 0:size] / float(size) - 0.5
+    field = 1 - 0.6 * (x**2 + y**2)
+    images = [
+        ChannelImage(
+            (field * random_state.lognormal(6, 0.5, (size, size))).astype(
+                np.uint16
+            ),
+            ChannelImageMetadata(
+                channel_id=1, site_id=i, cycle_id=1, tpoint=0, zplane=0
+            )
+        )
+        for i in range(n_images)
+    ]
+    results = list()
+    for f in (1, downsampling_factor):
+        stats = OnlineStatistics((size, size), downsampling_factor=f)
+        def accumulate():
+            for img in images:
+                stats.update(img)
+        _, t = time_call(accumulate)
+        metadata = IllumstatsImageMetadata(channel_id=1)
+        illumstats = IllumstatsContainer(
+            IllumstatsImage(stats.mean.array, metadata),
+            IllumstatsImage(stats.std.array, metadata),
+            stats.percentiles, f
+        ).smooth()
+        corrected, t_corr = time_call(
+            lambda: [img.correct(illumstats, False) for img in images]
+        )
+        n_bytes = stats._mean.nbytes + stats._M2.nbytes
+        results.append((corrected, t, t_corr, n_bytes))
+    reference, t_ref, t_corr_ref, n_bytes_ref = results[0]
+    corrected, t, t_corr, n_bytes = results[1]
+    diff = np.concatenate([
+        np.abs(c.array.astype(int) - r.array.astype(int)).ravel()
+        for c, r in zip(corrected, reference)
+    ])
+    signal = np.mean([r.array.mean() for r in reference])
+    print 'downsampling factor: %d' % downsampling_factor
+    print 'accumulation at full resolution: %.2f s' % t_ref
+    print 'accumulation downsampled: %.2f s (%.1fx)' % (t, t_ref / t)
+    print 'correction at full resolution: %.2f s' % t_corr_ref
+    print 'correction upsampled: %.2f s' % t_corr
+    print 'size of statistics at full resolution: %.1f MB' % (
+        n_bytes_ref / 1024.0**2
+    )
+    print 'size of statistics downsampled: %.3f MB (%.0fx smaller)' % (
+        n_bytes / 1024.0**2, n_bytes_ref / float(n_bytes)
+    )
+    print 'mean absolute difference of corrected pixels: %.2f (%.2f %%)' % (
+        diff.mean(), diff.mean() / signal * 100
+    )
+    print 'maximal absolute difference of corrected pixels: %d' % diff.max()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark calculation of illumination statistics.'
+    )
+
+    subparsers = parser.add_subparsers(dest='routine', help='routine')
+    subparsers.required = True
+
+    percentiles_subparser = subparsers.add_parser(
+        'percentiles', help='calculation of intensity percentiles'
+    )
+    percentiles_subparser.set_defaults(function='benchmark_percentiles')
+    percentiles_subparser.description = (
+        'Compare histogram-based percentiles against sorting of pixels.'
+    )
+    percentiles_subparser.add_argument(
+        '-n', '--n_images', type=int, default=20,
+        help='number of images (default: 20)'
+    )
+    percentiles_subparser.add_argument(
+        '-s', '--size', type=int, default=2160,
+        help='height and width of images (default: 2160)'
+    )
+
+    illumstats_subparser = subparsers.add_parser(
+        'illumstats', help='calculation of illumination statistics'
+    )
+    illumstats_subparser.set_defaults(function='benchmark_illumstats')
+    illumstats_subparser.description = (
+        'Compare illumination correction with downsampled statistics against '
+        'statistics calculated for each pixel.'
+    )
+    illumstats_subparser.add_argument(
+        '-n', '--n_images', type=int, default=20,
+        help='number of images (default: 20)'
+    )
+    illumstats_subparser.add_argument(
+        '-s', '--size', type=int, default=2160,
+        help='height and width of images (default: 2160)'
+    )
+    illumstats_subparser.add_argument(
+        '-d', '--downsampling_factor', type=int, default=8,
+        help='downsampling factor of statistics (default: 8)'
+    )
+
+    run(parser, globals())
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+'''Benchmark creation and ingestion of static mapobjects.
+
+The database is only accessed when a database URI is given, in which case
+the drivers are imported by the respective benchmark.
+'''
+import argparse
+import numpy as np
+import shapely.geometry
+import shapely.wkt
+
+from tmlib.models.channel import ChannelLayerLayout
+from tmlib.models.mapobject import Mapobject
+from tmlib.models.mapobject import MapobjectSegmentation
+from tmlib.workflow.illuminati.api import _create_outlines
+
+from common import time_call, run
+
+def _create_mapobjects_tables(cursor, schema):
+    cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % schema)
+    cursor.execute('CREATE SCHEMA %s' % schema)
+    cursor.execute('SET search_path TO %s, public' % schema)
+    cursor.execute('CREATE SEQUENCE mapobjects_id_seq')
+    cursor.execute('''
+        CREATE TABLE mapobjects (
+            partition_key integer NOT NULL, id bigint NOT NULL,
+            mapobject_type_id integer, ref_id integer,
+            PRIMARY KEY (id, partition_key)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE mapobject_segmentations (
+            partition_key integer NOT NULL, mapobject_id bigint NOT NULL,
+            segmentation_layer_id integer NOT NULL,
+            geom_polygon geometry(POLYGON), geom_centroid geometry(POINT),
+            label integer,
+            CONSTRAINT mapobject_segmentations_pkey
+            PRIMARY KEY (mapobject_id, partition_key, segmentation_layer_id)
+        )
+    ''')
+
+
+def benchmark_mapobjects(n_sites, batch_size, db_uri=None):
+    # Sites are arranged in 6x6 grids within the wells of 384 well plates.
+    n_wells = int(np.ceil(n_sites / 36.0))
+    n_plates = int(np.ceil(n_wells / 384.0))
+    print 'create layout of %d sites in %d wells of %d plates' % (
+        n_sites, n_wells, n_plates
+    )
+    sites = list()
+    for i in range(n_sites):
+        well_index = i / 36
+        plate_index = well_index / 384
+        name = '%s%.2d' % (
+            chr(ord('A') + (well_index % 384) / 24), well_index % 24 + 1
+        )
+        sites.append((
+            i + 1, (i % 36) / 6, i % 6, 2160, 2560, False,
+            well_index + 1, name, plate_index + 1
+        ))
+    plate_grid = np.arange(1, n_plates + 1).reshape(1, -1)
+    layout, t_layout = time_call(
+        ChannelLayerLayout, sites, [], plate_grid, 500, 1000
+    )
+    print 'layout: %.2f s' % t_layout
+
+    def create_polygons():
+        # Polygons are created for each object individually.
+        polygons = list()
+        for offset, size in zip(layout.site_offsets, layout.site_sizes):
+            ul = (offset[1] + 1, -1 * (offset[0] + 1))
+            ll = (ul[0], ul[1] - (size[0] - 3))
+            ur = (ul[0] + size[1] - 3, ul[1])
+            lr = (ll[0] + size[1] - 3, ll[1])
+            polygon = shapely.geometry.Polygon(
+                np.array([ur, ul, ll, lr, ur])
+            )
+            polygons.append((polygon.wkt, polygon.centroid.wkt))
+        return polygons
+
+    reference, t_ref = time_call(create_polygons)
+    (polygons, centroids), t = time_call(
+        _create_outlines, layout.site_offsets, layout.site_sizes
+    )
+    for i in range(0, n_sites, max(1, n_sites / 100)):
+        if not (shapely.wkt.loads(polygons[i]).equals(
+                    shapely.wkt.loads(reference[i][0])) and
+                shapely.wkt.loads(centroids[i]).equals(
+                    shapely.wkt.loads(reference[i][1]))):
+            raise AssertionError('Outlines differ.')
+    print 'outlines per object: %.2f s' % t_ref
+    print 'outlines vectorized: %.2f s (%.1fx)' % (t, t_ref / t)
+    if db_uri is None:
+        return
+    import psycopg2
+
+    def create_mapobjects(indices):
+        return [
+            Mapobject(partition_key=i + 1, mapobject_type_id=1)
+            for i in indices
+        ]
+
+    def create_segmentations(indices, mapobjects):
+        return [
+            MapobjectSegmentation(
+                partition_key=i + 1, mapobject_id=m.id,
+                geom_polygon=polygons[i], geom_centroid=centroids[i],
+                segmentation_layer_id=1
+            )
+            for i, m in zip(indices, mapobjects)
+        ]
+
+    def add():
+        # One statement for the ID and one per row, similar to adding each
+        # object to the session followed by a flush.
+        for i in range(n_sites):
+            mapobject = Mapobject._add(cursor, create_mapobjects([i])[0])
+            MapobjectSegmentation._add(
+                cursor, create_segmentations([i], [mapobject])[0]
+            )
+
+    def bulk_ingest():
+        for i in range(0, n_sites, batch_size):
+            indices = range(i, min(i + batch_size, n_sites))
+            mapobjects = create_mapobjects(indices)
+            Mapobject._bulk_ingest(cursor, mapobjects)
+            MapobjectSegmentation._bulk_ingest(
+                cursor, create_segmentations(indices, mapobjects)
+            )
+
+    schema = 'tm_benchmark_mapobjects'
+    connection = psycopg2.connect(db_uri)
+    connection.autocommit = True
+    cursor = connection.cursor()
+    try:
+        _create_mapobjects_tables(cursor, schema)
+        methods = [('per-object insert', add), ('bulk copy', bulk_ingest)]
+        for name, func in methods:
+            cursor.execute('TRUNCATE mapobjects, mapobject_segmentations')
+            _, t = time_call(func)
+            cursor.execute('SELECT count(*) FROM mapobject_segmentations')
+            if cursor.fetchone()[0] != n_sites:
+                raise AssertionError('Mapobjects were not ingested correctly.')
+            print '%s: %.2f s (%.0f objects/s)' % (name, t, n_sites / t)
+    finally:
+        cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % schema)
+        cursor.close()
+        connection.close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark creation of static mapobjects.'
+    )
+
+    subparsers = parser.add_subparsers(dest='routine', help='routine')
+    subparsers.required = True
+
+    mapobjects_subparser = subparsers.add_parser(
+        'mapobjects', help='creation of static mapobjects'
+    )
+    mapobjects_subparser.set_defaults(function='benchmark_mapobjects')
+    mapobjects_subparser.description = (
+        'Compare creation of site outlines per object against vectorized '
+        'creation. When a database URI is given, also compare ingestion '
+        'of mapobjects one by one against bulk ingestion into a temporary '
+        'schema, which requires PostGIS.'
+    )
+    mapobjects_subparser.add_argument(
+        '-n', '--n_sites', type=int, default=100000,
+        help='number of sites (default: 100000)'
+    )
+    mapobjects_subparser.add_argument(
+        '-b', '--batch_size', type=int, default=10000,
+        help='number of mapobjects per bulk ingestion (default: 10000)'
+    )
+    mapobjects_subparser.add_argument(
+        '-d', '--db_uri', type=str,
+        help='URI of the database (default: ingestion is not included)'
+    )
+
+    run(parser, globals())
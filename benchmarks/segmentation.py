@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+'''Benchmark extraction of polygons from label images.'''
+import argparse
+import numpy as np
+import scipy.ndimage as ndi
+import mahotas as mh
+
+from tmlib.image import SegmentationImage
+
+from common import time_call, run
+
+def _create_label_image(n_objects, size, radius, seed=0):
+    # Objects resemble clustered nuclei: random seeds that are grown into
+    # touching objects of approximately the given radius.
+    random_state = np.random.RandomState(seed)
+    markers = np.zeros((size, size), dtype=np.int32)
+    y = random_state.randint(0, size, n_objects)
+    x = random_state.randint(0, size, n_objects)
+    markers[y, x] = np.arange(1, n_objects + 1)
+    distances = ndi.distance_transform_edt(markers == 0)
+    labels = mh.cwatershed(distances, markers)
+    labels[distances > radius] = 0
+    labels, n = mh.labeled.relabel(labels)
+    return labels.astype(np.int32)
+
+
+def benchmark_polygons(n_objects, size, radius, n_processes):
+    print 'create label image with %d objects (%dx%d pixels)' % (
+        n_objects, size, size
+    )
+    img = SegmentationImage(_create_label_image(n_objects, size, radius))
+    reference, t_ref = time_call(
+        lambda: list(img._extract_polygons_per_object(0, 0))
+    )
+    polygons, t = time_call(
+        lambda: list(img.extract_polygons(0, 0, n_processes=n_processes))
+    )
+    if [l for l, p in reference] != [l for l, p in polygons]:
+        raise AssertionError('Labels of extracted polygons differ.')
+    n_differ = np.sum([
+        not p.equals(r) for (l, p), (l, r) in zip(polygons, reference)
+    ])
+    print 'objects: %d' % len(polygons)
+    print 'per-object loop: %.2f s' % t_ref
+    print 'batched extraction: %.2f s (%.1fx)' % (t, t_ref / t)
+    print 'polygons with different geometry: %d' % n_differ
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark extraction of polygons from label images.'
+    )
+
+    subparsers = parser.add_subparsers(dest='routine', help='routine')
+    subparsers.required = True
+
+    polygons_subparser = subparsers.add_parser(
+        'polygons', help='extraction of polygons from a label image'
+    )
+    polygons_subparser.set_defaults(function='benchmark_polygons')
+    polygons_subparser.description = (
+        'Compare batched polygon extraction against the per-object loop.'
+    )
+    polygons_subparser.add_argument(
+        '-n', '--n_objects', type=int, default=10000,
+        help='number of objects (default: 10000)'
+    )
+    polygons_subparser.add_argument(
+        '-s', '--size', type=int, default=2160,
+        help='height and width of the label image (default: 2160)'
+    )
+    polygons_subparser.add_argument(
+        '-r', '--radius', type=int, default=8,
+        help='approximate radius of objects (default: 8)'
+    )
+    polygons_subparser.add_argument(
+        '-p', '--n_processes', type=int, default=1,
+        help='number of processes for batched extraction (default: 1)'
+    )
+
+    run(parser, globals())
@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+'''Benchmark storage, reading and lazy creation of pyramid tiles.
+
+The database is only accessed when a database URI is given, in which case
+the drivers are imported by the respective benchmark.
+'''
+import os
+import shutil
+import tempfile
+import argparse
+import itertools
+import numpy as np
+import scipy.ndimage as ndi
+
+from tmlib.image import Image
+from tmlib.image import ChannelImage
+from tmlib.image import PyramidTile
+from tmlib.image import ChannelImagePreprocessor
+from tmlib.metadata import ChannelImageMetadata
+from tmlib.models.tile import ChannelLayerTile
+from tmlib.models.tile import DatabaseTileStore
+from tmlib.models.tile import FilesystemTileStore
+from tmlib.models.tile import HDF5TileStore
+from tmlib.models.tile import TileCache
+from tmlib.models.tile import TileReader
+
+from common import time_call, run
+
+def _create_tiles(n_tiles, seed=0):
+    print 'create %d tiles' % n_tiles
+    random_state = np.random.RandomState(seed)
+    # Tiles are encoded upfront, such that only storage is timed.
+    images = [
+        ndi.gaussian_filter(
+            random_state.randint(0, 256, (256, 256)).astype(np.uint8), 2
+        )
+        for i in range(16)
+    ]
+    return [
+        ChannelLayerTile(
+            channel_layer_id=1, z=0, y=i / 1000, x=i % 1000,
+            pixels=PyramidTile(images[i % len(images)])
+        )
+        for i in range(n_tiles)
+    ]
+
+
+def _create_tiles_table(cursor, schema):
+    cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % schema)
+    cursor.execute('CREATE SCHEMA %s' % schema)
+    cursor.execute('SET search_path TO %s' % schema)
+    cursor.execute('''
+        CREATE TABLE channel_layer_tiles (
+            channel_layer_id integer NOT NULL,
+            z integer NOT NULL, y integer NOT NULL, x integer NOT NULL,
+            pixels bytea,
+            CONSTRAINT channel_layer_tiles_pkey
+            PRIMARY KEY (y, channel_layer_id, z, x)
+        )
+    ''')
+
+
+def benchmark_tiles(n_tiles, db_uri, batch_size, seed=0):
+    import psycopg2
+    tiles = _create_tiles(n_tiles, seed)
+    n_bytes = np.sum([len(t.encoded_pixels) for t in tiles])
+    print 'encoded size: %.1f MB' % (n_bytes / 1024.0**2)
+
+    def add():
+        for t in tiles:
+            ChannelLayerTile._add(cursor, t)
+
+    def bulk_ingest():
+        for i in range(0, n_tiles, batch_size):
+            ChannelLayerTile._bulk_ingest(cursor, tiles[i:i+batch_size])
+
+    schema = 'tm_benchmark_tiles'
+    connection = psycopg2.connect(db_uri)
+    connection.autocommit = True
+    cursor = connection.cursor()
+    try:
+        _create_tiles_table(cursor, schema)
+        methods = [('per-tile insert', add), ('binary copy', bulk_ingest)]
+        for name, func in methods:
+            cursor.execute('TRUNCATE channel_layer_tiles')
+            # The first pass inserts tiles, the second one updates them.
+            _, t_insert = time_call(func)
+            _, t_update = time_call(func)
+            cursor.execute('''
+                SELECT count(*), sum(length(pixels)) FROM channel_layer_tiles
+            ''')
+            count, size = cursor.fetchone()
+            if count != n_tiles or size != n_bytes:
+                raise AssertionError('Tiles were not ingested correctly.')
+            print '%s: %.0f tiles/s (insert), %.0f tiles/s (update)' % (
+                name, n_tiles / t_insert, n_tiles / t_update
+            )
+    finally:
+        cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % schema)
+        cursor.close()
+        connection.close()
+
+
+def benchmark_tilestore(n_tiles, n_reads, batch_size, db_uri=None, seed=0):
+    tiles = _create_tiles(n_tiles, seed)
+    n_bytes = np.sum([len(t.encoded_pixels) for t in tiles])
+    print 'encoded size: %.1f MB' % (n_bytes / 1024.0**2)
+    # Tiles are read in groups of neighbouring tiles at random positions,
+    # similar to the requests of a viewer or of lower pyramid levels.
+    random_state = np.random.RandomState(seed)
+    coordinates = [(t.y, t.x) for t in tiles]
+    groups = list()
+    for i in random_state.randint(0, n_tiles, n_reads / 4 + 1):
+        groups.append(coordinates[i:i+4])
+
+    def write(store):
+        for t in tiles:
+            store.add(t)
+        store.flush()
+
+    def read(store):
+        n = 0
+        for group in groups:
+            n += len(store.get_encoded(0, group))
+        return n
+
+    # Views of 4x8 tiles pan across the layer row by row, with each view
+    # overlapping the previous one by half.
+    n_rows = int(np.ceil(n_tiles / 1000.0))
+    n_cols = min(n_tiles, 1000)
+    views = [
+        ((y, y + 4), (x, x + 8))
+        for y in range(0, n_rows, 4) for x in range(0, n_cols, 4)
+    ]
+
+    def view_per_tile(store):
+        n = 0
+        for y_range, x_range in views:
+            for y in range(*y_range):
+                for x in range(*x_range):
+                    n += len(store.get_encoded(0, [(y, x)]))
+        return n
+
+    def view(reader):
+        n = 0
+        for y_range, x_range in views:
+            n += len(reader.get_encoded(0, y_range, x_range))
+        return n
+
+    location = tempfile.mkdtemp()
+    stores = [
+        ('filesystem', FilesystemTileStore(
+            1, os.path.join(location, 'filesystem'), buffer_size=batch_size
+        )),
+        ('hdf5', HDF5TileStore(
+            1, os.path.join(location, 'hdf5'), buffer_size=batch_size
+        ))
+    ]
+    if db_uri is not None:
+        schema = 'tm_benchmark_tilestore'
+        import sqlalchemy
+        import sqlalchemy.orm
+        from tmlib.models.utils import _SQLAlchemy_Session
+        engine = sqlalchemy.create_engine(db_uri)
+        connection = engine.connect()
+        connection.execution_options(isolation_level='AUTOCOMMIT')
+        session = _SQLAlchemy_Session(sqlalchemy.orm.Session(bind=connection))
+        with connection.connection.cursor() as cursor:
+            _create_tiles_table(cursor, schema)
+        stores.append(
+            ('database', DatabaseTileStore(session, 1, buffer_size=batch_size))
+        )
+    try:
+        for name, store in stores:
+            _, t_write = time_call(write, store)
+            # Tiles are read once before the timed pass, such that all
+            # stores are measured with warm operating system caches.
+            read(store)
+            n_read, t_read = time_call(read, store)
+            n_view_per_tile, t_view_per_tile = time_call(view_per_tile, store)
+            reader = TileReader(store, TileCache(1024))
+            n_view, t_view = time_call(view, reader)
+            store.close()
+            if n_read != sum([len(g) for g in groups]):
+                raise AssertionError('Tiles were not stored correctly.')
+            print '%s: %.0f tiles/s (write), %.0f tiles/s (random read)' % (
+                name, n_tiles / t_write, n_read / t_read
+            )
+            print (
+                '%s: %.0f tiles/s (views, per tile), %.0f tiles/s '
+                '(views, batched with cache, hit rate %.2f)' % (
+                    name, n_view_per_tile / t_view_per_tile, n_view / t_view,
+                    reader.cache.hit_rate
+                )
+            )
+    finally:
+        shutil.rmtree(location)
+        if db_uri is not None:
+            with connection.connection.cursor() as cursor:
+                cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % schema)
+            connection.close()
+
+
+def benchmark_lazy(n_sites, size, seed=0):
+    print 'create %d images (%dx%d pixels)' % (n_sites, size, size)
+    random_state = np.random.RandomState(seed)
+    n_site_cols = int(np.ceil(np.sqrt(n_sites)))
+    images = [
+        ChannelImage(
+            random_state.lognormal(6, 0.5, (size, size)).astype(np.uint16),
+            ChannelImageMetadata(
+                channel_id=1, site_id=i, cycle_id=1, tpoint=0, zplane=0
+            )
+        )
+        for i in range(n_sites)
+    ]
+    preprocessor = ChannelImagePreprocessor(
+        crop=False, clip_min=0, clip_max=2000, dtype=np.float32
+    )
+    tile_size = PyramidTile.TILE_SIZE
+    n_site_rows = int(np.ceil(n_sites / float(n_site_cols)))
+    n_rows = int(np.ceil(n_site_rows * size / float(tile_size)))
+    n_cols = int(np.ceil(n_site_cols * size / float(tile_size)))
+    n_levels = int(np.ceil(np.log2(max(n_rows, n_cols)))) + 1
+    print 'pyramid: %d levels, %dx%d tiles at the maximal zoom level' % (
+        n_levels, n_rows, n_cols
+    )
+
+    def create_base_tiles(coordinates):
+        # Images intersecting with the tiles are preprocessed and stitched,
+        # similar to the creation of tiles from channel image files.
+        coordinates = np.array(coordinates)
+        start = coordinates.min(axis=0) * tile_size
+        end = (coordinates.max(axis=0) + 1) * tile_size
+        first = start / size
+        last = np.minimum(
+            (end - 1) / size, np.array([n_site_rows, n_site_cols]) - 1
+        )
+        mosaic = np.zeros(
+            ((last[0] - first[0] + 1) * size, (last[1] - first[1] + 1) * size),
+            dtype=np.uint8
+        )
+        for i in range(first[0], last[0] + 1):
+            for j in range(first[1], last[1] + 1):
+                k = i * n_site_cols + j
+                if k >= n_sites:
+                    continue
+                y = (i - first[0]) * size
+                x = (j - first[1]) * size
+                image = preprocessor.process(images[k])
+                mosaic[y:y+size, x:x+size] = image.array
+        offset = first * size
+        for row, column in coordinates.tolist():
+            y = row * tile_size - offset[0]
+            x = column * tile_size - offset[1]
+            yield (
+                row, column,
+                PyramidTile(mosaic[y:y+tile_size, x:x+tile_size].copy())
+            )
+
+    def build(store, lazy):
+        z = n_levels - 1
+        tiles = dict()
+        coordinates = list(itertools.product(range(n_rows), range(n_cols)))
+        for row, column, tile in create_base_tiles(coordinates):
+            if not lazy:
+                store.add(ChannelLayerTile(
+                    channel_layer_id=1, z=z, y=row, x=column, pixels=tile
+                ))
+            tiles[(row, column)] = tile
+        background = PyramidTile.create_as_background().array
+        while z > 0:
+            z -= 1
+            parents = sorted(set((r / 2, c / 2) for r, c in tiles))
+            lower_tiles = dict()
+            for row, column in parents:
+                mosaic = np.zeros((2 * tile_size, 2 * tile_size), np.uint8)
+                for i, j in itertools.product(range(2), range(2)):
+                    pixels = tiles.get((2 * row + i, 2 * column + j))
+                    pixels = background if pixels is None else pixels.array
+                    h, w = pixels.shape
+                    y = i * tile_size
+                    x = j * tile_size
+                    mosaic[y:y+h, x:x+w] = pixels
+                tile = PyramidTile(Image(mosaic).shrink(2).array)
+                store.add(ChannelLayerTile(
+                    channel_layer_id=1, z=z, y=row, x=column, pixels=tile
+                ))
+                lower_tiles[(row, column)] = tile
+            tiles = lower_tiles
+        store.flush()
+
+    def get_size(location, z=None):
+        if z is not None:
+            location = os.path.join(location, str(z))
+        n_bytes = 0
+        for root, dirs, files in os.walk(location):
+            for f in files:
+                n_bytes += os.lstat(os.path.join(root, f)).st_size
+        return n_bytes
+
+    # The first view shows the 4x8 tiles in the center of the layer.
+    y = max(n_rows / 2 - 2, 0)
+    x = max(n_cols / 2 - 4, 0)
+    view = ((y, min(y + 4, n_rows)), (x, min(x + 8, n_cols)))
+    z = n_levels - 1
+
+    location = tempfile.mkdtemp()
+    try:
+        eager_store = FilesystemTileStore(1, os.path.join(location, 'eager'))
+        _, t_eager = time_call(build, eager_store, False)
+        lazy_store = FilesystemTileStore(1, os.path.join(location, 'lazy'))
+        _, t_lazy = time_call(build, lazy_store, True)
+
+        reader = TileReader(eager_store, TileCache(1024))
+        _, t_view_eager = time_call(reader.get_encoded, z, *view)
+
+        def render(store, coordinates):
+            # Tiles are rendered and written through to the store.
+            tiles = dict()
+            for row, column, tile in create_base_tiles(coordinates):
+                t = ChannelLayerTile(
+                    channel_layer_id=1, z=z, y=row, x=column, pixels=tile
+                )
+                store.add(t)
+                tiles[(row, column)] = t.encoded_pixels
+            store.flush()
+            return tiles
+
+        class Renderer(object):
+            def render(self, z, coordinates):
+                return render(lazy_store, coordinates)
+
+        reader = TileReader(lazy_store, TileCache(1024), Renderer())
+        tiles, t_view_lazy = time_call(reader.get_encoded, z, *view)
+        reader = TileReader(lazy_store, TileCache(1024))
+        rendered, t_view_rendered = time_call(reader.get_encoded, z, *view)
+        if rendered != tiles:
+            raise AssertionError('Tiles were not written through correctly.')
+
+        n_bytes_eager = get_size(eager_store.location)
+        n_bytes_base = get_size(eager_store.location, z)
+        n_bytes_lazy = get_size(lazy_store.location)
+        print 'build, all levels: %.2f s' % t_eager
+        print 'build, lower levels: %.2f s (%.1fx)' % (
+            t_lazy, t_eager / t_lazy
+        )
+        print 'first view, stored tiles: %.3f s' % t_view_eager
+        print 'first view, rendered tiles: %.3f s' % t_view_lazy
+        print 'first view, after rendering: %.3f s' % t_view_rendered
+        print 'storage, all levels: %.1f MB' % (n_bytes_eager / 1024.0**2)
+        print 'storage, lower levels: %.1f MB (%.0f %% saved)' % (
+            n_bytes_lazy / 1024.0**2, n_bytes_base * 100.0 / n_bytes_eager
+        )
+    finally:
+        shutil.rmtree(location)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark storage of pyramid tiles.'
+    )
+
+    subparsers = parser.add_subparsers(dest='routine', help='routine')
+    subparsers.required = True
+
+    tiles_subparser = subparsers.add_parser(
+        'tiles', help='ingestion of pyramid tiles into the database'
+    )
+    tiles_subparser.set_defaults(function='benchmark_tiles')
+    tiles_subparser.description = (
+        'Compare binary COPY ingestion of tiles against per-tile inserts. '
+        'Tiles are written into a temporary schema, which gets dropped '
+        'afterwards.'
+    )
+    tiles_subparser.add_argument(
+        '-n', '--n_tiles', type=int, default=10000,
+        help='number of tiles (default: 10000)'
+    )
+    tiles_subparser.add_argument(
+        '-d', '--db_uri', type=str,
+        default='postgresql://postgres@localhost:5432/postgres',
+        help='URI of the database (default: postgres database on localhost)'
+    )
+    tiles_subparser.add_argument(
+        '-b', '--batch_size', type=int, default=256,
+        help='number of tiles per bulk ingestion (default: 256)'
+    )
+
+    tilestore_subparser = subparsers.add_parser(
+        'tilestore', help='storage backends of pyramid tiles'
+    )
+    tilestore_subparser.set_defaults(function='benchmark_tilestore')
+    tilestore_subparser.description = (
+        'Compare write and random read throughput of tile stores as well '
+        'as reading overlapping views tile by tile and with a tile reader. '
+        'The filesystem and HDF5 stores write into a temporary directory. '
+        'The database store is only included when a database URI is given '
+        'and writes into a temporary schema, which gets dropped afterwards.'
+    )
+    tilestore_subparser.add_argument(
+        '-n', '--n_tiles', type=int, default=10000,
+        help='number of tiles (default: 10000)'
+    )
+    tilestore_subparser.add_argument(
+        '-r', '--n_reads', type=int, default=10000,
+        help='number of randomly read tiles (default: 10000)'
+    )
+    tilestore_subparser.add_argument(
+        '-b', '--batch_size', type=int, default=256,
+        help='number of tiles per write (default: 256)'
+    )
+    tilestore_subparser.add_argument(
+        '-d', '--db_uri', type=str,
+        help='URI of the database (default: database store is not included)'
+    )
+
+    lazy_subparser = subparsers.add_parser(
+        'lazy', help='lazy creation of the maximal zoom level'
+    )
+    lazy_subparser.set_defaults(function='benchmark_lazy')
+    lazy_subparser.description = (
+        'Compare building all pyramid levels against building only the lower '
+        'levels and rendering tiles of the maximal zoom level upon first '
+        'request. Reports build time, time to the first view and storage '
+        'saved. Tiles are written into a temporary directory.'
+    )
+    lazy_subparser.add_argument(
+        '-n', '--n_sites', type=int, default=16,
+        help='number of sites (default: 16)'
+    )
+    lazy_subparser.add_argument(
+        '-s', '--size', type=int, default=2160,
+        help='height and width of images (default: 2160)'
+    )
+
+    run(parser, globals())
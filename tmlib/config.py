@@ -235,6 +235,8 @@ class LibraryConfig(TmapsConfig):
         self.modules_home = '~/jtmodules'
         self.formats_home = '~/tmformats'
         self.storage_home = '/storage/filesystem'
+        self.tile_store = 'database'
+        self.tile_cache_size = 4096
         self._resource = None
         self.read()
 
@@ -301,6 +303,49 @@ class LibraryConfig(TmapsConfig):
             )
         self._config.set(self._section, 'storage_home', str(value))
 
+    @property
+    def tile_store(self):
+        '''str: backend for storing pyramid tiles; either ``"database"``
+        (rows of the ``channel_layer_tiles`` table), ``"filesystem"``
+        (one *JPEG* file per tile) or ``"hdf5"`` (packed files per zoom level)
+        (default: ``"database"``)
+        '''
+        return self._config.get(self._section, 'tile_store')
+
+    @tile_store.setter
+    def tile_store(self, value):
+        if not isinstance(value, basestring):
+            raise TypeError(
+                'Configuration parameter "tile_store" must have type str.'
+            )
+        options = {'database', 'filesystem', 'hdf5'}
+        if value not in options:
+            raise ValueError(
+                'Configuration parameter "tile_store" must be one of the '
+                'following: "%s"' % '", "'.join(sorted(options))
+            )
+        self._config.set(self._section, 'tile_store', str(value))
+
+    @property
+    def tile_cache_size(self):
+        '''int: maximal number of encoded tiles that are kept in memory by
+        each process for reading (default: ``4096``)
+        '''
+        return self._config.getint(self._section, 'tile_cache_size')
+
+    @tile_cache_size.setter
+    def tile_cache_size(self, value):
+        if not isinstance(value, int):
+            raise TypeError(
+                'Configuration parameter "tile_cache_size" must have type int.'
+            )
+        if value < 0:
+            raise ValueError(
+                'Configuration parameter "tile_cache_size" must not be '
+                'negative.'
+            )
+        self._config.set(self._section, 'tile_cache_size', str(value))
+
     @property
     def formats_home(self):
         '''str: absolute path to the root directory of local copy of
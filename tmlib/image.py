@@ -14,6 +14,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
+import struct
+import collections
+import multiprocessing
 import numpy as np
 import scipy.ndimage as ndi
 import cv2
@@ -22,7 +25,9 @@ import skimage.measure
 import skimage.color
 import skimage.draw
 import shapely.geometry
+import shapely.wkb
 from geoalchemy2.shape import to_shape
+from geoalchemy2.elements import WKBElement
 from abc import ABCMeta
 import logging
 
@@ -31,6 +36,420 @@ from tmlib.metadata import ImageMetadata, PyramidTileMetadata
 
 logger = logging.getLogger(__name__)
 
+_WKB_POLYGON_TYPE = 3
+
+_EWKB_SRID_FLAG = 0x20000000
+
+#: int: flags of (E)WKB geometry types indicating Z and M coordinates
+_EWKB_ZM_FLAGS = 0x80000000 | 0x40000000
+
+#: Dict[str, object]: arguments shared with contour tracing worker processes
+_contour_worker_args = dict()
+
+#: Dict[Tuple[int, int], numpy.ndarray[numpy.uint8]]: lookup tables for
+#: mapping 16-bit to 8-bit pixel values cached per pair of bounds
+_uint8_luts = dict()
+
+_MAX_CACHED_LUTS = 32
+
+
+def _init_contour_worker(plane, bboxes, y_offset, x_offset):
+    _contour_worker_args.update({
+        'plane': plane, 'bboxes': bboxes,
+        'y_offset': y_offset, 'x_offset': x_offset
+    })
+
+
+def _create_polygons_worker(labels):
+    polygons = _create_label_polygons(labels=labels, **_contour_worker_args)
+    # Shapely geometries can't be pickled directly.
+    return {label: poly.wkb for label, poly in polygons.iteritems()}
+
+
+def _trace_label_contours(plane, labels):
+    '''Traces the contours of several objects in a single pass over a
+    labeled pixels array.
+
+    Parameters
+    ----------
+    plane: numpy.ndarray[numpy.int32]
+        labeled pixels array with zero-valued border pixels
+    labels: numpy.ndarray[numpy.int32]
+        labels of objects whose contours should be traced; objects must not
+        touch each other
+
+    Returns
+    -------
+    Dict[int, Tuple[Union[numpy.ndarray, List[numpy.ndarray]]]]
+        *x*, *y* coordinates of the outer contour and of each hole
+        for each traced object
+
+    Note
+    ----
+    Objects for which no contour can be found are missing in the returned
+    mapping. In case an object has more than one outer contour, only the
+    largest one is kept.
+    '''
+    is_selected = np.zeros((plane.max() + 1, ), dtype=np.bool)
+    is_selected[labels] = True
+    # We need to remove single pixel extensions on the border of
+    # objects because they can lead to polygon self-intersections.
+    # Opening the joint mask is equivalent to opening each object
+    # individually, because objects don't touch each other.
+    mask = mh.open(is_selected[plane])
+    # NOTE: OpenCV returns x, y coordinates. This means one would need
+    # to flip the axis for numpy-based indexing (y,x coordinates).
+    _, contours, hierarchy = cv2.findContours(
+        mask.astype(np.uint8) * 255,
+        cv2.RETR_CCOMP,  # two-level hierarchy (holes)
+        cv2.CHAIN_APPROX_NONE
+    )
+    outlines = dict()
+    if len(contours) == 0:
+        return outlines
+    hierarchy = hierarchy[0]
+    for i, contour in enumerate(contours):
+        if hierarchy[i][3] >= 0:
+            # Holes are collected via their parent contour.
+            continue
+        x, y = contour[0, 0]
+        label = int(plane[y, x])
+        shell = contour[:, 0, :]
+        if label in outlines:
+            logger.debug('multiple contours identified for object #%d', label)
+            if len(outlines[label][0]) >= len(shell):
+                continue
+        holes = list()
+        child_idx = hierarchy[i][2]
+        while child_idx >= 0:
+            holes.append(contours[child_idx][:, 0, :])
+            child_idx = hierarchy[child_idx][0]
+        outlines[label] = (shell, holes)
+    return outlines
+
+
+def _create_label_polygons(plane, labels, bboxes, y_offset, x_offset):
+    '''Creates polygons for several objects, whose contours are traced in a
+    single pass over a labeled pixels array.
+
+    Parameters
+    ----------
+    plane: numpy.ndarray[numpy.int32]
+        labeled pixels array with zero-valued border pixels
+    labels: numpy.ndarray[numpy.int32]
+        labels of objects that should be represented by polygons;
+        objects must not touch each other
+    bboxes: numpy.ndarray[numpy.int32]
+        bounding box for each label as returned by
+        :func:`mahotas.labeled.bbox`
+    y_offset: int
+        global vertical offset that needs to be subtracted from
+        *y*-coordinates (*y*-axis is inverted)
+    x_offset: int
+        global horizontal offset that needs to be added to *x*-coordinates
+
+    Returns
+    -------
+    Dict[int, shapely.geometry.polygon.Polygon]
+        polygon for each object for which a contour could be found
+    '''
+    polygons = dict()
+    for label, (shell, holes) in _trace_label_contours(plane, labels).iteritems():
+        if len(holes) == 0:
+            holes = None
+        if shell.shape[0] < 3:
+            logger.warn('polygon doesn\'t have enough coordinates')
+            # In case the contour cannot be represented as a
+            # valid polygon we create a little square to not loose
+            # the object. It is placed at the center of the padded
+            # bounding box of the object.
+            bbox = bboxes[label]
+            y = bbox[0] - 1 + (bbox[1] - bbox[0] + 2) / 2
+            x = bbox[2] - 1 + (bbox[3] - bbox[2] + 2) / 2
+            shell = _create_fallback_shell(y, x)
+            holes = None
+        # Add offset required due to alignment and cropping and
+        # invert the y-axis as required by Openlayers.
+        shell[:, 0] = shell[:, 0] + x_offset
+        shell[:, 1] = -1 * (shell[:, 1] + y_offset)
+        if holes is not None:
+            for i in range(len(holes)):
+                holes[i][:, 0] = holes[i][:, 0] + x_offset
+                holes[i][:, 1] = -1 * (holes[i][:, 1] + y_offset)
+        polygons[label] = _create_polygon(label, shell, holes)
+    return polygons
+
+
+def _decode_polygon_exteriors(geometries):
+    '''Decodes the exterior ring of polygon geometries.
+
+    Parameters
+    ----------
+    geometries: List[Union[geoalchemy2.elements.WKBElement, geoalchemy2.elements.WKTElement]]
+        polygon geometries
+
+    Returns
+    -------
+    List[numpy.ndarray[numpy.int64]]
+        *x*, *y* coordinates of the exterior ring of each polygon
+
+    Raises
+    ------
+    TypeError
+        when a geometry doesn't have type POLYGON
+    ValueError
+        when a (E)WKB encoded geometry has *z* or *m* coordinates
+
+    Note
+    ----
+    Coordinates of (E)WKB encoded geometries are read directly from the
+    binary representation, which avoids the creation of
+    :class:`shapely.geometry.Polygon` instances. Other geometry
+    representations are decoded via :func:`geoalchemy2.shape.to_shape`.
+    '''
+    rings = list()
+    for geometry in geometries:
+        if isinstance(geometry, WKBElement):
+            buf = bytes(geometry.data)
+            byte_order = '<' if struct.unpack_from('B', buf, 0)[0] == 1 else '>'
+            geom_type = struct.unpack_from(byte_order + 'I', buf, 1)[0]
+            offset = 5
+            if geom_type & _EWKB_SRID_FLAG:
+                offset += 4
+            # Coordinates are read as x, y pairs, which requires that
+            # geometries don't have Z or M coordinates.
+            if geom_type & _EWKB_ZM_FLAGS or geom_type & 0xffff >= 1000:
+                raise ValueError('Geometry must be two-dimensional.')
+            if geom_type & 0xffff != _WKB_POLYGON_TYPE:
+                raise TypeError('Geometry must have type POLYGON.')
+            n_points = struct.unpack_from(byte_order + 'I', buf, offset + 4)[0]
+            coordinates = np.frombuffer(
+                buf, dtype=byte_order + 'f8', count=2 * n_points,
+                offset=offset + 8
+            ).reshape(n_points, 2)
+        else:
+            coordinates = np.array(to_shape(geometry).exterior.coords)
+        rings.append(coordinates.astype(np.int64))
+    return rings
+
+
+def _fill_polygons(array, rings, labels):
+    '''Fills polygons into a pixels array in a single scanline pass.
+
+    Parameters
+    ----------
+    array: numpy.ndarray[numpy.int32]
+        pixels array that should be filled in place
+    rings: List[numpy.ndarray[numpy.int64]]
+        *x*, *y* coordinates of the closed exterior ring of each polygon
+    labels: numpy.ndarray[numpy.int32]
+        value that should be assigned to pixels of each polygon
+
+    Note
+    ----
+    A pixel is assigned to a polygon when its center lies within the
+    polygon according to the even-odd rule, consistent with
+    :func:`skimage.draw.polygon`.
+    '''
+    height, width = array.shape
+    counts = np.array([len(r) for r in rings], dtype=np.int64)
+    coordinates = np.concatenate(rings).astype(np.float64)
+    polygon_index = np.repeat(np.arange(len(rings)), counts)
+    # Each vertex forms an edge with the preceding vertex of the same ring.
+    starts = np.cumsum(counts) - counts
+    preceding = np.arange(len(coordinates)) - 1
+    preceding[starts] = starts + counts - 1
+    x0, y0 = coordinates[:, 0], coordinates[:, 1]
+    x1, y1 = coordinates[preceding, 0], coordinates[preceding, 1]
+
+    # An edge crosses all scanlines (rows) in the half-open interval
+    # [min(y0, y1), max(y0, y1)). Horizontal edges don't cross any.
+    row_start = np.maximum(np.ceil(np.minimum(y0, y1)), 0).astype(np.int64)
+    row_stop = np.minimum(np.ceil(np.maximum(y0, y1)), height).astype(np.int64)
+    n_rows = np.maximum(row_stop - row_start, 0)
+    edge = np.repeat(np.arange(len(coordinates)), n_rows)
+    rows = np.repeat(row_start, n_rows) + _ranges(n_rows)
+    crossings = (
+        (x1[edge] - x0[edge]) * (rows - y0[edge]) / (y1[edge] - y0[edge]) +
+        x0[edge]
+    )
+
+    # Each polygon crosses a scanline an even number of times and pixels
+    # between pairs of sorted crossings lie within the polygon.
+    polygon_index = polygon_index[edge]
+    order = np.lexsort((crossings, rows, polygon_index))
+    crossings = crossings[order]
+    span_start = np.clip(np.ceil(crossings[0::2]), 0, width).astype(np.int64)
+    span_stop = np.clip(np.ceil(crossings[1::2]), 0, width).astype(np.int64)
+    span_length = np.maximum(span_stop - span_start, 0)
+    span_offset = rows[order][0::2] * width + span_start
+    pixels = np.repeat(span_offset, span_length) + _ranges(span_length)
+    values = np.repeat(labels[polygon_index[order][0::2]], span_length)
+    # Spans are sorted by polygon and later polygons overwrite pixels of
+    # previous ones. Assignment of duplicate indices isn't ordered, so only
+    # the last occurrence of each pixel is assigned.
+    _, last = np.unique(pixels[::-1], return_index=True)
+    last = len(pixels) - 1 - last
+    array.flat[pixels[last]] = values[last]
+
+
+def _get_uint8_lut(lower_bound, upper_bound):
+    # Building the 65536 entry table is as expensive as mapping an image.
+    # Bounds are typically fixed per channel layer, so cached tables get
+    # reused for all images of a layer.
+    key = (int(lower_bound), int(upper_bound))
+    if key not in _uint8_luts:
+        if len(_uint8_luts) >= _MAX_CACHED_LUTS:
+            _uint8_luts.clear()
+        lut = np.concatenate([
+            np.zeros(key[0], dtype=np.uint16),
+            np.linspace(0, 255, key[1] - key[0]).astype(np.uint16),
+            np.ones(2**16 - key[1], dtype=np.uint16) * 255
+        ]).astype(np.uint8)
+        lut.flags.writeable = False
+        _uint8_luts[key] = lut
+    return _uint8_luts[key]
+
+
+def _ranges(lengths):
+    # Concatenated ranges [0, length) for each element of lengths
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1] if len(ends) > 0 else 0) - np.repeat(
+        ends - lengths, lengths
+    )
+
+
+def _create_fallback_shell(y, x):
+    # Create a closed ring with coordinates sorted counter-clockwise
+    return np.array([
+        [x-1, x+1, x+1, x-1, x-1],
+        [y-1, y-1, y+1, y+1, y-1]
+    ]).T
+
+
+def _create_polygon(label, shell, holes):
+    poly = shapely.geometry.Polygon(shell, holes)
+    if not poly.is_valid:
+        logger.warn(
+            'invalid polygon for object #%d - trying to fix it',
+            label
+        )
+        # In some cases there may be invalid intersections
+        # that can be fixed with the buffer trick.
+        poly = poly.buffer(0)
+        if not poly.is_valid:
+            raise ValueError(
+                'Polygon of object #%d is invalid.' % label
+            )
+        if isinstance(poly, shapely.geometry.MultiPolygon):
+            logger.warn(
+                'object #%d has multiple polygons - '
+                'take largest', label
+            )
+            # Repair may create multiple polygons.
+            # We take the largest and discard the smaller ones.
+            areas = [g.area for g in poly.geoms]
+            index = areas.index(np.max(areas))
+            poly = poly.geoms[index]
+    return poly
+
+
+class ArrayBufferPool(object):
+
+    '''Pool of reusable pixel arrays.
+
+    Jobs that process many images of the same dimensions can acquire output
+    arrays from the pool and release them once the processed image is no
+    longer needed, such that memory gets recycled between images rather than
+    allocated anew for each image.
+
+    Examples
+    --------
+    >>> pool = ArrayBufferPool()
+    >>> for image in images:
+    ...     out = pool.acquire(image.dimensions, image.dtype)
+    ...     smoothed_image = image.smooth(2, inplace=False, out=out)
+    ...     process(smoothed_image)
+    ...     pool.release(out)
+    '''
+
+    def __init__(self, max_buffers=8):
+        '''
+        Parameters
+        ----------
+        max_buffers: int, optional
+            maximal number of released arrays that are retained for reuse;
+            arrays released in excess are left to the garbage collector
+            (default: ``8``)
+        '''
+        self.max_buffers = max_buffers
+        self._buffers = collections.defaultdict(list)
+        self._free_ids = set()
+        self._n_free = 0
+        self.n_allocated = 0
+        self.n_reused = 0
+
+    def acquire(self, shape, dtype):
+        '''Provides an array, which is either reused or newly allocated.
+
+        Parameters
+        ----------
+        shape: Tuple[int]
+            dimensions of the array
+        dtype: type
+            data type of the array
+
+        Returns
+        -------
+        numpy.ndarray
+            array with uninitialized values
+        '''
+        key = (tuple(shape), np.dtype(dtype))
+        if self._buffers[key]:
+            self._n_free -= 1
+            self.n_reused += 1
+            array = self._buffers[key].pop()
+            self._free_ids.remove(id(array))
+            return array
+        self.n_allocated += 1
+        return np.empty(key[0], dtype=key[1])
+
+    def release(self, array):
+        '''Returns an array to the pool.
+
+        Parameters
+        ----------
+        array: numpy.ndarray
+            array that was acquired from the pool and is no longer in use
+
+        Raises
+        ------
+        ValueError
+            when `array` doesn't own its memory, e.g. because it is a view
+            of another array, or when it has already been released
+
+        Warning
+        -------
+        Values of `array` will be overwritten once the array gets acquired
+        again. Views of the array must therefore not be used after release.
+        '''
+        # Views would hand out memory that is still used by other arrays and
+        # released arrays would be handed out to several users.
+        if array.base is not None:
+            raise ValueError('Only arrays that own their memory can be released.')
+        if id(array) in self._free_ids:
+            raise ValueError('Array has already been released.')
+        if self._n_free >= self.max_buffers:
+            return
+        self._buffers[(array.shape, array.dtype)].append(array)
+        self._free_ids.add(id(array))
+        self._n_free += 1
+
+    def __repr__(self):
+        return '<%s(allocated=%d, reused=%d)>' % (
+            self.__class__.__name__, self.n_allocated, self.n_reused
+        )
+
 
 class Image(object):
 
@@ -128,6 +547,15 @@ class Image(object):
         '''bool: whether pixels array has boolean data type'''
         return self.array.dtype == np.bool
 
+    @staticmethod
+    def _check_out(out, shape, dtype):
+        if out.shape != tuple(shape) or out.dtype != dtype:
+            raise ValueError(
+                'Argument "out" must have dimensions %s and type %s.' % (
+                    str(tuple(shape)), np.dtype(dtype).name
+                )
+            )
+
     def extract(self, y_offset, height, x_offset, width):
         '''Extracts a continuous, rectangular plane of pixels from the image.
 
@@ -250,7 +678,7 @@ class Image(object):
             raise ValueError('Unknown axis.')
         return self.__class__(array, self.metadata)
 
-    def pad_with_background(self, n, side):
+    def pad_with_background(self, n, side, out=None):
         '''Pads one side of the pixels array with zero values.
 
         Parameters
@@ -261,6 +689,9 @@ class Image(object):
             side of the array that should be padded relative to the *y*, *x*
             axis of an individual plane
             (options: ``{"top", "bottom", "left", "right"}``)
+        out: numpy.ndarray, optional
+            array with the dimensions of the padded image and the data type
+            of the image into which pixels should be written
 
         Returns
         -------
@@ -269,22 +700,29 @@ class Image(object):
         '''
         height, width = self.dimensions
         if side == 'top':
-            array = np.zeros((n, width), dtype=self.dtype)
-            array = np.vstack([array, self.array])
+            shape = (height + n, width)
+            region = (slice(n, None), slice(None))
         elif side == 'bottom':
-            array = np.zeros((n, width), dtype=self.dtype)
-            array = np.vstack([self.array, array])
+            shape = (height + n, width)
+            region = (slice(0, height), slice(None))
         elif side == 'left':
-            array = np.zeros((height, n), dtype=self.dtype)
-            array = np.hstack([array, self.array])
+            shape = (height, width + n)
+            region = (slice(None), slice(n, None))
         elif side == 'right':
-            array = np.zeros((height, n), dtype=self.dtype)
-            array = np.hstack([self.array, array])
+            shape = (height, width + n)
+            region = (slice(None), slice(0, width))
         else:
             raise ValueError('Unknown side.')
+        if out is None:
+            array = np.zeros(shape, dtype=self.dtype)
+        else:
+            self._check_out(out, shape, self.dtype)
+            array = out
+            array.fill(0)
+        array[region] = self.array
         return self.__class__(array, self.metadata)
 
-    def smooth(self, sigma, inplace=True):
+    def smooth(self, sigma, inplace=True, out=None):
         '''Applies a Gaussian smoothing filter to the pixels array.
 
         Parameters
@@ -294,13 +732,27 @@ class Image(object):
         inplace: bool, optional
             smooth the array inplace instead of returning a copy
             (default: ``True``)
+        out: numpy.ndarray, optional
+            array with the dimensions of the image into which
+            the smoothed pixels should be written; must have the data type of
+            the image in case of floating point pixels and ``numpy.float64``
+            otherwise (may be the array of the image itself)
 
         Returns
         -------
         tmlib.image.Image
             smoothed image
         '''
-        array = mh.gaussian_filter(self.array, sigma)
+        # Mahotas doesn't write the result of the last filter pass into
+        # "out", therefore the equivalent filter of scipy is used, such that
+        # results don't depend on whether "out" is provided.
+        dtype = self.dtype if self.is_float else np.float64
+        if out is not None:
+            self._check_out(out, self.dimensions, dtype)
+            array = out
+        else:
+            array = np.empty(self.array.shape, dtype=dtype)
+        ndi.gaussian_filter(self.array, sigma, output=array, mode='reflect')
         if inplace:
             self.array = array
             self.metadata.is_smoothed = True
@@ -310,7 +762,7 @@ class Image(object):
             new_img.metadata.is_smoothed = True
             return new_img
 
-    def shrink(self, factor, inplace=True):
+    def shrink(self, factor, inplace=True, out=None):
         '''Shrinks the first two dimensions of the pixels array
         by `factor`. pixels values of the aggregated array
         are the mean of the neighbouring pixels, where the neighbourhood
@@ -324,6 +776,9 @@ class Image(object):
         inplace: bool, optional
             shrink the array inplace instead of returning a copy
             (default: ``True``)
+        out: numpy.ndarray, optional
+            array with the dimensions of the shrunken image and the data type
+            of the image into which pixels should be written
 
         Returns
         -------
@@ -331,9 +786,13 @@ class Image(object):
             shrunken image
         '''
         height, width = self.dimensions
+        if out is not None:
+            self._check_out(
+                out, (height/factor, width/factor), self.dtype
+            )
         # NOTE: OpenCV uses (x, y) instead of (y, x)
         array = cv2.resize(
-            self.array, (width/factor, height/factor),
+            self.array, (width/factor, height/factor), dst=out,
             interpolation=cv2.INTER_AREA
         )
         if inplace:
@@ -343,7 +802,8 @@ class Image(object):
             return self.__class__(array, self.metadata)
 
     @staticmethod
-    def _shift_and_crop(img, y, x, bottom, top, right, left, crop=True):
+    def _shift_and_crop(img, y, x, bottom, top, right, left, crop=True,
+            out=None):
         '''Shifts and crops an image according to the calculated values shift and
         overhang values.
 
@@ -366,6 +826,8 @@ class Image(object):
         crop: bool, optional
             whether image should cropped or rather padded with zero valued pixels
             (default: ``True``)
+        out: numpy.ndarray, optional
+            array into which the aligned image should be written
 
         Returns
         -------
@@ -392,8 +854,15 @@ class Image(object):
                 col_end = -col_end
             if crop:
                 aligned_im = img[row_start:row_end, col_start:col_end]
+                if out is not None:
+                    out[:] = aligned_im
+                    aligned_im = out
             else:
-                aligned_im = np.zeros(img.shape, dtype=img.dtype)
+                if out is None:
+                    aligned_im = np.zeros(img.shape, dtype=img.dtype)
+                else:
+                    aligned_im = out
+                    aligned_im.fill(0)
                 extracted_im = img[row_start:row_end, col_start:col_end]
                 row_end = top + extracted_im.shape[0]
                 col_end = left + extracted_im.shape[1]
@@ -410,7 +879,7 @@ class Image(object):
                 'Reason: %s' % str(e)
             )
 
-    def align(self, crop=True, inplace=True):
+    def align(self, crop=True, inplace=True, out=None):
         '''Aligns, i.e. shifts and optionally crops, an image based on
         pre-calculated shift and residue values.
 
@@ -422,6 +891,10 @@ class Image(object):
         inplace: bool, optional
             whether the array of the existing image should be replaced instead
             of creating a copy (default: ``True``)
+        out: numpy.ndarray, optional
+            array with the dimensions of the aligned image and the data type
+            of the image into which pixels should be written (must not be the
+            array of the image itself)
 
         Returns
         -------
@@ -442,7 +915,7 @@ class Image(object):
         array = self._shift_and_crop(
             self.array, y=md.y_shift, x=md.x_shift,
             bottom=md.bottom_residue, top=md.top_residue,
-            right=md.right_residue, left=md.left_residue, crop=crop
+            right=md.right_residue, left=md.left_residue, crop=crop, out=out
         )
         if inplace:
             self.metadata.is_aligned = True
@@ -491,7 +964,7 @@ class ChannelImage(Image):
         self._array = value
 
     @staticmethod
-    def _map_to_uint8(img, lower_bound=None, upper_bound=None):
+    def _map_to_uint8(img, lower_bound=None, upper_bound=None, out=None):
         '''Maps a 16-bit image trough a lookup table to convert it to 8-bit.
 
         Parameters
@@ -506,6 +979,8 @@ class ChannelImage(Image):
             upper bound of the range that should be mapped to ``[0, 255]``,
             value must be in the range ``[0, 65535]``
             (defaults to ``numpy.max(img)``)
+        out: numpy.ndarray[numpy.uint8], optional
+            array into which the mapped image should be written
 
         Returns
         -------
@@ -524,14 +999,12 @@ class ChannelImage(Image):
             upper_bound = np.max(img)
         if lower_bound >= upper_bound:
             raise ValueError('"lower_bound" must be smaller than "upper_bound"')
-        lut = np.concatenate([
-            np.zeros(lower_bound, dtype=np.uint16),
-            np.linspace(0, 255, upper_bound - lower_bound).astype(np.uint16),
-            np.ones(2**16 - upper_bound, dtype=np.uint16) * 255
-        ])
-        return lut[img].astype(np.uint8)
+        lut = _get_uint8_lut(lower_bound, upper_bound)
+        if out is None:
+            return lut[img]
+        return np.take(lut, img, out=out, mode='clip')
 
-    def scale(self, lower, upper, inplace=True):
+    def scale(self, lower, upper, inplace=True, out=None):
         '''Scales values to 8-bit such that the range [`lower`, `upper`]
         will be mapped to the range [0, 255].
 
@@ -544,6 +1017,9 @@ class ChannelImage(Image):
         inplace: bool, optional
             whether values should be rescaled in place rather than creating
             a new image object (default: ``True``)
+        out: numpy.ndarray[numpy.uint8], optional
+            array with the dimensions of the image into which rescaled pixels
+            should be written (ignored when the image already has 8-bit)
 
         Returns
         -------
@@ -551,7 +1027,9 @@ class ChannelImage(Image):
             image with rescaled pixels
         '''
         if self.is_uint16:
-            array = self._map_to_uint8(self.array, lower, upper)
+            if out is not None:
+                self._check_out(out, self.dimensions, np.uint8)
+            array = self._map_to_uint8(self.array, lower, upper, out=out)
             if inplace:
                 self.array = array
                 self.metadata.is_rescaled = True
@@ -567,7 +1045,7 @@ class ChannelImage(Image):
                 'Only pixels with unsigned integer type can be scaled.'
             )
 
-    def clip(self, lower, upper, inplace=True):
+    def clip(self, lower, upper, inplace=True, out=None):
         '''Clips intensity values below `lower` and above `upper`, i.e. set all
         pixel values below `lower` to `lower` and all above `upper` to `upper`.
 
@@ -580,13 +1058,19 @@ class ChannelImage(Image):
         inplace: bool, optional
             whether values should be clipped in place rather than creating
             a new image object (default: ``True``)
+        out: numpy.ndarray, optional
+            array with the dimensions and data type of the image into which
+            clipped pixels should be written (may be the array of the image
+            itself)
 
         Returns
         -------
         tmlib.image.ChannelImage
             image with clipped pixels
         '''
-        array = np.clip(self.array, lower, upper)
+        if out is not None:
+            self._check_out(out, self.dimensions, self.dtype)
+        array = np.clip(self.array, lower, upper, out=out)
         if inplace:
             self.array = array
             self.metadata.is_clipped = True
@@ -638,7 +1122,8 @@ class ChannelImage(Image):
         ----------
         stats: tmlib.image.IllumstatsContainer
             mean and standard deviation statistics at each pixel position
-            calculated over all images of the same channel
+            calculated over all images of the same channel; downsampled
+            statistics get upsampled to the dimensions of the image
         inplace: bool, optional
             whether values should be corrected in place rather than creating
             a new image object (default: ``True``)
@@ -652,11 +1137,19 @@ class ChannelImage(Image):
         ------
         ValueError
             when channel doesn't match between illumination statistics and
-            image
+            image or when statistics that were not downsampled don't have
+            the dimensions of the image
         '''
         if (stats.mean.metadata.channel_id != self.metadata.channel_id or
                 stats.std.metadata.channel_id != self.metadata.channel_id):
             raise ValueError('Channels don\'t match!')
+        if stats.downsampling_factor > 1:
+            stats = stats.upsample(self.dimensions)
+        elif stats.mean.dimensions != self.dimensions:
+            raise ValueError(
+                'Image and illumination statistics must have the same '
+                'dimensions.'
+            )
         array = self._correct_illumination(
             self.array, stats.mean.array, stats.std.array
         )
@@ -693,6 +1186,276 @@ class ChannelImage(Image):
         return cv2.imencode('.tif', self.array)[1]
 
 
+class ChannelImagePreprocessor(object):
+
+    '''Fused preprocessing of channel images.
+
+    Performs illumination correction, alignment, clipping and rescaling
+    of a :class:`ChannelImage <tmlib.image.ChannelImage>` in a single pass,
+    which is equivalent to calling
+    :meth:`correct <tmlib.image.ChannelImage.correct>`,
+    :meth:`align <tmlib.image.Image.align>`,
+    :meth:`clip <tmlib.image.ChannelImage.clip>` and
+    :meth:`scale <tmlib.image.ChannelImage.scale>` one after the other.
+    Terms that only depend on the illumination statistics are computed once
+    upon construction and a single working buffer is reused for all images,
+    such that no full-size temporary arrays need to be allocated per image.
+
+    Examples
+    --------
+    >>> preprocessor = ChannelImagePreprocessor(
+    ...     stats=stats, align=True, crop=False,
+    ...     clip_min=layer.min_intensity, clip_max=layer.max_intensity,
+    ...     dtype=np.float32
+    ... )
+    >>> image = preprocessor.process(file.get())
+    '''
+
+    @assert_type(
+        stats=['tmlib.image.IllumstatsContainer', 'types.NoneType'],
+        align='bool', crop='bool',
+        pool=['tmlib.image.ArrayBufferPool', 'types.NoneType']
+    )
+    def __init__(self, stats=None, align=False, crop=True, clip_min=None,
+            clip_max=None, rescale=True, dtype=np.float64, pool=None):
+        '''
+        Parameters
+        ----------
+        stats: tmlib.image.IllumstatsContainer, optional
+            illumination statistics of the channel; images are only corrected
+            when provided
+        align: bool, optional
+            whether images should be aligned (default: ``False``)
+        crop: bool, optional
+            whether aligned images should be cropped or rather padded with
+            zero values (default: ``True``)
+        clip_min: int, optional
+            value below which pixel values should be clipped
+        clip_max: int, optional
+            value above which pixel values should be clipped
+        rescale: bool, optional
+            whether clipped 16-bit images should be rescaled to 8-bit such
+            that the range [`clip_min`, `clip_max`] will be mapped to the range
+            [0, 255] (default: ``True``)
+        dtype: type, optional
+            floating point type used for illumination correction; use
+            ``numpy.float32`` to halve memory traffic at the cost of precision
+            (default: ``numpy.float64``)
+        pool: tmlib.image.ArrayBufferPool, optional
+            pool from which output arrays should be acquired when no output
+            array is provided; arrays of preprocessed images should be
+            released to the pool once the images are no longer needed
+
+        Raises
+        ------
+        ValueError
+            when only one of `clip_min` and `clip_max` is provided or when
+            `dtype` is not a floating point type
+        '''
+        if (clip_min is None) != (clip_max is None):
+            raise ValueError(
+                'Arguments "clip_min" and "clip_max" must be provided together.'
+            )
+        if not np.issubdtype(dtype, np.floating):
+            raise ValueError('Argument "dtype" must be a floating point type.')
+        self.align = align
+        self.crop = crop
+        self.dtype = np.dtype(dtype)
+        self.clip_min = clip_min
+        self.clip_max = clip_max
+        self.rescale = rescale and clip_min is not None
+        self.pool = pool
+        if self.rescale:
+            self._lut = _get_uint8_lut(clip_min, clip_max)
+        self._stats = stats
+        self._correction_terms = dict()
+        if stats is not None:
+            self.channel_id = stats.mean.metadata.channel_id
+            if stats.downsampling_factor == 1:
+                self._get_correction_terms(stats.mean.dimensions)
+        else:
+            self.channel_id = None
+        self._buffers = dict()
+
+    @property
+    def correct(self):
+        '''bool: whether images get corrected for illumination artifacts'''
+        return self._stats is not None
+
+    def _get_correction_terms(self, dimensions):
+        # Downsampled statistics are upsampled to the dimensions of the first
+        # image, such that terms are only computed once per image size.
+        if dimensions not in self._correction_terms:
+            stats = self._stats
+            if stats.downsampling_factor > 1:
+                stats = stats.upsample(dimensions)
+            elif stats.mean.dimensions != dimensions:
+                raise ValueError(
+                    'Image and illumination statistics must have the same '
+                    'dimensions.'
+                )
+            mean = stats.mean.array
+            std = stats.std.array
+            # (log10(img) - mean) / std * mean(std) + mean(mean) is
+            # rearranged to ln(img) * gain + bias, such that the back
+            # transformation 10**x reduces to exp(x).
+            gain = np.mean(std) / std
+            bias = (np.mean(mean) - mean * gain) * np.log(10)
+            self._correction_terms[dimensions] = (
+                gain.astype(self.dtype), bias.astype(self.dtype)
+            )
+        return self._correction_terms[dimensions]
+
+    def _get_buffer(self, shape, dtype):
+        # Aligned regions differ slightly in size between sites, so a buffer
+        # is only reallocated when it is too small to hold the region.
+        dtype = np.dtype(dtype)
+        buf = self._buffers.get(dtype)
+        if buf is None or buf.shape[0] < shape[0] or buf.shape[1] < shape[1]:
+            if buf is not None:
+                shape = (max(buf.shape[0], shape[0]), max(buf.shape[1], shape[1]))
+            buf = np.empty(shape, dtype=dtype)
+            self._buffers[dtype] = buf
+        return buf[:shape[0], :shape[1]]
+
+    @staticmethod
+    def _calc_alignment_regions(shape, metadata, crop):
+        # Same slicing as in Image._shift_and_crop(), but expressed as the
+        # region of the source image and the region of the output image
+        # it ends up in.
+        y, x = metadata.y_shift, metadata.x_shift
+        row_start = metadata.top_residue - y
+        row_end = metadata.bottom_residue + y
+        row_end = shape[0] if row_end == 0 else -row_end
+        col_start = metadata.left_residue - x
+        col_end = metadata.right_residue + x
+        col_end = shape[1] if col_end == 0 else -col_end
+        src = (slice(row_start, row_end), slice(col_start, col_end))
+        height = len(xrange(*src[0].indices(shape[0])))
+        width = len(xrange(*src[1].indices(shape[1])))
+        if crop:
+            dst = (slice(0, height), slice(0, width))
+            out_shape = (height, width)
+        else:
+            top = metadata.top_residue
+            left = metadata.left_residue
+            dst = (slice(top, top + height), slice(left, left + width))
+            out_shape = shape
+        return (src, dst, out_shape)
+
+    @staticmethod
+    def _fill_outside(array, region, value):
+        rows, cols = region
+        array[:rows.start, :] = value
+        array[rows.stop:, :] = value
+        array[rows, :cols.start] = value
+        array[rows, cols.stop:] = value
+
+    @assert_type(image='tmlib.image.ChannelImage')
+    def process(self, image, out=None):
+        '''Preprocesses an image.
+
+        Parameters
+        ----------
+        image: tmlib.image.ChannelImage
+            image that should be preprocessed (pixels are not modified)
+        out: numpy.ndarray, optional
+            array into which the preprocessed pixels should be written, e.g.
+            a view of a larger preallocated array; must have the dimensions of
+            the preprocessed image and type ``numpy.uint8`` when 16-bit images
+            get rescaled or the type of `image` otherwise
+
+        Returns
+        -------
+        tmlib.image.ChannelImage
+            preprocessed image, whose array is `out` if provided
+
+        Raises
+        ------
+        ValueError
+            when channels don't match between illumination statistics and
+            image or when `out` has incorrect dimensions or type
+        AttributeError
+            when `image` has no metadata, but needs to be aligned or corrected
+        '''
+        array = image.array
+        if (self.correct or self.align) and image.metadata is None:
+            raise AttributeError(
+                'Image requires attribute "metadata" for preprocessing.'
+            )
+        if self.correct:
+            if image.metadata.channel_id != self.channel_id:
+                raise ValueError('Channels don\'t match!')
+            gain, bias = self._get_correction_terms(array.shape)
+        if self.align:
+            src, dst, out_shape = self._calc_alignment_regions(
+                array.shape, image.metadata, self.crop
+            )
+        else:
+            src = dst = (slice(0, array.shape[0]), slice(0, array.shape[1]))
+            out_shape = array.shape
+        # 8-bit images are neither clipped nor rescaled
+        is_clipped = self.clip_min is not None and image.is_uint16
+        is_rescaled = self.rescale and image.is_uint16
+        out_dtype = np.uint8 if is_rescaled else array.dtype
+        if out is None:
+            if self.pool is not None:
+                out = self.pool.acquire(out_shape, out_dtype)
+            else:
+                out = np.empty(out_shape, dtype=out_dtype)
+        elif out.shape != out_shape or out.dtype != out_dtype:
+            raise ValueError(
+                'Argument "out" must have dimensions %s and type %s.' % (
+                    str(out_shape), np.dtype(out_dtype).name
+                )
+            )
+        # Padded pixels are zero before clipping, such that they are raised
+        # to the lower clip bound unless the image gets rescaled.
+        if is_clipped and not is_rescaled:
+            self._fill_outside(out, dst, self.clip_min)
+        else:
+            self._fill_outside(out, dst, 0)
+
+        pixels = array[src]
+        if self.correct:
+            work = self._get_buffer(pixels.shape, self.dtype)
+            np.copyto(work, pixels)
+            np.maximum(work, 10**-10, out=work)
+            np.log(work, out=work)
+            work *= gain[src]
+            work += bias[src]
+            np.exp(work, out=work)
+            if is_clipped:
+                # Clipping before truncation gives the same result as
+                # truncation before clipping for non-negative values.
+                np.clip(work, self.clip_min, self.clip_max, out=work)
+            if is_rescaled:
+                pixels = self._get_buffer(pixels.shape, np.uint16)
+                np.copyto(pixels, work, casting='unsafe')
+            else:
+                np.copyto(out[dst], work, casting='unsafe')
+        elif is_clipped and not is_rescaled:
+            np.clip(pixels, self.clip_min, self.clip_max, out=out[dst])
+        elif not is_rescaled:
+            out[dst] = pixels
+        if is_rescaled:
+            # The lookup table saturates values outside the clip bounds.
+            np.take(self._lut, pixels, out=out[dst], mode='clip')
+
+        new_image = ChannelImage(out, image.metadata)
+        if new_image.metadata is None:
+            return new_image
+        if self.correct:
+            new_image.metadata.is_corrected = True
+        if self.align:
+            new_image.metadata.is_aligned = True
+        if is_clipped:
+            new_image.metadata.is_clipped = True
+        if is_rescaled:
+            new_image.metadata.is_rescaled = True
+        return new_image
+
+
 class SegmentationImage(Image):
 
     '''Class for a segmentation image: a labeled image where each segmented
@@ -762,24 +1525,181 @@ class SegmentationImage(Image):
         -------
         tmlib.image.SegmentationImage
             created image
+
+        Note
+        ----
+        Geometries of all objects are decoded in one go and filled into the
+        pixels array in a single scanline pass. Pixels that fall into more
+        than one polygon are assigned to the object that comes last.
         '''
         array = np.zeros(dimensions, dtype=np.int32)
-        for label, geometry in polygons:
-            poly = to_shape(geometry)
-            coordinates = np.array(poly.exterior.coords).astype(int)
-            x, y = np.split(coordinates, 2, axis=1)
-            y *= -1
-            x -= x_offset
-            y -= y_offset
-            y, x = skimage.draw.polygon(y, x, dimensions)
-            array[y, x] = label
+        if len(polygons) == 0:
+            return cls(array, metadata)
+        labels, geometries = zip(*polygons)
+        rings = _decode_polygon_exteriors(geometries)
+        for ring in rings:
+            # Coordinates are provided as x, inverted y
+            ring[:, 1] *= -1
+            ring[:, 0] -= x_offset
+            ring[:, 1] -= y_offset
+        _fill_polygons(array, rings, np.array(labels, dtype=np.int32))
         return cls(array, metadata)
 
-    def extract_polygons(self, y_offset, x_offset):
+    def extract_polygons(self, y_offset, x_offset, n_processes=1):
         '''Creates a polygon representation for each segmented object.
         The coordinates of the polygon contours are relative to the global map,
         i.e. an offset is added to the :class:`Site <tmlib.models.site.Site>`.
 
+        Parameters
+        ----------
+        y_offset: int
+            global vertical offset that needs to be subtracted from
+            *y*-coordinates (*y*-axis is inverted)
+        x_offset: int
+            global horizontal offset that needs to be added to *x*-coordinates
+        n_processes: int, optional
+            number of processes that should be used to trace contours and
+            create polygons; values larger than one are only worth it for
+            very large planes
+            (default: ``1``)
+
+        Returns
+        -------
+        Generator[Tuple[Union[int, shapely.geometry.polygon.Polygon]]]
+            label and geometry for each segmented object
+
+        Note
+        ----
+        Objects are sorted into groups of labels that don't touch each other
+        and contours of all objects of a group are traced at once on the
+        whole plane. The number of passes over the plane is therefore given
+        by the number of groups (typically a handful) rather than by the number
+        of objects.
+        '''
+        bboxes = mh.labeled.bbox(self.array)
+        # We set border pixels to zero to get closed contours for
+        # border objects. This may cause problems for very small objects
+        # at the border, because they may get lost.
+        # We recreate them later on (see below).
+        plane = self.array.copy()
+        plane[0, :] = 0
+        plane[-1, :] = 0
+        plane[:, 0] = 0
+        plane[:, -1] = 0
+
+        labels = np.unique(plane[plane > 0])
+        if len(labels) == 0:
+            return
+        sizes = np.bincount(plane.ravel())
+        # Objects consisting of a single pixel cannot be represented by a
+        # contour. They don't need to be traced, but are represented by the
+        # smallest possible valid polygon (see below).
+        groups = self._group_nonadjacent_labels(
+            plane, labels[sizes[labels] > 1]
+        )
+        polygons = dict()
+        if n_processes > 1:
+            chunks = [
+                c for g in groups for c in np.array_split(g, n_processes)
+                if len(c) > 0
+            ]
+            logger.debug(
+                'create polygons for %d objects in %d processes',
+                len(labels), n_processes
+            )
+            pool = multiprocessing.Pool(
+                n_processes, _init_contour_worker,
+                (plane, bboxes, y_offset, x_offset)
+            )
+            try:
+                for result in pool.map(_create_polygons_worker, chunks):
+                    for label, wkb in result.iteritems():
+                        polygons[label] = shapely.wkb.loads(wkb)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for group in groups:
+                polygons.update(_create_label_polygons(
+                    plane, group, bboxes, y_offset, x_offset
+                ))
+
+        missing_labels = [l for l in labels if l not in polygons]
+        if missing_labels:
+            centroids = ndi.center_of_mass(
+                np.ones(plane.shape, dtype=np.uint8), plane, missing_labels
+            )
+            for label, (y, x) in zip(missing_labels, centroids):
+                logger.warn('no contours identified for object #%d', label)
+                # This is most likely an object that does not extend
+                # beyond the line of border pixels or that consists of a
+                # single pixel.
+                # To ensure a correct number of objects we represent
+                # it by the smallest possible valid polygon.
+                shell = _create_fallback_shell(int(y), int(x))
+                shell[:, 0] = shell[:, 0] + x_offset
+                shell[:, 1] = -1 * (shell[:, 1] + y_offset)
+                polygons[label] = _create_polygon(label, shell, None)
+
+        for label in labels:
+            yield (int(label), polygons[label])
+
+    @staticmethod
+    def _group_nonadjacent_labels(plane, labels):
+        '''Assigns labels to groups such that objects of the same group
+        don't touch each other (considering 8-connectivity).
+
+        Parameters
+        ----------
+        plane: numpy.ndarray[numpy.int32]
+            labeled pixels array
+        labels: numpy.ndarray[numpy.int32]
+            labels that should be grouped
+
+        Returns
+        -------
+        List[numpy.ndarray[numpy.int32]]
+            labels of each group
+        '''
+        n = np.int64(plane.max()) + 1
+        pairs = list()
+        neighbourhoods = (
+            (plane[:, :-1], plane[:, 1:]),
+            (plane[:-1, :], plane[1:, :]),
+            (plane[:-1, :-1], plane[1:, 1:]),
+            (plane[:-1, 1:], plane[1:, :-1])
+        )
+        for a, b in neighbourhoods:
+            is_touching = (a != b) & (a > 0) & (b > 0)
+            a = a[is_touching].astype(np.int64)
+            b = b[is_touching].astype(np.int64)
+            pairs.append(np.minimum(a, b) * n + np.maximum(a, b))
+        pairs = np.unique(np.concatenate(pairs))
+        neighbours = collections.defaultdict(set)
+        for a, b in zip(pairs // n, pairs % n):
+            neighbours[a].add(b)
+            neighbours[b].add(a)
+        # Greedy coloring of the adjacency graph
+        colors = dict()
+        groups = collections.defaultdict(list)
+        for label in labels:
+            used_colors = {colors[l] for l in neighbours[label] if l in colors}
+            color = 0
+            while color in used_colors:
+                color += 1
+            colors[label] = color
+            groups[color].append(label)
+        return [np.array(groups[c], dtype=np.int32) for c in sorted(groups)]
+
+    def _extract_polygons_per_object(self, y_offset, x_offset):
+        '''Creates a polygon representation for each segmented object by
+        tracing contours individually within the bounding box of each object.
+
+        This is the reference implementation of
+        :meth:`extract_polygons <tmlib.image.SegmentationImage.extract_polygons>`.
+        The coordinates of the polygon contours are relative to the global map,
+        i.e. an offset is added to the :class:`Site <tmlib.models.site.Site>`.
+
         Parameters
         ----------
         y_offset: int
@@ -891,30 +1811,7 @@ class SegmentationImage(Image):
                 for i in range(len(holes)):
                     holes[i][:, 0] = holes[i][:, 0] + add_x
                     holes[i][:, 1] = -1 * (holes[i][:, 1] + add_y)
-            poly = shapely.geometry.Polygon(shell, holes)
-            if not poly.is_valid:
-                logger.warn(
-                    'invalid polygon for object #%d - trying to fix it',
-                    label
-                )
-                # In some cases there may be invalid intersections
-                # that can be fixed with the buffer trick.
-                poly = poly.buffer(0)
-                if not poly.is_valid:
-                    raise ValueError(
-                        'Polygon of object #%d is invalid.' % label
-                    )
-                if isinstance(poly, shapely.geometry.MultiPolygon):
-                    logger.warn(
-                        'object #%d has multiple polygons - '
-                        'take largest', label
-                    )
-                    # Repair may create multiple polygons.
-                    # We take the largest and discard the smaller ones.
-                    areas = [g.area for g in poly.geoms]
-                    index = areas.index(np.max(areas))
-                    poly = poly.geoms[index]
-            yield (int(label), poly)
+            yield (int(label), _create_polygon(label, shell, holes))
 
     @staticmethod
     def _get_bbox_image(img, bbox):
@@ -1142,7 +2039,9 @@ class IllumstatsContainer(object):
 
     Provides the mean and standard deviation matrices for a given channel.
     The statistics are calculated at each pixel position over all
-    sites acquired in the same channel [1]_.
+    sites acquired in the same channel [1]_. Statistics may also be calculated
+    for blocks of pixels, in which case they need to be upsampled to the
+    dimensions of images for correction.
 
     References
     ----------
@@ -1153,7 +2052,7 @@ class IllumstatsContainer(object):
     @assert_type(
         mean='tmlib.image.IllumstatsImage', std='tmlib.image.IllumstatsImage'
     )
-    def __init__(self, mean, std, percentiles):
+    def __init__(self, mean, std, percentiles, downsampling_factor=1):
         '''
         Parameters
         ----------
@@ -1164,10 +2063,65 @@ class IllumstatsContainer(object):
             over all sites
         percentiles: Dict[float, int]
             intensity percentiles calculated over all sites
+        downsampling_factor: int, optional
+            size of the blocks of pixels along the y and x axis for which
+            `mean` and `std` were calculated (default: ``1``)
         '''
         self.mean = mean
         self.std = std
         self.percentiles = percentiles
+        self.downsampling_factor = downsampling_factor
+        self._upsampled = None
+
+    def upsample(self, dimensions):
+        '''Upsamples mean and standard deviation statistic images to the
+        dimensions of images using bilinear interpolation between the
+        centers of blocks.
+
+        Parameters
+        ----------
+        dimensions: Tuple[int]
+            dimensions of images
+
+        Returns
+        -------
+        tmlib.image.IllumstatsContainer
+            statistics at each pixel position (the object itself in case
+            statistics were not downsampled)
+
+        Note
+        ----
+        Statistics upsampled to the most recently requested dimensions are
+        cached, such that they are only computed once for repeated
+        corrections of images with the same dimensions. The returned images
+        are therefore shared and read-only.
+        '''
+        dimensions = tuple(dimensions)
+        if self.mean.dimensions == dimensions:
+            return self
+        if self._upsampled is None or self._upsampled[0] != dimensions:
+            # NOTE: OpenCV uses (x, y) instead of (y, x)
+            size = (dimensions[1], dimensions[0])
+            mean = IllumstatsImage(
+                cv2.resize(
+                    self.mean.array, size, interpolation=cv2.INTER_LINEAR
+                ),
+                self.mean.metadata
+            )
+            std = IllumstatsImage(
+                cv2.resize(
+                    self.std.array, size, interpolation=cv2.INTER_LINEAR
+                ),
+                self.std.metadata
+            )
+            mean.array.flags.writeable = False
+            std.array.flags.writeable = False
+            # Only a single upsampled copy is kept, which bounds the memory
+            # held by cached statistics.
+            self._upsampled = (
+                dimensions, IllumstatsContainer(mean, std, self.percentiles)
+            )
+        return self._upsampled[1]
 
     def smooth(self, sigma=5):
         '''Smoothes mean and standard deviation statistic images with a
@@ -1178,7 +2132,8 @@ class IllumstatsContainer(object):
         Parameters
         ----------
         sigma: int, optional
-            size of the standard deviation of the Gaussian kernel
+            size of the standard deviation of the Gaussian kernel in pixels
+            of images, i.e. it is scaled by the downsampling factor
             (default: ``5``)
 
         Note
@@ -1186,10 +2141,9 @@ class IllumstatsContainer(object):
         :attr:`mean <tmlib.image.IllumstatsImage.mean>` and
         :attr:`std <tmlib.image.IllumstatsImage.std>` are modified in place.
         '''
-        self.mean.array = self.mean.smooth(sigma).array
-        self.mean.metadata.is_smoothed = True
-        self.std.array = self.std.smooth(sigma).array
-        self.std.metadata.is_smoothed = True
+        sigma = sigma / float(self.downsampling_factor)
+        self.mean.smooth(sigma, out=self.mean.array)
+        self.std.smooth(sigma, out=self.std.array)
         return self
 
     def get_closest_percentile(self, value):
@@ -22,7 +22,9 @@ import collections
 import lxml
 import numpy as np
 from cached_property import cached_property
-from sqlalchemy import Column, Integer, ForeignKey, String, UniqueConstraint
+from sqlalchemy import (
+    Column, Integer, ForeignKey, String, Boolean, UniqueConstraint
+)
 from sqlalchemy import or_
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.ext.declarative import declared_attr
@@ -188,6 +190,18 @@ class ChannelLayer(ExperimentModel, IdMixIn):
     #: bit depth before rescaling to 8-bit
     min_intensity = Column(Integer)
 
+    #: bool: whether tiles at the maximal zoom level are rendered upon
+    #: request rather than stored when the pyramid gets built
+    lazy = Column(Boolean, default=False)
+
+    #: bool: whether images were corrected for illumination artifacts
+    #: when the pyramid got built
+    illumcorr = Column(Boolean, default=False)
+
+    #: bool: whether images were aligned between multiplexing cycles
+    #: when the pyramid got built
+    align = Column(Boolean, default=False)
+
     #: int: ID of parent channel
     channel_id = Column(
         Integer,
@@ -216,6 +230,20 @@ class ChannelLayer(ExperimentModel, IdMixIn):
         self.zplane = zplane
         self.channel_id = channel_id
 
+    @property
+    def tiles_location(self):
+        '''str: location where pyramid tiles are stored in case they are not
+        stored in the database
+
+        See also
+        --------
+        :attr:`tmlib.config.LibraryConfig.tile_store`
+        '''
+        return os.path.join(
+            self.channel.location,
+            CHANNEL_LAYER_LOCATION_FORMAT.format(id=self.id), 'tiles'
+        )
+
     @cached_property
     def height(self):
         '''int: number of pixels along vertical axis at highest resolution level
@@ -453,27 +481,8 @@ class ChannelLayer(ExperimentModel, IdMixIn):
         # or plates represent an exception because in these cases there is
         # no neighboring image to create the tile instead, but an empty spacer.
         # The same is true in case of missing neighboring images.
-        session = Session.object_session(self)
-        lower_neighbor_count = session.query(ChannelImageFile.id).\
-            join(Site).\
-            filter(
-                Site.y == site.y + 1, Site.x == site.x,
-                Site.well_id == site.well_id,
-                ChannelImageFile.channel_id == self.channel_id,
-                ChannelImageFile.tpoint == self.tpoint
-            ).\
-            count()
-        right_neighbor_count = session.query(ChannelImageFile.id).\
-            join(Site).\
-            filter(
-                Site.y == site.y, Site.x == site.x + 1,
-                Site.well_id == site.well_id,
-                ChannelImageFile.channel_id == self.channel_id,
-                ChannelImageFile.tpoint == self.tpoint
-            ).\
-            count()
-        has_lower_neighbor = lower_neighbor_count > 0
-        has_right_neighbor = right_neighbor_count > 0
+        has_lower_neighbor = self._has_image(site.well_id, site.y + 1, site.x)
+        has_right_neighbor = self._has_image(site.well_id, site.y, site.x + 1)
         for i, y in enumerate(row_info['indices']):
             y_offset = row_info['offsets'][i]
             is_overhanging_vertically = (
@@ -502,6 +511,21 @@ class ChannelLayer(ExperimentModel, IdMixIn):
                 })
         return mappings
 
+    def _has_image(self, well_id, y, x):
+        # Determines whether an image of the layer exists at the given
+        # position within the well.
+        session = Session.object_session(self)
+        count = session.query(ChannelImageFile.id).\
+            join(Site).\
+            filter(
+                Site.y == y, Site.x == x,
+                Site.well_id == well_id,
+                ChannelImageFile.channel_id == self.channel_id,
+                ChannelImageFile.tpoint == self.tpoint
+            ).\
+            count()
+        return count > 0
+
     def get_empty_base_tile_coordinates(self):
         '''Gets coordinates of empty base tiles, i.e. tiles at the maximum
         zoom level that don't map to an image because they fall into
@@ -511,13 +535,14 @@ class ChannelLayer(ExperimentModel, IdMixIn):
         -------
         Set[Tuple[int]]
             row, column coordinates
+
+        See also
+        --------
+        :meth:`tmlib.models.channel.ChannelLayerLayout.get_empty_base_tile_spans`
         '''
         logger.debug('get coordinates of empty tiles at maxzoom level')
-        tile_coords = self.base_tile_coordinate_to_image_file_map.keys()
-        rows = range(self.dimensions[-1][0])
-        cols = range(self.dimensions[-1][1])
-        all_tile_coords = list(itertools.product(rows, cols))
-        return set(all_tile_coords) - set(tile_coords)
+        rows, cols = np.nonzero(~self.layout.occupancy)
+        return set(zip(rows.tolist(), cols.tolist()))
 
     def _calc_tile_indices(self, position, length, displacement):
         '''Calculates row or column index for each tile
@@ -608,40 +633,19 @@ class ChannelLayer(ExperimentModel, IdMixIn):
         return mapping
 
     @cached_property
+    def layout(self):
+        '''tmlib.models.channel.ChannelLayerLayout: geometry of all images
+        of the layer at the maximal zoom level
+        '''
+        return ChannelLayerLayout.load(self)
+
+    @property
     def base_tile_coordinate_to_image_file_map(self):
         '''Dict[Tuple[int], List[int]]: IDs of all images, which intersect
         with a given tile; maps coordinates of tiles at the maximal zoom level
         to the files of intersecting images
         '''
-        logger.debug('create mapping of base tile coordinates to image files')
-        experiment = self.channel.experiment
-        session = Session.object_session(self)
-        sites = session.query(Site).\
-            join(Well).\
-            join(Plate).\
-            filter(Plate.experiment_id == experiment.id)
-        mapping = collections.defaultdict(list)
-        for site in sites:
-            if site.omitted:
-                continue
-            fid = session.query(ChannelImageFile.id).\
-                filter_by(
-                    site_id=site.id, channel_id=self.channel.id,
-                    tpoint=self.tpoint, zplane=self.zplane
-                ).\
-                one()[0]
-            y_offset_site, x_offset_site = site.offset
-            row_indices = self._calc_tile_indices(
-                y_offset_site, site.image_size[0],
-                experiment.vertical_site_displacement
-            )
-            col_indices = self._calc_tile_indices(
-                x_offset_site, site.image_size[1],
-                experiment.horizontal_site_displacement
-            )
-            for y, x in itertools.product(row_indices, col_indices):
-                mapping[(y, x)].append(fid)
-        return mapping
+        return self.layout.base_tile_coordinate_to_image_file_map
 
     def calc_coordinates_of_next_higher_level(self, z, y, x):
         '''Calculates for a given tile the coordinates of the 4 tiles at the
@@ -742,3 +746,482 @@ class ChannelLayer(ExperimentModel, IdMixIn):
                 self.tpoint, self.zplane)
         )
 
+
+class ChannelLayerLayout(object):
+
+    '''Geometry of all images of a
+    :class:`ChannelLayer <tmlib.models.channel.ChannelLayer>` at the maximal
+    zoom level.
+
+    Sites, wells and plates are loaded once and the position of each image
+    within the layer as well as the tiles that intersect with each image
+    are computed for all images at once. This avoids issuing queries and
+    loading related objects for each image individually.
+
+    See also
+    --------
+    :meth:`tmlib.models.channel.ChannelLayer.map_image_to_base_tiles`
+    :meth:`tmlib.models.channel.ChannelLayer.map_base_tile_to_images`
+    '''
+
+    def __init__(self, sites, files, plate_grid, well_spacer_size,
+            plate_spacer_size, vertical_site_displacement=0,
+            horizontal_site_displacement=0, tile_size=256):
+        '''
+        Parameters
+        ----------
+        sites: List[Tuple]
+            ID, *y* and *x* coordinate, height, width, whether the site was
+            omitted, well ID, well name and plate ID of each site of the
+            experiment
+        files: List[Tuple[int]]
+            ID of each image file of the layer and ID of the corresponding site
+        plate_grid: numpy.ndarray[int]
+            IDs of plates arranged according to their relative position within
+            the experiment (see
+            :attr:`tmlib.models.experiment.Experiment.plate_grid`)
+        well_spacer_size: int
+            gap between neighboring wells in pixels
+        plate_spacer_size: int
+            gap between neighboring plates in pixels
+        vertical_site_displacement: int, optional
+            displacement of neighboring sites within a well along the
+            vertical axis in pixels (default: ``0``)
+        horizontal_site_displacement: int, optional
+            displacement of neighboring sites within a well along the
+            horizontal axis in pixels (default: ``0``)
+        tile_size: int, optional
+            maximal number of pixels along each axis of a tile
+            (default: ``256``)
+        '''
+        logger.debug('calculate layout of %d sites', len(sites))
+        self.tile_size = tile_size
+        self._displacement = np.array(
+            [vertical_site_displacement, horizontal_site_displacement]
+        )
+        if len(sites) > 0:
+            (site_ids, site_y, site_x, heights, widths, omitted,
+                site_well_ids, well_names, site_plate_ids) = zip(*sites)
+        else:
+            (site_ids, site_y, site_x, heights, widths, omitted,
+                site_well_ids, well_names, site_plate_ids) = [()] * 9
+        # Sites are sorted by ID, such that the first site of each well
+        # represents the well (in analogy to Well._image_size)
+        site_ids = np.array(site_ids, dtype=np.int64)
+        order = np.argsort(site_ids, kind='mergesort')
+        site_ids = site_ids[order]
+        coordinates = np.column_stack([
+            np.array(site_y, dtype=np.int64)[order],
+            np.array(site_x, dtype=np.int64)[order]
+        ])
+        sizes = np.column_stack([
+            np.array(heights, dtype=np.int64)[order],
+            np.array(widths, dtype=np.int64)[order]
+        ])
+        omitted = np.array(omitted, dtype=bool)[order]
+        well_names = np.array(well_names, dtype=object)[order]
+        site_plate_ids = np.array(site_plate_ids, dtype=np.int64)[order]
+
+        well_ids, first_site_index, well_index = np.unique(
+            np.array(site_well_ids, dtype=np.int64)[order],
+            return_index=True, return_inverse=True
+        )
+        well_dimensions = np.zeros((len(well_ids), 2), dtype=np.int64)
+        np.maximum.at(well_dimensions, well_index, coordinates + 1)
+        well_sizes = (
+            well_dimensions * sizes[first_site_index] +
+            self._displacement * (well_dimensions - 1)
+        )
+        well_coordinates = np.array([
+            Well.map_name_to_coordinate(name)
+            for name in well_names[first_site_index]
+        ], dtype=np.int64).reshape(-1, 2)
+
+        # Wells are allowed to have different sizes, but all wells of a plate
+        # are placed using the size of the largest well. Empty rows and
+        # columns of the plate are skipped.
+        plate_ids, well_plate_index = np.unique(
+            site_plate_ids[first_site_index], return_inverse=True
+        )
+        plate_well_sizes = np.zeros((len(plate_ids), 2), dtype=np.int64)
+        np.maximum.at(plate_well_sizes, well_plate_index, well_sizes)
+        plate_dimensions = np.zeros((len(plate_ids), 2), dtype=np.int64)
+        well_positions = np.zeros((len(well_ids), 2), dtype=np.int64)
+        for i in xrange(len(plate_ids)):
+            is_plate = well_plate_index == i
+            for axis in xrange(2):
+                nonempty, positions = np.unique(
+                    well_coordinates[is_plate, axis], return_inverse=True
+                )
+                well_positions[is_plate, axis] = positions
+                plate_dimensions[i, axis] = len(nonempty)
+        plate_sizes = (
+            plate_dimensions * plate_well_sizes +
+            well_spacer_size * (plate_dimensions - 1)
+        )
+        plate_coordinates = np.array([
+            np.argwhere(plate_grid == pid)[0] for pid in plate_ids
+        ], dtype=np.int64).reshape(-1, 2)
+        plate_offsets = plate_coordinates * (plate_sizes + plate_spacer_size)
+        well_offsets = (
+            well_positions *
+            (plate_well_sizes[well_plate_index] + well_spacer_size) +
+            plate_offsets[well_plate_index]
+        )
+        site_offsets = (
+            coordinates * (sizes + self._displacement) +
+            well_offsets[well_index]
+        )
+
+        grid_shape = np.array(plate_grid.shape)
+        if len(plate_ids) > 0:
+            if len(np.unique(plate_sizes[:, 0])) > 1 or \
+                    len(np.unique(plate_sizes[:, 1])) > 1:
+                logger.warning('plates don\'t have equal sizes')
+            plate_size = np.max(plate_sizes, axis=0)
+        else:
+            plate_size = np.zeros((2, ), dtype=np.int64)
+        self.image_size = tuple(
+            (plate_size * grid_shape +
+                (grid_shape - 1) * plate_spacer_size).tolist()
+        )
+
+        # Geometry of sites, wells and plates is exposed for creating
+        # static mapobjects. Offsets and sizes are given as
+        # *y*, *x* and height, width, respectively.
+        #: numpy.ndarray[int]: IDs of sites (sorted)
+        self.site_ids = site_ids
+        #: numpy.ndarray[int]: offset of each site (see
+        #: :attr:`tmlib.models.site.Site.offset`)
+        self.site_offsets = site_offsets
+        #: numpy.ndarray[int]: size of each site
+        self.site_sizes = sizes
+        #: numpy.ndarray[int]: IDs of wells (sorted)
+        self.well_ids = well_ids
+        #: numpy.ndarray[int]: offset of each well (see
+        #: :attr:`tmlib.models.well.Well.offset`)
+        self.well_offsets = well_offsets
+        #: numpy.ndarray[int]: size of each well (see
+        #: :attr:`tmlib.models.well.Well.image_size`)
+        self.well_sizes = plate_well_sizes[well_plate_index]
+        #: numpy.ndarray[int]: IDs of plates (sorted)
+        self.plate_ids = plate_ids
+        #: numpy.ndarray[int]: offset of each plate (see
+        #: :attr:`tmlib.models.plate.Plate.offset`)
+        self.plate_offsets = plate_offsets
+        #: numpy.ndarray[int]: size of each plate (see
+        #: :attr:`tmlib.models.plate.Plate.image_size`)
+        self.plate_sizes = plate_sizes
+
+        if len(files) > 0:
+            file_ids, file_site_ids = zip(*files)
+        else:
+            file_ids, file_site_ids = (), ()
+        #: numpy.ndarray[int]: IDs of image files of the layer
+        self.file_ids = np.array(file_ids, dtype=np.int64)
+        self._file_index = dict(
+            (fid, i) for i, fid in enumerate(self.file_ids.tolist())
+        )
+        index = np.searchsorted(site_ids, np.array(file_site_ids, np.int64))
+        #: numpy.ndarray[int]: *y*, *x* coordinate of the top, left corner
+        #: of each image relative to the layer at the maximal zoom level
+        self.offsets = site_offsets[index]
+        self._sizes = sizes[index]
+        self._coordinates = coordinates[index]
+        self._omitted = omitted[index]
+        self._well_index = well_index[index]
+        self._well_dimensions = well_dimensions[well_index[index]]
+
+        end = self.offsets + self._sizes - self._displacement
+        self._tile_start = self.offsets // tile_size
+        self._tile_end = -(-end // tile_size)
+
+        # Positions of images within wells are encoded as integers to
+        # look up neighboring images.
+        if len(self.file_ids) > 0:
+            self._key_shape = self._coordinates.max(axis=0) + 2
+        else:
+            self._key_shape = np.ones((2, ), dtype=np.int64)
+        self._keys = self._encode_position(self._well_index, self._coordinates)
+
+    def _encode_position(self, well_index, coordinates):
+        return (
+            (well_index * self._key_shape[0] + coordinates[:, 0]) *
+            self._key_shape[1] + coordinates[:, 1]
+        )
+
+    @classmethod
+    def load(cls, layer):
+        '''Loads the geometry of all images of a given layer from the database.
+
+        Parameters
+        ----------
+        layer: tmlib.models.channel.ChannelLayer
+            channel layer
+
+        Returns
+        -------
+        tmlib.models.channel.ChannelLayerLayout
+        '''
+        logger.debug('load layout of channel layer %d', layer.id)
+        experiment = layer.channel.experiment
+        session = Session.object_session(layer)
+        sites = session.query(
+                Site.id, Site.y, Site.x, Site.height, Site.width,
+                Site.omitted, Site.well_id, Well.name, Well.plate_id
+            ).\
+            join(Well).\
+            join(Plate).\
+            filter(Plate.experiment_id == experiment.id).\
+            all()
+        files = session.query(
+                ChannelImageFile.id, ChannelImageFile.site_id
+            ).\
+            filter_by(
+                channel_id=layer.channel_id, tpoint=layer.tpoint,
+                zplane=layer.zplane
+            ).\
+            all()
+        return cls(
+            sites, files, experiment.plate_grid,
+            experiment.well_spacer_size, experiment.plate_spacer_size,
+            experiment.vertical_site_displacement,
+            experiment.horizontal_site_displacement,
+            layer.tile_size
+        )
+
+    @property
+    def dimensions(self):
+        '''Tuple[int]: number of tiles along the vertical and horizontal axis
+        of the layer at the maximal zoom level
+        '''
+        return tuple(
+            int(np.ceil(float(s) / self.tile_size)) for s in self.image_size
+        )
+
+    @cached_property
+    def _tiles(self):
+        # Expands the tile range of each image into one element per tile,
+        # ordered by image and row-wise within each image.
+        n_tiles = self._tile_end - self._tile_start
+        counts = n_tiles[:, 0] * n_tiles[:, 1]
+        index = np.repeat(np.arange(len(self.file_ids)), counts)
+        k = (
+            np.arange(np.sum(counts)) -
+            np.repeat(np.cumsum(counts) - counts, counts)
+        )
+        i = k // n_tiles[index, 1]
+        j = k % n_tiles[index, 1]
+        coordinates = self._tile_start[index] + np.column_stack([i, j])
+        offsets = (
+            -(self.offsets[index] % self.tile_size) +
+            np.column_stack([i, j]) * self.tile_size
+        )
+        return (index, coordinates, offsets)
+
+    @cached_property
+    def _base_tile_mappings(self):
+        index, coordinates, offsets = self._tiles
+        # Tiles that overlap neighboring images are only mapped to the
+        # image at the lower and/or right border (see
+        # ChannelLayer.map_image_to_base_tiles).
+        has_neighbor = np.column_stack([
+            np.in1d(
+                self._encode_position(
+                    self._well_index, self._coordinates + shift
+                ),
+                self._keys
+            )
+            for shift in ([1, 0], [0, 1])
+        ])
+        is_overhanging = offsets + self.tile_size > self._sizes[index]
+        is_not_layer_border = coordinates + 1 != np.array(self.dimensions)
+        is_not_well_border = (
+            self._coordinates[index] + 1 != self._well_dimensions[index]
+        )
+        is_skipped = (
+            is_overhanging & has_neighbor[index] &
+            is_not_layer_border & is_not_well_border
+        )
+        is_mapped = ~(is_skipped[:, 0] | is_skipped[:, 1])
+        index = index[is_mapped]
+        bounds = np.searchsorted(index, np.arange(len(self.file_ids) + 1))
+        return (bounds, coordinates[is_mapped], offsets[is_mapped])
+
+    def map_image_to_base_tiles(self, image_file_id):
+        '''Maps an image to the corresponding tiles at the base of the pyramid
+        (maximal zoom level) that intersect with the image.
+
+        Parameters
+        ----------
+        image_file_id: int
+            ID of the file containing the image that should be mapped
+
+        Returns
+        -------
+        List[Dict[str, int]]
+            mappings with *y* and *x* coordinate as well as
+            *y_offset* and *x_offset* relative to the image
+            for each tile whose pixels are part of the image
+
+        See also
+        --------
+        :meth:`tmlib.models.channel.ChannelLayer.map_image_to_base_tiles`
+        '''
+        bounds, coordinates, offsets = self._base_tile_mappings
+        i = self._file_index[image_file_id]
+        return [
+            {'y': c[0], 'x': c[1], 'y_offset': o[0], 'x_offset': o[1]}
+            for c, o in zip(
+                coordinates[bounds[i]:bounds[i+1]].tolist(),
+                offsets[bounds[i]:bounds[i+1]].tolist()
+            )
+        ]
+
+    def map_base_tile_to_images(self, image_file_id):
+        '''Maps tiles at the maximal zoom level to the IDs of images, which
+        intersect with the given tile. Only images bordering the given image to
+        the left and/or top within the same well are considered.
+
+        Parameters
+        ----------
+        image_file_id: int
+            ID of the file containing the image whose neighbours should be
+            included in the search
+
+        Returns
+        -------
+        Dict[Tuple[int], List[int]]
+            IDs of images intersecting with a given tile hashable by tile
+            y, x coordinates
+
+        See also
+        --------
+        :meth:`tmlib.models.channel.ChannelLayer.map_base_tile_to_images`
+        '''
+        i = self._file_index[image_file_id]
+        neighbor_keys = self._encode_position(
+            np.repeat(self._well_index[i], 3),
+            self._coordinates[i] - np.array([[1, 1], [1, 0], [0, 1]])
+        )
+        positions = np.where(np.in1d(self._keys, neighbor_keys))[0]
+        mapping = collections.defaultdict(list)
+        for j in positions[~self._omitted[positions]]:
+            start = self._tile_start[j].tolist()
+            end = self._tile_end[j].tolist()
+            rows = range(start[0], end[0])
+            cols = range(start[1], end[1])
+            for y, x in itertools.product(rows, cols):
+                mapping[(y, x)].append(int(self.file_ids[j]))
+        return mapping
+
+    def find_images_of_base_tiles(self, coordinates):
+        '''Finds the images to which tiles at the maximal zoom level are
+        mapped, i.e. the images from which the tiles are created.
+
+        Parameters
+        ----------
+        coordinates: List[Tuple[int]]
+            zero-based row and column indices of tiles
+
+        Returns
+        -------
+        List[int]
+            sorted IDs of the files containing the images; tiles that don't
+            intersect with any image are not considered
+
+        See also
+        --------
+        :meth:`tmlib.models.channel.ChannelLayerLayout.map_image_to_base_tiles`
+        '''
+        bounds, mapped_coordinates, _ = self._base_tile_mappings
+        n_cols = self.dimensions[1]
+        coordinates = np.array(coordinates, dtype=np.int64).reshape(-1, 2)
+        positions = np.where(np.in1d(
+            mapped_coordinates[:, 0] * n_cols + mapped_coordinates[:, 1],
+            coordinates[:, 0] * n_cols + coordinates[:, 1]
+        ))[0]
+        index = np.searchsorted(bounds, positions, side='right') - 1
+        return np.unique(self.file_ids[index]).tolist()
+
+    @cached_property
+    def base_tile_coordinate_to_image_file_map(self):
+        '''Dict[Tuple[int], List[int]]: IDs of all images, which intersect
+        with a given tile; maps coordinates of tiles at the maximal zoom level
+        to the files of intersecting images
+        '''
+        logger.debug('create mapping of base tile coordinates to image files')
+        index, coordinates, _ = self._tiles
+        is_included = ~self._omitted[index]
+        file_ids = self.file_ids[index[is_included]]
+        coordinates = coordinates[is_included]
+        order = np.lexsort((file_ids, coordinates[:, 1], coordinates[:, 0]))
+        mapping = collections.defaultdict(list)
+        for y, x, fid in zip(coordinates[order, 0].tolist(),
+                coordinates[order, 1].tolist(), file_ids[order].tolist()):
+            mapping[(y, x)].append(fid)
+        return mapping
+
+    @cached_property
+    def occupancy(self):
+        '''numpy.ndarray[bool]: whether a tile at the maximal zoom level
+        intersects with an image; the grid has the dimensions of the layer
+        at the maximal zoom level
+        '''
+        logger.debug('create occupancy grid of base tiles')
+        shape = self.dimensions
+        # The tile range of each image is added to a difference grid,
+        # whose cumulative sums along both axes count the images that
+        # intersect with each tile.
+        diff = np.zeros((shape[0] + 1, shape[1] + 1), dtype=np.int32)
+        start = self._tile_start[~self._omitted]
+        end = np.minimum(self._tile_end[~self._omitted], shape)
+        np.add.at(diff, (start[:, 0], start[:, 1]), 1)
+        np.add.at(diff, (start[:, 0], end[:, 1]), -1)
+        np.add.at(diff, (end[:, 0], start[:, 1]), -1)
+        np.add.at(diff, (end[:, 0], end[:, 1]), 1)
+        counts = diff.cumsum(axis=0).cumsum(axis=1)
+        return counts[:shape[0], :shape[1]] > 0
+
+    def get_empty_base_tile_spans(self):
+        '''Gets rectangular regions of empty tiles at the maximal zoom level,
+        i.e. tiles that don't intersect with any image because they fall
+        into a spacer region, e.g. the gap between wells.
+
+        Returns
+        -------
+        numpy.ndarray[int]
+            zero-based index of the first and one past the last row as well
+            as of the first and one past the last column of each region
+            (*n*x4 array); regions don't overlap
+
+        Note
+        ----
+        Empty tiles are run-length encoded per row and runs that span the
+        same columns in consecutive rows are merged.
+        '''
+        logger.debug('get spans of empty tiles at maxzoom level')
+        is_empty = ~self.occupancy
+        padded = np.zeros((is_empty.shape[0], is_empty.shape[1] + 2), np.int8)
+        padded[:, 1:-1] = is_empty
+        changes = np.diff(padded, axis=1)
+        rows, col_start = np.nonzero(changes == 1)
+        _, col_end = np.nonzero(changes == -1)
+        # Runs are sorted by columns and rows, such that a run that
+        # continues a region directly follows the run of the previous row.
+        order = np.lexsort((rows, col_end, col_start))
+        rows = rows[order]
+        col_start = col_start[order]
+        col_end = col_end[order]
+        is_new = np.ones(len(rows), dtype=bool)
+        is_new[1:] = (
+            (rows[1:] != rows[:-1] + 1) |
+            (col_start[1:] != col_start[:-1]) |
+            (col_end[1:] != col_end[:-1])
+        )
+        first = np.where(is_new)[0]
+        last = np.append(first[1:], len(rows)) - 1
+        spans = np.column_stack([
+            rows[first], rows[last] + 1, col_start[first], col_end[first]
+        ])
+        return spans[np.lexsort((spans[:, 2], spans[:, 0]))].astype(np.int64)
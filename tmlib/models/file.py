@@ -14,7 +14,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
+import random
 import logging
+import collections
 import numpy as np
 from sqlalchemy import Column, String, Integer, Text, Boolean, ForeignKey
 from sqlalchemy.orm import relationship, backref, Session
@@ -41,6 +43,12 @@ from tmlib.models.alignment import SiteShift
 
 logger = logging.getLogger(__name__)
 
+#: collections.OrderedDict: illumination statistics loaded in the current
+#: process together with the revision of the file, keyed by location
+_illumstats_cache = collections.OrderedDict()
+
+_ILLUMSTATS_CACHE_SIZE = 8
+
 
 @remove_location_upon_delete
 class MicroscopeImageFile(FileModel, DateMixIn):
@@ -386,11 +394,20 @@ class IllumstatsFile(FileModel, DateMixIn):
     deviation values calculated at each pixel position across all images of
     the same *channel* and *cycle*.
 
+    Smoothed versions of the matrices are stored alongside the raw ones, such
+    that they don't have to be derived upon each load.
     '''
 
     #: Format string to build filename
     FILENAME_FORMAT = 'illumstats_file_{id}.h5'
 
+    #: int: version of the smoothing procedure; stored smoothed matrices of a
+    #: different version are ignored and derived from the raw matrices instead
+    SMOOTHING_VERSION = 1
+
+    #: int: standard deviation of the Gaussian smoothing kernel
+    SMOOTHING_SIGMA = 5
+
     __tablename__ = 'illumstats_files'
 
     __table_args__ = (UniqueConstraint('channel_id'), )
@@ -418,42 +435,151 @@ class IllumstatsFile(FileModel, DateMixIn):
         self.channel_id = channel_id
 
     def get(self):
-        '''Get illumination statistics images from store.
+        '''Get smoothed illumination statistics images from store.
 
         Returns
         -------
         Illumstats
             illumination statistics images
+
+        Note
+        ----
+        Statistics are cached in memory, such that repeated loading of the
+        same file within a process only needs to read the revision of the
+        file, which changes every time statistics are written. The returned
+        images are therefore shared and read-only. Statistics of files that
+        were written without a revision are not cached.
         '''
-        logger.debug(
-            'get data from illumination statistics file: %s', self.location
-        )
-        metadata = IllumstatsImageMetadata(channel_id=self.channel.id)
+        metadata = IllumstatsImageMetadata(channel_id=self.channel_id)
         with DatasetReader(self.location) as f:
-            mean = IllumstatsImage(f.read('mean'), metadata)
-            std = IllumstatsImage(f.read('std'), metadata)
+            if f.exists('revision'):
+                revision = int(f.read('revision'))
+            else:
+                revision = None
+            if self.location in _illumstats_cache:
+                cached_revision, stats = _illumstats_cache.pop(self.location)
+                if revision is not None and cached_revision == revision:
+                    logger.debug(
+                        'get cached data of illumination statistics file: %s',
+                        self.location
+                    )
+                    _illumstats_cache[self.location] = (revision, stats)
+                    return stats
+            logger.debug(
+                'get data from illumination statistics file: %s', self.location
+            )
             keys = f.read('percentiles/keys')
             values = f.read('percentiles/values')
             percentiles = dict(zip(keys, values))
-        return IllumstatsContainer(mean, std, percentiles).smooth()
+            if f.exists('downsampling_factor'):
+                factor = int(f.read('downsampling_factor'))
+            else:
+                factor = 1
+            is_stored = (
+                f.exists('/smoothed/version') and
+                f.read('/smoothed/version') == self.SMOOTHING_VERSION
+            )
+            if is_stored:
+                logger.debug('use stored smoothed statistics')
+                mean = IllumstatsImage(f.read('/smoothed/mean'), metadata)
+                std = IllumstatsImage(f.read('/smoothed/std'), metadata)
+                metadata.is_smoothed = True
+                stats = IllumstatsContainer(mean, std, percentiles, factor)
+            else:
+                logger.debug('derive smoothed statistics')
+                mean = IllumstatsImage(f.read('mean'), metadata)
+                std = IllumstatsImage(f.read('std'), metadata)
+                stats = IllumstatsContainer(
+                    mean, std, percentiles, factor
+                ).smooth(self.SMOOTHING_SIGMA)
+        stats.mean.array.flags.writeable = False
+        stats.std.array.flags.writeable = False
+        if revision is not None:
+            _illumstats_cache[self.location] = (revision, stats)
+            if len(_illumstats_cache) > _ILLUMSTATS_CACHE_SIZE:
+                _illumstats_cache.popitem(last=False)
+        return stats
+
+    def get_accumulator(self):
+        '''Gets the state of the accumulator from which the illumination
+        statistics were calculated.
+
+        Returns
+        -------
+        Tuple[Dict[str, Union[int, numpy.ndarray]], List[int]]
+            state of the accumulator and IDs of
+            :class:`ChannelImageFile <tmlib.models.file.ChannelImageFile>`
+            instances whose images were accumulated or ``None`` in case
+            the file doesn't hold the state of an accumulator
+
+        See also
+        --------
+        :attr:`tmlib.workflow.corilla.stats.OnlineStatistics.state`
+        '''
+        logger.debug(
+            'get accumulator from illumination statistics file: %s',
+            self.location
+        )
+        with DatasetReader(self.location) as f:
+            if not f.exists('/accumulator'):
+                return None
+            state = {
+                name: f.read('/accumulator/state/%s' % name)
+                for name in f.list_datasets('/accumulator/state')
+            }
+            file_ids = f.read('/accumulator/channel_image_file_ids').tolist()
+        return (state, file_ids)
 
     @assert_type(data='tmlib.image.IllumstatsContainer')
-    def put(self, data):
+    def put(self, data, accumulator=None, channel_image_file_ids=None):
         '''Put illumination statistics images to store.
 
         Parameters
         ----------
         data: IllumstatsContainer
-            illumination statistics
+            illumination statistics, which may have been calculated for
+            blocks of pixels
+        accumulator: Dict[str, Union[int, numpy.ndarray]], optional
+            state of the accumulator from which statistics were calculated,
+            which allows updating statistics with additional images later on
+        channel_image_file_ids: List[int], optional
+            IDs of :class:`ChannelImageFile <tmlib.models.file.ChannelImageFile>`
+            instances whose images were accumulated (required when
+            `accumulator` is provided)
         '''
+        if accumulator is not None and channel_image_file_ids is None:
+            raise ValueError(
+                'Argument "channel_image_file_ids" is required when '
+                'argument "accumulator" is provided.'
+            )
         logger.debug(
             'put data to illumination statistics file: %s', self.location
         )
+        metadata = IllumstatsImageMetadata(channel_id=self.channel_id)
+        smoothed_data = IllumstatsContainer(
+            IllumstatsImage(data.mean.array.copy(), metadata),
+            IllumstatsImage(data.std.array.copy(), metadata),
+            data.percentiles, data.downsampling_factor
+        ).smooth(self.SMOOTHING_SIGMA)
         with DatasetWriter(self.location, truncate=True) as f:
             f.write('mean', data.mean.array)
             f.write('std', data.std.array)
             f.write('/percentiles/keys', data.percentiles.keys())
             f.write('/percentiles/values', data.percentiles.values())
+            f.write('downsampling_factor', data.downsampling_factor)
+            f.write('/smoothed/mean', smoothed_data.mean.array)
+            f.write('/smoothed/std', smoothed_data.std.array)
+            f.write('/smoothed/version', self.SMOOTHING_VERSION)
+            # Identifies the written statistics for the cache of "get()",
+            # since the modification time may not change upon rewrites.
+            f.write('revision', random.getrandbits(62))
+            if accumulator is not None:
+                for name, value in accumulator.iteritems():
+                    f.write('/accumulator/state/%s' % name, value)
+                f.write(
+                    '/accumulator/channel_image_file_ids',
+                    np.array(channel_image_file_ids, dtype=np.int64)
+                )
 
     @hybrid_property
     def location(self):
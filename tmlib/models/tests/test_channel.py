@@ -0,0 +1,206 @@
+import itertools
+import collections
+
+import tmlib.models as tm
+from tmlib.models.channel import ChannelLayerLayout
+
+
+def _create_layer():
+    # Two plates with wells of different size, empty rows and columns,
+    # omitted sites and sites without image. Site sizes are no multiple
+    # of the tile size and neighbouring sites are displaced.
+    experiment = tm.Experiment(
+        1, 'cellvoyager', 384, 'basic', '/tmp', well_spacer_size=300,
+        vertical_site_displacement=7, horizontal_site_displacement=3
+    )
+    wells = {
+        1: [('A01', (2, 3)), ('A03', (3, 2)), ('C02', (2, 2))],
+        2: [('B02', (1, 2)), ('D05', (2, 3))]
+    }
+    channel = tm.Channel('dapi', '405', 16, 1)
+    channel.id = 1
+    channel.experiment = experiment
+    layer = tm.ChannelLayer(1, 0, 0)
+    layer.id = 1
+    layer.channel = channel
+    files = list()
+    site_id = 0
+    for plate_id in sorted(wells):
+        plate = tm.Plate('plate%d' % plate_id, 1)
+        plate.id = plate_id
+        plate.experiment = experiment
+        for name, (n_rows, n_cols) in wells[plate_id]:
+            well = tm.Well(name, plate_id)
+            well.id = len(files) + 10 * plate_id
+            well.plate = plate
+            for y, x in itertools.product(range(n_rows), range(n_cols)):
+                site_id += 1
+                site = tm.Site(
+                    y, x, 300, 400, well.id, omitted=(site_id % 7 == 0)
+                )
+                site.id = site_id
+                site.well = well
+                if site_id % 5 == 0:
+                    continue
+                f = tm.ChannelImageFile(0, 0, site.id, 1, 1, {})
+                f.id = 100 + site_id
+                f.site = site
+                files.append(f)
+    height, width = layer.calculate_max_image_size()
+    experiment.pyramid_height = height
+    experiment.pyramid_width = width
+    experiment.pyramid_depth = layer.calculate_zoom_levels(height, width)
+    positions = set([(f.site.well_id, f.site.y, f.site.x) for f in files])
+    layer._has_image = lambda well_id, y, x: (well_id, y, x) in positions
+    return (layer, files)
+
+
+def _create_layout(layer, files):
+    experiment = layer.channel.experiment
+    sites = [
+        (s.id, s.y, s.x, s.height, s.width, s.omitted,
+            s.well_id, s.well.name, s.well.plate_id)
+        for p in experiment.plates for w in p.wells for s in w.sites
+    ]
+    return ChannelLayerLayout(
+        sites, [(f.id, f.site_id) for f in files], experiment.plate_grid,
+        experiment.well_spacer_size, experiment.plate_spacer_size,
+        experiment.vertical_site_displacement,
+        experiment.horizontal_site_displacement
+    )
+
+
+def _map_sites_to_tiles(layer, sites):
+    experiment = layer.channel.experiment
+    mapping = collections.defaultdict(list)
+    for site, fid in sites:
+        rows = layer._calc_tile_indices(
+            site.offset[0], site.height,
+            experiment.vertical_site_displacement
+        )
+        cols = layer._calc_tile_indices(
+            site.offset[1], site.width,
+            experiment.horizontal_site_displacement
+        )
+        for y, x in itertools.product(rows, cols):
+            mapping[(y, x)].append(fid)
+    return dict((k, sorted(v)) for k, v in mapping.iteritems())
+
+
+def test_layout_image_size():
+    layer, files = _create_layer()
+    layout = _create_layout(layer, files)
+    assert layout.image_size == tuple(layer.calculate_max_image_size())
+    assert layout.dimensions == tuple(layer.dimensions[-1])
+
+
+def test_layout_offsets():
+    layer, files = _create_layer()
+    layout = _create_layout(layer, files)
+    for i, f in enumerate(files):
+        assert layout.file_ids[i] == f.id
+        assert tuple(layout.offsets[i]) == f.site.offset
+
+
+def test_layout_static_geometry():
+    layer, files = _create_layer()
+    layout = _create_layout(layer, files)
+    experiment = layer.channel.experiment
+    for i, plate in enumerate(sorted(experiment.plates, key=lambda p: p.id)):
+        assert layout.plate_ids[i] == plate.id
+        assert tuple(layout.plate_offsets[i]) == plate.offset
+        assert tuple(layout.plate_sizes[i]) == plate.image_size
+    wells = [w for p in experiment.plates for w in p.wells]
+    for i, well in enumerate(sorted(wells, key=lambda w: w.id)):
+        assert layout.well_ids[i] == well.id
+        assert tuple(layout.well_offsets[i]) == well.offset
+        assert tuple(layout.well_sizes[i]) == well.image_size
+    sites = [s for w in wells for s in w.sites]
+    for i, site in enumerate(sorted(sites, key=lambda s: s.id)):
+        assert layout.site_ids[i] == site.id
+        assert tuple(layout.site_offsets[i]) == site.offset
+        assert tuple(layout.site_sizes[i]) == site.image_size
+
+
+def test_layout_map_image_to_base_tiles():
+    layer, files = _create_layer()
+    layout = _create_layout(layer, files)
+    for f in files:
+        assert (
+            layout.map_image_to_base_tiles(f.id) ==
+            layer.map_image_to_base_tiles(f)
+        )
+
+
+def test_layout_map_base_tile_to_images():
+    layer, files = _create_layer()
+    layout = _create_layout(layer, files)
+    for f in files:
+        neighbours = [
+            (n.site, n.id) for n in files
+            if n.site.well_id == f.site.well_id and
+            n.site.y in (f.site.y - 1, f.site.y) and
+            n.site.x in (f.site.x - 1, f.site.x) and
+            n.site is not f.site and not n.site.omitted
+        ]
+        mapping = layout.map_base_tile_to_images(f.id)
+        assert (
+            dict((k, sorted(v)) for k, v in mapping.iteritems()) ==
+            _map_sites_to_tiles(layer, neighbours)
+        )
+
+
+def test_layout_base_tile_coordinate_to_image_file_map():
+    layer, files = _create_layer()
+    layout = _create_layout(layer, files)
+    sites = [(f.site, f.id) for f in files if not f.site.omitted]
+    assert (
+        dict(layout.base_tile_coordinate_to_image_file_map) ==
+        _map_sites_to_tiles(layer, sites)
+    )
+
+
+def test_layout_find_images_of_base_tiles():
+    layer, files = _create_layer()
+    layout = _create_layout(layer, files)
+    owners = collections.defaultdict(set)
+    for f in files:
+        for t in layout.map_image_to_base_tiles(f.id):
+            owners[(t['y'], t['x'])].add(f.id)
+    for coordinate, fids in owners.iteritems():
+        assert layout.find_images_of_base_tiles([coordinate]) == sorted(fids)
+    coordinates = sorted(owners)[::3]
+    expected = sorted(set.union(*[owners[c] for c in coordinates]))
+    assert layout.find_images_of_base_tiles(coordinates) == expected
+    assert layout.find_images_of_base_tiles([]) == []
+
+
+def test_layout_occupancy():
+    layer, files = _create_layer()
+    layout = _create_layout(layer, files)
+    occupancy = layout.occupancy
+    assert occupancy.shape == layout.dimensions
+    rows, cols = occupancy.nonzero()
+    assert (
+        set(zip(rows.tolist(), cols.tolist())) ==
+        set(layout.base_tile_coordinate_to_image_file_map.keys())
+    )
+
+
+def test_layout_get_empty_base_tile_spans():
+    layer, files = _create_layer()
+    layout = _create_layout(layer, files)
+    spans = layout.get_empty_base_tile_spans()
+    coordinates = list()
+    for y_start, y_end, x_start, x_end in spans.tolist():
+        coordinates.extend(itertools.product(
+            range(y_start, y_end), range(x_start, x_end)
+        ))
+    assert len(coordinates) == len(set(coordinates))
+    rows, cols = layout.dimensions
+    expected = (
+        set(itertools.product(range(rows), range(cols))) -
+        set(layout.base_tile_coordinate_to_image_file_map.keys())
+    )
+    assert set(coordinates) == expected
+    assert len(spans) < len(expected)
@@ -0,0 +1,25 @@
+import os
+import numpy as np
+
+import tmlib.models as tm
+from tmlib.image import IllumstatsImage
+from tmlib.image import IllumstatsContainer
+
+
+def _create_stats(value):
+    mean = IllumstatsImage(np.full((16, 24), value, dtype=float))
+    std = IllumstatsImage(np.ones((16, 24), dtype=float))
+    return IllumstatsContainer(mean, std, {50.0: 100})
+
+
+def test_illumstats_file_rewrite_within_same_second(tmpdir, monkeypatch):
+    # Modification times have a resolution of one second on some
+    # filesystems, such that a rewrite may not change them.
+    monkeypatch.setattr(os.path, 'getmtime', lambda path: 1400000000.0)
+    stats_file = tm.IllumstatsFile(channel_id=1)
+    stats_file._location = str(tmpdir.join('illumstats.h5'))
+    stats_file.put(_create_stats(1.0))
+    np.testing.assert_allclose(stats_file.get().mean.array, 1.0)
+    stats_file.put(_create_stats(2.0))
+    np.testing.assert_allclose(stats_file.get().mean.array, 2.0)
+    assert stats_file.get() is stats_file.get()
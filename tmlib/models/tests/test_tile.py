@@ -0,0 +1,159 @@
+import os
+import pytest
+import numpy as np
+from struct import unpack
+
+from tmlib.image import PyramidTile
+from tmlib.models.tile import ChannelLayerTile
+from tmlib.models.tile import FilesystemTileStore
+from tmlib.models.tile import HDF5TileStore
+from tmlib.models.tile import TileCache
+from tmlib.models.tile import TileReader
+
+
+def _create_tile(z, y, x):
+    random_state = np.random.RandomState(y * 10 + x)
+    array = random_state.randint(1, 256, (256, 256)).astype(np.uint8)
+    return ChannelLayerTile(z, y, x, 1, PyramidTile(array))
+
+
+def test_hdf5_tile_store_releases_files_upon_exception(tmpdir):
+    location = str(tmpdir)
+    with HDF5TileStore(1, location) as store:
+        store.add(_create_tile(0, 0, 0))
+    with pytest.raises(RuntimeError):
+        with HDF5TileStore(1, location, writer_id=1) as store:
+            store.add(_create_tile(0, 0, 1))
+            store.flush()
+            store.add(_create_tile(0, 1, 0))
+            assert (0, 0) in store.get_encoded(0, [(0, 0)])
+            assert store._files
+            raise RuntimeError()
+    assert not store._files
+    store = HDF5TileStore(1, location, writer_id=2)
+    tiles = store.get_encoded(0, [(0, 0), (0, 1), (1, 0)])
+    assert sorted(tiles) == [(0, 0), (0, 1)]
+    store.close()
+
+
+def test_tile_reader_doesnt_cache_missing_tiles(tmpdir):
+    location = str(tmpdir)
+    cache = TileCache()
+    with HDF5TileStore(1, location) as store:
+        store.add(_create_tile(0, 0, 0))
+        store.add(ChannelLayerTile(0, 0, 1, 1))
+    reader = TileReader(HDF5TileStore(1, location, writer_id=1), cache)
+    tiles = reader.get_encoded(0, (0, 2), (0, 2))
+    background = tiles[(0, 1)]
+    assert tiles[(1, 0)] == background
+    assert sorted(cache._tiles) == [(1, 0, 0, 0), (1, 0, 0, 1)]
+    # Tiles that get added later are read from the store
+    with HDF5TileStore(1, location, writer_id=2) as store:
+        store.add(_create_tile(0, 1, 0))
+    reader = TileReader(HDF5TileStore(1, location, writer_id=3), cache)
+    tiles = reader.get_encoded(0, (0, 2), (0, 2))
+    assert tiles[(1, 0)] != background
+    assert tiles[(1, 1)] == background
+
+
+class _Cursor(object):
+
+    def __init__(self):
+        self.statements = list()
+        self.copied = None
+
+    def execute(self, statement, *args):
+        self.statements.append(statement)
+
+    def copy_expert(self, statement, f):
+        self.statements.append(statement)
+        self.copied = f.read()
+
+
+def _parse_copy_stream(data):
+    assert data[:11] == b'PGCOPY\n\377\r\n\0'
+    assert unpack('!ii', data[11:19]) == (0, 0)
+    rows = list()
+    i = 19
+    while unpack('!h', data[i:i+2])[0] != -1:
+        values = unpack('!hiiiiiiiii', data[i:i+38])
+        assert values[0] == 5
+        n = values[-1]
+        i += 38
+        if n == -1:
+            pixels = None
+        else:
+            pixels = data[i:i+n]
+            i += n
+        rows.append((values[2], values[4], values[6], values[8], pixels))
+    assert len(data) == i + 2
+    return rows
+
+
+def test_bulk_ingest_copies_tiles_in_binary_format():
+    first = _create_tile(0, 0, 0)
+    empty = ChannelLayerTile(0, 0, 1, 1)
+    last = _create_tile(0, 1, 1)
+    last.y = 0
+    last.x = 0
+    cursor = _Cursor()
+    ChannelLayerTile._bulk_ingest(cursor, [first, empty, last])
+    # The last of several instances of the same tile wins.
+    assert _parse_copy_stream(cursor.copied) == [
+        (1, 0, 0, 1, None), (1, 0, 0, 0, last.encoded_pixels)
+    ]
+    assert first.encoded_pixels != last.encoded_pixels
+    assert 'FORMAT binary' in cursor.statements[2]
+    assert 'ON CONFLICT' in cursor.statements[3]
+
+
+def test_filesystem_tile_store_round_trip(tmpdir):
+    location = str(tmpdir)
+    tile = _create_tile(1, 0, 70)
+    with FilesystemTileStore(1, location) as store:
+        store.add(tile)
+        store.add(ChannelLayerTile(1, 0, 0, 1))
+        store.add(ChannelLayerTile(1, 1, 0, 1))
+    store = FilesystemTileStore(1, location)
+    tiles = store.get_encoded(1, [(0, 70), (0, 0), (1, 0), (1, 1)])
+    assert tiles == {(0, 70): tile.encoded_pixels, (0, 0): None, (1, 0): None}
+    # Empty tiles refer to a single background tile.
+    for y, x in [(0, 0), (1, 0)]:
+        filename = store._build_filename(1, y, x)
+        assert os.path.islink(filename)
+        assert os.path.samefile(filename, store._background_filename)
+    assert not os.path.islink(store._build_filename(1, 0, 70))
+
+
+def test_channel_layer_tile_with_zero_pixels():
+    array = np.zeros((256, 256), dtype=np.uint8)
+    tile = ChannelLayerTile(0, 0, 0, 1, PyramidTile(array))
+    assert tile.is_empty
+    assert tile.encoded_pixels is None
+    assert tile.pixels.dimensions == (256, 256)
+    assert not tile.pixels.array.any()
+    # Tiles at the border of a layer may be smaller and are never empty.
+    array = np.zeros((256, 100), dtype=np.uint8)
+    tile = ChannelLayerTile(0, 0, 1, 1, PyramidTile(array))
+    assert not tile.is_empty
+    assert tile.encoded_pixels is not None
+    assert tile.pixels.dimensions == (256, 100)
+    assert not tile.pixels.array.any()
+
+
+def test_tile_cache_evicts_least_recently_used_tile():
+    cache = TileCache(max_size=2)
+    cache.put((1, 0, 0, 0), b'a')
+    cache.put((1, 0, 0, 1), b'b')
+    assert cache.get((1, 0, 0, 0)) == b'a'
+    cache.put((1, 0, 1, 0), b'c')
+    assert len(cache) == 2
+    assert cache.get((1, 0, 0, 1)) is None
+    assert cache.get((1, 0, 1, 0)) == b'c'
+    assert cache.n_hits == 2
+    assert cache.n_misses == 1
+    assert cache.hit_rate == 2 / 3.0
+    cache = TileCache(max_size=0)
+    cache.put((1, 0, 0, 0), b'a')
+    assert len(cache) == 0
+    assert cache.hit_rate == 0.0
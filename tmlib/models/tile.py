@@ -14,10 +14,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
+import glob
+import errno
 import logging
+import itertools
 import collections
+from abc import ABCMeta
+from abc import abstractmethod
 from io import BytesIO
 from struct import pack
+import h5py
 import psycopg2
 import numpy as np
 import pandas as pd
@@ -25,17 +31,43 @@ from sqlalchemy import (
     Column, String, Integer, BigInteger, Boolean, ForeignKey, Index,
     PrimaryKeyConstraint
 )
+from sqlalchemy import tuple_
 from sqlalchemy.dialects.postgresql import BYTEA
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.ext.hybrid import hybrid_property
 
+from tmlib import cfg
 from tmlib.image import PyramidTile
 from tmlib.metadata import PyramidTileMetadata
 from tmlib.models.base import DistributedExperimentModel
+from tmlib.models.utils import delete_location
+from tmlib.writers import DatasetWriter
 
 logger = logging.getLogger(__name__)
 
 
+def is_background_tile(tile):
+    '''Determines whether a tile only contains background pixels.
+
+    Parameters
+    ----------
+    tile: tmlib.image.PyramidTile
+        tile
+
+    Returns
+    -------
+    bool
+
+    Note
+    ----
+    Only tiles with the full size are considered, because all empty tiles
+    refer to the same background tile. Tiles at the border of a layer
+    may be smaller.
+    '''
+    size = PyramidTile.TILE_SIZE
+    return tile.dimensions == (size, size) and not tile.array.any()
+
+
 class ChannelLayerTile(DistributedExperimentModel):
 
     '''A *channel layer tile* is a component of an image pyramid. Each tile
@@ -87,6 +119,12 @@ class ChannelLayerTile(DistributedExperimentModel):
             ID of the parent channel pyramid
         pixels: tmlib.image.PyramidTile, optional
             pixels array (default: ``None``)
+
+        Note
+        ----
+        Tiles that only contain background pixels or for which no `pixels`
+        are provided are *empty*. Their pixels are not encoded and stored,
+        but all empty tiles refer to the same background tile.
         '''
         self.y = y
         self.x = x
@@ -102,6 +140,8 @@ class ChannelLayerTile(DistributedExperimentModel):
             z=self.z, y=self.y, x=self.x,
             channel_layer_id=self.channel_layer_id
         )
+        if self._pixels is None:
+            return PyramidTile.create_as_background(metadata=metadata)
         return PyramidTile.create_from_binary(self._pixels, metadata)
 
     @pixels.setter
@@ -116,33 +156,91 @@ class ChannelLayerTile(DistributedExperimentModel):
         # In case we switch to raster tiles, we should also think of a way to
         # colocate tiles and mapobjects on the same shards to improve
         # performance of combined spatial queries.
-        if value is not None:
+        if value is not None and not is_background_tile(value):
             self._pixels = value.jpeg_encode()
         else:
             self._pixels = None
 
+    @property
+    def is_empty(self):
+        '''bool: whether the tile only contains background pixels'''
+        return self._pixels is None
+
+    @property
+    def encoded_pixels(self):
+        '''str: *JPEG* encoded pixels or ``None`` in case the tile is empty'''
+        if self._pixels is None:
+            return None
+        return _to_bytes(self._pixels)
+
     @classmethod
     def _add(cls, connection, instance):
-        # This is expensive because the pixels data array gets included twice
-        # in the query
         connection.execute('''
             INSERT INTO channel_layer_tiles AS t (
                 channel_layer_id, z, y, x, pixels
             )
             VALUES (%(channel_layer_id)s, %(z)s, %(y)s, %(x)s, %(pixels)s)
             ON CONFLICT ON CONSTRAINT channel_layer_tiles_pkey
-            DO UPDATE SET pixels = %(pixels)s
+            DO UPDATE SET pixels = EXCLUDED.pixels
         ''', {
             'channel_layer_id': instance.channel_layer_id,
             'z': instance.z, 'y': instance.y, 'x': instance.x,
-            'pixels': psycopg2.Binary(instance._pixels.tostring())
+            'pixels': (
+                psycopg2.Binary(instance._pixels.tostring())
+                if instance._pixels is not None else None
+            )
         })
 
     @classmethod
     def _bulk_ingest(cls, connection, instances):
-        # TODO: figure out how to COPY the binary pixel data
+        if not instances:
+            return
+        # Only the last instance is kept for tiles that are contained more
+        # than once, because a single statement cannot update a row twice.
+        tiles = collections.OrderedDict()
         for obj in instances:
-            cls._add(connection, obj)
+            if not isinstance(obj, cls):
+                raise TypeError('Object must have type %s' % cls.__name__)
+            key = (obj.channel_layer_id, obj.z, obj.y, obj.x)
+            tiles.pop(key, None)
+            tiles[key] = obj.encoded_pixels
+        # Tiles are copied in binary format into a temporary staging table,
+        # from which they get merged into the distributed table with a single
+        # statement. This sends pixels data only once and without escaping.
+        connection.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS channel_layer_tiles_staging (
+                channel_layer_id integer, z integer, y integer, x integer,
+                pixels bytea
+            )
+        ''')
+        connection.execute('TRUNCATE channel_layer_tiles_staging')
+        f = BytesIO()
+        f.write(pack('!11sii', b'PGCOPY\n\377\r\n\0', 0, 0))
+        for (channel_layer_id, z, y, x), pixels in tiles.iteritems():
+            # Pixels of empty tiles are NULL, which has length -1.
+            f.write(pack(
+                '!hiiiiiiiii', 5, 4, channel_layer_id, 4, z, 4, y, 4, x,
+                len(pixels) if pixels is not None else -1
+            ))
+            if pixels is not None:
+                f.write(pixels)
+        f.write(pack('!h', -1))
+        f.seek(0)
+        connection.copy_expert(
+            'COPY channel_layer_tiles_staging FROM STDIN WITH (FORMAT binary)',
+            f
+        )
+        f.close()
+        connection.execute('''
+            INSERT INTO channel_layer_tiles AS t (
+                channel_layer_id, z, y, x, pixels
+            )
+            SELECT channel_layer_id, z, y, x, pixels
+            FROM channel_layer_tiles_staging
+            ON CONFLICT ON CONSTRAINT channel_layer_tiles_pkey
+            DO UPDATE SET pixels = EXCLUDED.pixels
+        ''')
+        connection.execute('TRUNCATE channel_layer_tiles_staging')
 
     def __repr__(self):
         return '<%s(z=%r, y=%r, x=%r, channel_layer_id=%r)>' % (
@@ -151,3 +249,770 @@ class ChannelLayerTile(DistributedExperimentModel):
         )
 
 
+class TileStore(object):
+
+    '''Abstract base class for a storage backend of the tiles of a
+    :class:`ChannelLayer <tmlib.models.channel.ChannelLayer>`.
+
+    Tiles are added as instances of :class:`ChannelLayerTile` with encoded
+    pixels and are buffered until they get written in bulk. A store can be
+    used as a context manager, which flushes the buffer upon exit and
+    releases resources held by the store. Buffered tiles are discarded in
+    case the context is left because of an exception.
+
+    See also
+    --------
+    :func:`tmlib.models.tile.create_tile_store`
+    '''
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, channel_layer_id, buffer_size=256):
+        '''
+        Parameters
+        ----------
+        channel_layer_id: int
+            ID of the parent channel layer
+        buffer_size: int, optional
+            number of tiles that should be written at once (default: ``256``)
+        '''
+        self.channel_layer_id = channel_layer_id
+        self.buffer_size = buffer_size
+        self._tiles = list()
+        self.n_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, except_type, except_value, except_trace):
+        if except_type is None:
+            self.close()
+        else:
+            if self._tiles:
+                logger.warning(
+                    'discard %d buffered tiles because of an exception',
+                    len(self._tiles)
+                )
+                self._tiles = list()
+            self._release()
+
+    def add(self, tile):
+        '''Adds a tile, which gets written once the buffer is full.
+
+        Parameters
+        ----------
+        tile: tmlib.models.tile.ChannelLayerTile
+            tile with encoded pixels
+        '''
+        self._tiles.append(tile)
+        if len(self._tiles) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        '''Writes all buffered tiles.'''
+        if not self._tiles:
+            return
+        logger.debug('write %d tiles', len(self._tiles))
+        self._write(self._tiles)
+        self.n_written += len(self._tiles)
+        self._tiles = list()
+
+    def close(self):
+        '''Writes all buffered tiles and releases resources held by the store.
+        '''
+        try:
+            self.flush()
+        finally:
+            self._release()
+
+    def _release(self):
+        # Releases resources, such as open files, held by the store.
+        pass
+
+    @abstractmethod
+    def _write(self, tiles):
+        pass
+
+    @abstractmethod
+    def get_encoded(self, z, coordinates):
+        '''Gets the encoded pixels of several tiles of the same zoom level.
+
+        Parameters
+        ----------
+        z: int
+            zero-based zoom level index
+        coordinates: List[Tuple[int]]
+            zero-based row and column indices of tiles
+
+        Returns
+        -------
+        Dict[Tuple[int], str]
+            *JPEG* encoded pixels for each existing tile; ``None`` for empty
+            tiles
+
+        See also
+        --------
+        :attr:`tmlib.models.tile.ChannelLayerTile.is_empty`
+        '''
+        pass
+
+    def get(self, z, y, x):
+        '''Gets a single tile.
+
+        Parameters
+        ----------
+        z: int
+            zero-based zoom level index
+        y: int
+            zero-based row index of the tile
+        x: int
+            zero-based column index of the tile
+
+        Returns
+        -------
+        tmlib.image.PyramidTile
+            tile or ``None`` in case the tile doesn't exist
+        '''
+        tiles = self.get_encoded(z, [(y, x)])
+        if (y, x) not in tiles:
+            return None
+        metadata = PyramidTileMetadata(
+            z=z, y=y, x=x, channel_layer_id=self.channel_layer_id
+        )
+        if tiles[(y, x)] is None:
+            return PyramidTile.create_as_background(metadata=metadata)
+        return PyramidTile.create_from_binary(tiles[(y, x)], metadata)
+
+    @abstractmethod
+    def delete(self):
+        '''Deletes all tiles of the channel layer.'''
+        pass
+
+
+class DatabaseTileStore(TileStore):
+
+    '''Stores tiles as rows of the distributed ``channel_layer_tiles`` table.
+    '''
+
+    def __init__(self, session, channel_layer_id, buffer_size=256):
+        '''
+        Parameters
+        ----------
+        session: tmlib.models.utils.ExperimentSession
+            database session
+        channel_layer_id: int
+            ID of the parent channel layer
+        buffer_size: int, optional
+            number of tiles that should be ingested at once (default: ``256``)
+        '''
+        super(DatabaseTileStore, self).__init__(channel_layer_id, buffer_size)
+        self._session = session
+
+    def _write(self, tiles):
+        self._session.bulk_ingest(tiles)
+
+    def get_encoded(self, z, coordinates):
+        # Only the encoded pixels are loaded, which avoids constructing a
+        # model instance for each tile. Tiles are distributed by row, so the
+        # rows are given explicitly to restrict the query to the shards
+        # holding the requested tiles.
+        if not coordinates:
+            return dict()
+        rows = sorted(set([c[0] for c in coordinates]))
+        tiles = self._session.query(
+                ChannelLayerTile.y, ChannelLayerTile.x,
+                ChannelLayerTile._pixels.label('pixels')
+            ).\
+            filter(
+                ChannelLayerTile.channel_layer_id == self.channel_layer_id,
+                ChannelLayerTile.z == z,
+                ChannelLayerTile.y.in_(rows),
+                tuple_(ChannelLayerTile.y, ChannelLayerTile.x).in_(
+                    coordinates
+                )
+            ).\
+            all()
+        return {(t.y, t.x): t.pixels for t in tiles}
+
+    def delete(self):
+        self._session.query(ChannelLayerTile).\
+            filter_by(channel_layer_id=self.channel_layer_id).\
+            delete()
+
+
+class FilesystemTileStore(TileStore):
+
+    '''Stores each tile as a separate *JPEG* file. Files are sharded into
+    subdirectories per zoom level and square blocks of tiles to keep the
+    number of files per directory small. Empty tiles are symbolic links to
+    a single background tile file.
+    '''
+
+    #: int: number of tiles along each axis of a block that shares a directory
+    SHARD_SIZE = 64
+
+    def __init__(self, channel_layer_id, location, buffer_size=256):
+        '''
+        Parameters
+        ----------
+        channel_layer_id: int
+            ID of the parent channel layer
+        location: str
+            absolute path to the root directory of the store
+        buffer_size: int, optional
+            number of tiles that should be written at once (default: ``256``)
+        '''
+        super(FilesystemTileStore, self).__init__(channel_layer_id, buffer_size)
+        self.location = location
+        self._directories = set()
+        self._background_filename = os.path.join(location, 'background.jpg')
+
+    def _build_filename(self, z, y, x):
+        return os.path.join(
+            self.location, str(z),
+            '%d_%d' % (y / self.SHARD_SIZE, x / self.SHARD_SIZE),
+            '%d_%d.jpg' % (y, x)
+        )
+
+    def _write(self, tiles):
+        for t in tiles:
+            filename = self._build_filename(t.z, t.y, t.x)
+            directory = os.path.dirname(filename)
+            if directory not in self._directories:
+                try:
+                    os.makedirs(directory)
+                except OSError as err:
+                    if err.errno != errno.EEXIST:
+                        raise
+                self._directories.add(directory)
+            # Files are renamed once complete, such that concurrent readers
+            # never see partially written tiles.
+            tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+            if t.is_empty:
+                if not os.path.exists(self._background_filename):
+                    self._write_background()
+                os.symlink(
+                    os.path.relpath(self._background_filename, directory),
+                    tmp_filename
+                )
+            else:
+                with open(tmp_filename, 'wb') as f:
+                    f.write(t.encoded_pixels)
+            os.rename(tmp_filename, filename)
+
+    def _write_background(self):
+        tmp_filename = '%s.%d.tmp' % (self._background_filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            f.write(_get_encoded_background_tile())
+        os.rename(tmp_filename, self._background_filename)
+
+    def get_encoded(self, z, coordinates):
+        tiles = dict()
+        for y, x in coordinates:
+            filename = self._build_filename(z, y, x)
+            if os.path.islink(filename):
+                tiles[(y, x)] = None
+                continue
+            try:
+                with open(filename, 'rb') as f:
+                    tiles[(y, x)] = f.read()
+            except IOError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+        return tiles
+
+    def delete(self):
+        delete_location(self.location)
+
+
+class HDF5TileStore(TileStore):
+
+    '''Stores tiles in packed *HDF5* files. There is one file per zoom level
+    and writer, which holds the concatenated encoded pixels of all tiles
+    written by the writer in the one-dimensional dataset ``/data`` and the
+    index of each tile in the datasets ``/index/y``, ``/index/x``,
+    ``/index/offset`` and ``/index/length``. Empty tiles have zero length.
+
+    Note
+    ----
+    Each writer (e.g. a job) must use a separate `writer_id`, because
+    *HDF5* files cannot be written concurrently. A file gets truncated the
+    first time tiles of its zoom level are written by a store instance.
+    '''
+
+    #: int: number of bytes per chunk of the pixels dataset
+    _CHUNK_SIZE = 2**16
+
+    #: int: maximal number of bytes between tiles that are read at once
+    _MAX_READ_GAP = 2**16
+
+    def __init__(self, channel_layer_id, location, writer_id=0,
+            buffer_size=256):
+        '''
+        Parameters
+        ----------
+        channel_layer_id: int
+            ID of the parent channel layer
+        location: str
+            absolute path to the root directory of the store
+        writer_id: int, optional
+            ID of the writer (default: ``0``)
+        buffer_size: int, optional
+            number of tiles that should be written at once (default: ``256``)
+        '''
+        super(HDF5TileStore, self).__init__(channel_layer_id, buffer_size)
+        self.location = location
+        self.writer_id = writer_id
+        self._n_bytes = dict()
+        self._indices = dict()
+        self._files = dict()
+
+    def _build_filename(self, z, writer_id):
+        return os.path.join(
+            self.location, str(z), 'pack_%.7d.h5' % writer_id
+        )
+
+    def _write(self, tiles):
+        levels = collections.defaultdict(list)
+        for t in tiles:
+            levels[t.z].append(t)
+        for z, level_tiles in levels.iteritems():
+            filename = self._build_filename(z, self.writer_id)
+            truncate = z not in self._n_bytes
+            if truncate:
+                directory = os.path.dirname(filename)
+                try:
+                    os.makedirs(directory)
+                except OSError as err:
+                    if err.errno != errno.EEXIST:
+                        raise
+                self._n_bytes[z] = 0
+            buffers = [
+                t.encoded_pixels if not t.is_empty else b''
+                for t in level_tiles
+            ]
+            lengths = np.array([len(b) for b in buffers], dtype=np.int64)
+            offsets = np.cumsum(lengths) - lengths + self._n_bytes[z]
+            self._close_file(filename)
+            with DatasetWriter(filename, truncate=truncate) as f:
+                if truncate:
+                    f.create(
+                        '/data', dims=(0, ), dtype=np.uint8, max_dims=(None, ),
+                        chunks=(self._CHUNK_SIZE, )
+                    )
+                f.append('/data', np.frombuffer(b''.join(buffers), np.uint8))
+                f.append(
+                    '/index/y',
+                    np.array([t.y for t in level_tiles], dtype=np.int32)
+                )
+                f.append(
+                    '/index/x',
+                    np.array([t.x for t in level_tiles], dtype=np.int32)
+                )
+                f.append('/index/offset', offsets)
+                f.append('/index/length', lengths)
+            self._n_bytes[z] += lengths.sum()
+            self._indices.pop(z, None)
+
+    def _get_index(self, z):
+        # The index of all files of a zoom level is loaded once and cached.
+        # Files are opened in read-only mode, which allows concurrent reads.
+        if z not in self._indices:
+            index = dict()
+            filenames = sorted(glob.glob(
+                os.path.join(self.location, str(z), 'pack_*.h5')
+            ))
+            for filename in filenames:
+                with h5py.File(filename, 'r') as f:
+                    if 'index' not in f:
+                        continue
+                    entries = itertools.izip(
+                        f['index/y'][:].tolist(), f['index/x'][:].tolist(),
+                        f['index/offset'][:].tolist(),
+                        f['index/length'][:].tolist()
+                    )
+                    for y, x, offset, length in entries:
+                        index[(y, x)] = (filename, offset, length)
+            self._indices[z] = index
+        return self._indices[z]
+
+    def get_encoded(self, z, coordinates):
+        index = self._get_index(z)
+        files = collections.defaultdict(list)
+        tiles = dict()
+        for c in coordinates:
+            entry = index.get(tuple(c))
+            if entry is None:
+                continue
+            elif entry[2] == 0:
+                tiles[tuple(c)] = None
+            else:
+                files[entry[0]].append((tuple(c), entry[1], entry[2]))
+        for filename, entries in files.iteritems():
+            # Files are kept open for subsequent reads.
+            if filename not in self._files:
+                self._files[filename] = h5py.File(filename, 'r')
+            data = self._files[filename]['data']
+            # Tiles that lie close to each other in the file are read at once,
+            # because the overhead of reading a slice exceeds the cost of
+            # reading a few superfluous bytes.
+            entries.sort(key=lambda e: e[1])
+            start = 0
+            while start < len(entries):
+                end = start + 1
+                stop = entries[start][1] + entries[start][2]
+                while (end < len(entries) and
+                        entries[end][1] - stop < self._MAX_READ_GAP):
+                    stop = max(stop, entries[end][1] + entries[end][2])
+                    end += 1
+                first = entries[start][1]
+                buf = data[first:stop]
+                for c, offset, length in entries[start:end]:
+                    tiles[c] = buf[offset-first:offset-first+length]
+                start = end
+        return tiles
+
+    def _close_file(self, filename):
+        f = self._files.pop(filename, None)
+        if f is not None:
+            f.close()
+
+    def _release(self):
+        for filename in self._files.keys():
+            self._close_file(filename)
+
+    def delete(self):
+        for filename in self._files.keys():
+            self._close_file(filename)
+        delete_location(self.location)
+        self._n_bytes = dict()
+        self._indices = dict()
+
+
+def create_tile_store(session, channel_layer, writer_id=0, buffer_size=256):
+    '''Creates a store for the tiles of a channel layer using the backend
+    configured via :attr:`tmlib.config.LibraryConfig.tile_store`.
+
+    Parameters
+    ----------
+    session: tmlib.models.utils.ExperimentSession
+        database session
+    channel_layer: tmlib.models.channel.ChannelLayer
+        channel layer whose tiles should be stored
+    writer_id: int, optional
+        ID of the writer; must be unique among concurrent writers of the same
+        channel layer (default: ``0``)
+    buffer_size: int, optional
+        number of tiles that should be written at once (default: ``256``)
+
+    Returns
+    -------
+    tmlib.models.tile.TileStore
+    '''
+    if cfg.tile_store == 'database':
+        return DatabaseTileStore(session, channel_layer.id, buffer_size)
+    elif cfg.tile_store == 'filesystem':
+        return FilesystemTileStore(
+            channel_layer.id, channel_layer.tiles_location, buffer_size
+        )
+    elif cfg.tile_store == 'hdf5':
+        return HDF5TileStore(
+            channel_layer.id, channel_layer.tiles_location, writer_id,
+            buffer_size
+        )
+    else:
+        raise ValueError('Unknown tile store: %s' % cfg.tile_store)
+
+
+class TileCache(object):
+
+    '''Least recently used cache of encoded tiles, which is kept in memory
+    of the current process.
+
+    Tiles are hashable by channel layer ID, zoom level, row and column.
+    Tiles written by other processes are not invalidated. Since tiles get
+    deleted together with their channel layer, this only matters when tiles
+    of an existing layer are overwritten.
+    '''
+
+    def __init__(self, max_size=4096):
+        '''
+        Parameters
+        ----------
+        max_size: int, optional
+            maximal number of tiles that are kept (default: ``4096``)
+        '''
+        self.max_size = max_size
+        self._tiles = collections.OrderedDict()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def __len__(self):
+        return len(self._tiles)
+
+    @property
+    def hit_rate(self):
+        '''float: fraction of lookups that were served from the cache'''
+        n_lookups = self.n_hits + self.n_misses
+        if n_lookups == 0:
+            return 0.0
+        return self.n_hits / float(n_lookups)
+
+    def get(self, key):
+        '''Gets a tile from the cache.
+
+        Parameters
+        ----------
+        key: Tuple[int]
+            channel layer ID, zoom level, row and column of the tile
+
+        Returns
+        -------
+        str
+            *JPEG* encoded pixels or ``None`` in case the tile isn't cached
+        '''
+        value = self._tiles.pop(key, None)
+        if value is None:
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        self._tiles[key] = value
+        return value
+
+    def put(self, key, value):
+        '''Adds a tile to the cache. The least recently used tile is
+        removed in case the cache is full.
+
+        Parameters
+        ----------
+        key: Tuple[int]
+            channel layer ID, zoom level, row and column of the tile
+        value: str
+            *JPEG* encoded pixels
+        '''
+        if self.max_size == 0:
+            return
+        self._tiles.pop(key, None)
+        self._tiles[key] = value
+        while len(self._tiles) > self.max_size:
+            self._tiles.popitem(last=False)
+
+    def clear(self, channel_layer_id=None):
+        '''Removes tiles from the cache.
+
+        Parameters
+        ----------
+        channel_layer_id: int, optional
+            ID of the channel layer whose tiles should be removed; all tiles
+            are removed if not provided
+        '''
+        if channel_layer_id is None:
+            self._tiles.clear()
+            return
+        for key in self._tiles.keys():
+            if key[0] == channel_layer_id:
+                del self._tiles[key]
+
+    def __repr__(self):
+        return '<%s(size=%d, max_size=%d, hits=%d, misses=%d)>' % (
+            self.__class__.__name__, len(self._tiles), self.max_size,
+            self.n_hits, self.n_misses
+        )
+
+
+_tile_cache = None
+
+_tile_renderers = dict()
+
+_encoded_background_tile = None
+
+
+def get_tile_cache():
+    '''Gets the tile cache of the current process, which is created upon
+    first use with the size configured via
+    :attr:`tmlib.config.LibraryConfig.tile_cache_size`.
+
+    Returns
+    -------
+    tmlib.models.tile.TileCache
+    '''
+    global _tile_cache
+    if _tile_cache is None:
+        _tile_cache = TileCache(cfg.tile_cache_size)
+    return _tile_cache
+
+
+def _get_encoded_background_tile():
+    # All empty tiles share the same encoded background tile.
+    global _encoded_background_tile
+    if _encoded_background_tile is None:
+        _encoded_background_tile = \
+            PyramidTile.create_as_background().jpeg_encode().tostring()
+    return _encoded_background_tile
+
+
+def _to_bytes(value):
+    # Stores return encoded pixels as string, buffer or array.
+    if isinstance(value, np.ndarray):
+        return value.tostring()
+    elif isinstance(value, memoryview):
+        return value.tobytes()
+    return str(value)
+
+
+class TileReader(object):
+
+    '''Reads the tiles of a rectangular region of a channel layer, e.g.
+    the current view of a viewer.
+
+    All tiles of a region, which are not cached, are read from the store
+    with a single request. Tiles that are missing in the store are rendered
+    in case a renderer is provided. Empty and missing tiles are replaced
+    with the background tile, but only tiles provided by the store or the
+    renderer get cached.
+
+    See also
+    --------
+    :func:`tmlib.models.tile.create_tile_reader`
+    '''
+
+    def __init__(self, store, cache=None, renderer=None):
+        '''
+        Parameters
+        ----------
+        store: tmlib.models.tile.TileStore
+            store of the tiles of a channel layer
+        cache: tmlib.models.tile.TileCache, optional
+            cache for encoded tiles (default: cache of the current process)
+        renderer: tmlib.workflow.illuminati.api.LazyTileRenderer, optional
+            renderer for tiles that are missing in the store, e.g. tiles of
+            the maximal zoom level of lazily built layers (default: ``None``)
+        '''
+        self.store = store
+        self.cache = cache if cache is not None else get_tile_cache()
+        self.renderer = renderer
+
+    def get_encoded(self, z, y_range, x_range):
+        '''Gets the encoded pixels of all tiles of a region.
+
+        Parameters
+        ----------
+        z: int
+            zero-based zoom level index
+        y_range: Tuple[int]
+            zero-based index of the first and one past the last row
+        x_range: Tuple[int]
+            zero-based index of the first and one past the last column
+
+        Returns
+        -------
+        collections.OrderedDict[Tuple[int], str]
+            *JPEG* encoded pixels for each tile of the region hashable by
+            row and column; tiles are sorted row-wise
+        '''
+        channel_layer_id = self.store.channel_layer_id
+        tiles = collections.OrderedDict()
+        missing = list()
+        for y, x in itertools.product(xrange(*y_range), xrange(*x_range)):
+            value = self.cache.get((channel_layer_id, z, y, x))
+            if value is None:
+                missing.append((y, x))
+            tiles[(y, x)] = value
+        if missing:
+            logger.debug('read %d of %d tiles', len(missing), len(tiles))
+            background = _get_encoded_background_tile()
+            encoded = self.store.get_encoded(z, missing)
+            if self.renderer is not None:
+                unknown = [c for c in missing if c not in encoded]
+                if unknown:
+                    encoded.update(self.renderer.render(z, unknown))
+            for c in missing:
+                if c not in encoded:
+                    # Tiles may be missing because the pyramid is still
+                    # being built, so they must not be cached.
+                    tiles[c] = background
+                    continue
+                value = encoded[c]
+                if value is None:
+                    value = background
+                else:
+                    value = _to_bytes(value)
+                self.cache.put((channel_layer_id, z) + c, value)
+                tiles[c] = value
+        return tiles
+
+    def get(self, z, y_range, x_range):
+        '''Gets all tiles of a region.
+
+        Parameters
+        ----------
+        z: int
+            zero-based zoom level index
+        y_range: Tuple[int]
+            zero-based index of the first and one past the last row
+        x_range: Tuple[int]
+            zero-based index of the first and one past the last column
+
+        Returns
+        -------
+        collections.OrderedDict[Tuple[int], tmlib.image.PyramidTile]
+            tiles of the region hashable by row and column
+
+        See also
+        --------
+        :meth:`tmlib.models.tile.TileReader.get_encoded`
+        '''
+        tiles = collections.OrderedDict()
+        for (y, x), value in self.get_encoded(z, y_range, x_range).iteritems():
+            metadata = PyramidTileMetadata(
+                z=z, y=y, x=x, channel_layer_id=self.store.channel_layer_id
+            )
+            tiles[(y, x)] = PyramidTile.create_from_binary(value, metadata)
+        return tiles
+
+
+def create_tile_reader(session, channel_layer):
+    '''Creates a reader for the tiles of a channel layer, which uses the
+    tile cache of the current process. Tiles at the maximal zoom level of
+    layers that were built with argument ``lazy`` are rendered upon first
+    request by a renderer, which is shared by all readers of the layer
+    within the current process.
+
+    Parameters
+    ----------
+    session: tmlib.models.utils.ExperimentSession
+        database session
+    channel_layer: tmlib.models.channel.ChannelLayer
+        channel layer whose tiles should be read
+
+    Returns
+    -------
+    tmlib.models.tile.TileReader
+
+    See also
+    --------
+    :class:`tmlib.workflow.illuminati.api.LazyTileRenderer`
+    '''
+    renderer = None
+    if channel_layer.lazy:
+        renderer = _get_tile_renderer(channel_layer)
+    return TileReader(
+        create_tile_store(session, channel_layer), renderer=renderer
+    )
+
+
+def _get_tile_renderer(channel_layer):
+    # Renderers cache preprocessed images and serialize renders of a layer,
+    # therefore they are shared between readers. The module is imported
+    # here, because the workflow package depends on the models.
+    from tmlib.workflow.illuminati.api import LazyTileRenderer
+    renderer = _tile_renderers.get(channel_layer.id)
+    if renderer is None:
+        renderer = _tile_renderers.setdefault(
+            channel_layer.id, LazyTileRenderer(
+                channel_layer.channel.experiment_id, channel_layer.id,
+                illumcorr=bool(channel_layer.illumcorr),
+                align=bool(channel_layer.align)
+            )
+        )
+    return renderer
@@ -17,7 +17,9 @@ import os
 import sys
 import re
 import h5py
+import time
 import logging
+import threading
 import json
 import ruamel.yaml
 import traceback
@@ -29,6 +31,7 @@ import numpy as np
 import pandas as pd
 from abc import ABCMeta
 from abc import abstractmethod
+from multiprocessing.pool import ThreadPool
 
 from tmlib.errors import NotSupportedError
 from tmlib.utils import same_docstring_as
@@ -521,6 +524,124 @@ class DatasetReader(Reader):
         return dtype
 
 
+class DatasetPrefetcher(object):
+
+    '''Class for reading a dataset from a sequence of HDF5 files ahead of
+    time.
+
+    Files are read and decompressed by a small pool of threads, while the
+    caller processes datasets that have already been read. At most
+    `max_prefetch` datasets are held in memory at any time.
+
+    Examples
+    --------
+    >>> with DatasetPrefetcher(filenames, 'array') as prefetcher:
+    ...     for array in prefetcher:
+    ...         stats.update(array)
+    '''
+
+    def __init__(self, filenames, path, n_threads=2, max_prefetch=4,
+            log_interval=100):
+        '''
+        Parameters
+        ----------
+        filenames: List[str]
+            absolute paths to the files
+        path: str
+            absolute path to the dataset within each file
+        n_threads: int, optional
+            number of threads that read files (default: ``2``)
+        max_prefetch: int, optional
+            maximal number of datasets that are read ahead of time
+            (default: ``4``)
+        log_interval: int, optional
+            number of datasets after which throughput gets logged
+            (default: ``100``)
+        '''
+        if max_prefetch < n_threads:
+            raise ValueError(
+                'Argument "max_prefetch" must be at least "n_threads".'
+            )
+        self.filenames = list(filenames)
+        self.path = path
+        self.n_threads = n_threads
+        self.max_prefetch = max_prefetch
+        self.log_interval = log_interval
+        self._slots = threading.Semaphore(max_prefetch)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._n_read = 0
+        self._n_bytes = 0
+        self._n_consumed = 0
+        self._queue_depth = 0
+        self._wait_time = 0.0
+
+    def __enter__(self):
+        self._pool = ThreadPool(self.n_threads)
+        self._start = time.time()
+        return self
+
+    def __exit__(self, except_type, except_value, except_trace):
+        self.close()
+
+    def close(self):
+        '''Stops reading of files and logs throughput.'''
+        if self._closed:
+            return
+        self._closed = True
+        # Unblock the task handler in case it waits for a free slot.
+        for i in xrange(self.max_prefetch):
+            self._slots.release()
+        self._pool.close()
+        self._pool.join()
+        if self._n_consumed % self.log_interval != 0:
+            self._log_throughput()
+
+    def _bounded(self):
+        for filename in self.filenames:
+            self._slots.acquire()
+            if self._closed:
+                return
+            yield filename
+
+    def _read(self, filename):
+        with DatasetReader(filename) as f:
+            array = f.read(self.path)
+        with self._lock:
+            self._n_read += 1
+            self._n_bytes += array.nbytes
+        return array
+
+    def _log_throughput(self):
+        elapsed = time.time() - self._start
+        n = max(self._n_consumed, 1)
+        logger.info(
+            'read %d datasets in %.1f s (%.1f datasets/s, %.1f MB/s); '
+            'mean queue depth: %.1f; waited %.1f s for datasets',
+            self._n_consumed, elapsed, self._n_consumed / elapsed,
+            self._n_bytes / 1024.0**2 / elapsed,
+            self._queue_depth / float(n), self._wait_time
+        )
+
+    def __iter__(self):
+        arrays = self._pool.imap(self._read, self._bounded())
+        while True:
+            start = time.time()
+            try:
+                array = next(arrays)
+            except StopIteration:
+                break
+            self._wait_time += time.time() - start
+            self._slots.release()
+            with self._lock:
+                self._n_consumed += 1
+                # Datasets that have been read, but not yet consumed
+                self._queue_depth += self._n_read - self._n_consumed
+            if self._n_consumed % self.log_interval == 0:
+                self._log_throughput()
+            yield array
+
+
 class JavaBridge(object):
 
     '''Class for using a Java Virtual Machine for `javabridge`.
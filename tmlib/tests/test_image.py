@@ -0,0 +1,197 @@
+import pytest
+import numpy as np
+import shapely.geometry
+import skimage.draw
+from geoalchemy2.elements import WKBElement
+
+from tmlib.image import SegmentationImage
+from tmlib.image import ChannelImage
+from tmlib.image import IllumstatsImage
+from tmlib.image import IllumstatsContainer
+from tmlib.image import ChannelImagePreprocessor
+from tmlib.image import ArrayBufferPool
+from tmlib.metadata import ChannelImageMetadata
+from tmlib.metadata import IllumstatsImageMetadata
+from tmlib.image import _fill_polygons
+from tmlib.image import _decode_polygon_exteriors
+
+
+def _create_label_image():
+    # Touching objects, an object with a hole, an object enclosed by
+    # another one, single pixel objects and objects at the border.
+    labels = np.zeros((60, 80), dtype=np.int32)
+    labels[5:20, 5:15] = 1
+    labels[5:20, 15:25] = 2
+    labels[20:30, 10:20] = 3
+    labels[30:50, 30:55] = 4
+    labels[36:44, 38:47] = 0
+    labels[39:41, 41:43] = 5
+    labels[10, 40] = 6
+    labels[12, 42] = 7
+    labels[13, 43] = 8
+    labels[0:10, 60:80] = 9
+    labels[50:60, 0:8] = 10
+    labels[45:55, 65:72] = 11
+    labels[47, 66:71] = 0
+    return SegmentationImage(labels)
+
+
+def _assert_equal_polygons(image, n_processes):
+    polygons = list(image.extract_polygons(10, 20, n_processes))
+    reference = list(image._extract_polygons_per_object(10, 20))
+    assert [l for l, _ in polygons] == [l for l, _ in reference]
+    for (label, polygon), (_, expected) in zip(polygons, reference):
+        if label == 5:
+            # The object vanishes upon morphological opening. The reference
+            # adds the bounding box offset twice to its fallback square,
+            # which should be centered on the object instead.
+            expected = shapely.geometry.Polygon([
+                (60, -48), (62, -48), (62, -50), (60, -50)
+            ])
+        assert polygon.equals(expected), label
+
+
+def test_extract_polygons():
+    _assert_equal_polygons(_create_label_image(), 1)
+
+
+def test_extract_polygons_multiple_processes():
+    _assert_equal_polygons(_create_label_image(), 2)
+
+
+def test_fill_polygons():
+    # Overlapping and concave polygons, a polygon crossing the border
+    rings = [
+        np.array([[5, 5], [40, 8], [30, 35], [5, 5]]),
+        np.array([
+            [20, 10], [50, 10], [50, 40], [35, 20], [20, 40], [20, 10]
+        ]),
+        np.array([[10, 25], [25, 25], [25, 45], [10, 45], [10, 25]]),
+        np.array([[55, 30], [70, 40], [55, 50], [55, 30]])
+    ]
+    labels = np.array([3, 1, 7, 2], dtype=np.int32)
+    array = np.zeros((48, 64), dtype=np.int32)
+    _fill_polygons(array, rings, labels)
+    expected = np.zeros(array.shape, dtype=np.int32)
+    for ring, label in zip(rings, labels):
+        rr, cc = skimage.draw.polygon(ring[:, 1], ring[:, 0], array.shape)
+        expected[rr, cc] = label
+    assert np.array_equal(array, expected)
+
+
+def test_decode_polygon_exteriors():
+    polygon = shapely.geometry.Polygon([(1, -2), (5, -2), (5, -8), (1, -2)])
+    rings = _decode_polygon_exteriors([WKBElement(polygon.wkb)])
+    assert np.array_equal(rings[0], np.array(polygon.exterior.coords))
+
+
+def test_decode_polygon_exteriors_with_z_coordinates():
+    polygon = shapely.geometry.Polygon([(1, -2, 0), (5, -2, 0), (5, -8, 0)])
+    with pytest.raises(ValueError):
+        _decode_polygon_exteriors([WKBElement(polygon.wkb)])
+
+
+def _create_channel_image_and_stats():
+    random_state = np.random.RandomState(0)
+    shape = (64, 80)
+    y, x = np.mgrid[0:shape[0], 0:shape[1]] / float(shape[0]) - 0.5
+    field = 1 - 0.6 * (x**2 + y**2)
+    pixels = field * random_state.lognormal(6, 0.5, shape)
+    metadata = ChannelImageMetadata(
+        channel_id=1, site_id=1, cycle_id=1, tpoint=0, zplane=0
+    )
+    metadata.y_shift = 2
+    metadata.x_shift = -3
+    metadata.top_residue = 3
+    metadata.bottom_residue = 1
+    metadata.left_residue = 0
+    metadata.right_residue = 4
+    image = ChannelImage(pixels.astype(np.uint16), metadata)
+    log_pixels = np.log10(
+        field * random_state.lognormal(6, 0.5, (20, ) + shape)
+    )
+    stats_metadata = IllumstatsImageMetadata(channel_id=1)
+    stats = IllumstatsContainer(
+        IllumstatsImage(log_pixels.mean(axis=0), stats_metadata),
+        IllumstatsImage(log_pixels.std(axis=0), stats_metadata),
+        {}
+    )
+    return (image, stats)
+
+
+def _preprocess_chained(image, stats, crop, clip_min, clip_max, rescale):
+    image = image.correct(stats, inplace=False)
+    image = image.align(crop=crop)
+    image = image.clip(clip_min, clip_max)
+    if rescale:
+        image = image.scale(clip_min, clip_max)
+    return image
+
+
+def test_correct_requires_matching_dimensions():
+    image, stats = _create_channel_image_and_stats()
+    stats = IllumstatsContainer(
+        IllumstatsImage(stats.mean.array[:-2, :], stats.mean.metadata),
+        IllumstatsImage(stats.std.array[:-2, :], stats.std.metadata),
+        {}
+    )
+    with pytest.raises(ValueError):
+        image.correct(stats)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('rescale', [True, False])
+@pytest.mark.parametrize('crop', [True, False])
+def test_preprocessor_matches_chained_operations(dtype, rescale, crop):
+    image, stats = _create_channel_image_and_stats()
+    preprocessor = ChannelImagePreprocessor(
+        stats=stats, align=True, crop=crop, clip_min=100, clip_max=900,
+        rescale=rescale, dtype=dtype
+    )
+    processed = preprocessor.process(image)
+    expected = _preprocess_chained(image, stats, crop, 100, 900, rescale)
+    assert processed.array.dtype == expected.array.dtype
+    assert processed.dimensions == expected.dimensions
+    diff = np.abs(
+        processed.array.astype(np.int64) - expected.array.astype(np.int64)
+    )
+    if dtype == np.float64:
+        assert diff.max() == 0
+    else:
+        # Single precision may round differently at integer boundaries.
+        assert diff.max() <= 1
+        assert np.mean(diff > 0) < 0.01
+
+
+def test_array_buffer_pool_reuses_released_arrays():
+    pool = ArrayBufferPool()
+    array = pool.acquire((4, 4), np.float64)
+    pool.release(array)
+    assert pool.acquire((4, 4), np.float64) is array
+    assert pool.n_reused == 1
+
+
+def test_array_buffer_pool_rejects_double_release():
+    pool = ArrayBufferPool()
+    array = pool.acquire((4, 4), np.float64)
+    pool.release(array)
+    with pytest.raises(ValueError):
+        pool.release(array)
+
+
+def test_array_buffer_pool_rejects_views():
+    pool = ArrayBufferPool()
+    array = pool.acquire((4, 4), np.float64)
+    with pytest.raises(ValueError):
+        pool.release(array[:2])
+
+
+def test_smooth_with_and_without_out():
+    np.random.seed(2)
+    array = np.random.random((20, 30))
+    image = IllumstatsImage(array, IllumstatsImageMetadata(channel_id=1))
+    smoothed = image.smooth(2, inplace=False)
+    out = np.empty(array.shape, dtype=np.float64)
+    smoothed_out = image.smooth(2, inplace=False, out=out)
+    assert smoothed_out.array is out
+    np.testing.assert_array_equal(smoothed.array, smoothed_out.array)
@@ -20,7 +20,10 @@ import time
 import datetime
 import re
 import os
+import sys
 import inspect
+import resource
+import threading
 from decorator import decorator
 from types import *
 import logging
@@ -573,3 +576,98 @@ def notimplemented(func):
     wrapper.is_implemented = False
     return wrapper
 
+
+def get_memory_usage():
+    '''Determines the resident set size (RSS) of the current process.
+
+    Returns
+    -------
+    int
+        current resident set size in bytes
+
+    Note
+    ----
+    Falls back to the peak resident set size on systems that don't provide
+    ``/proc``.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            n_pages = int(f.read().split()[1])
+        return n_pages * resource.getpagesize()
+    except IOError:
+        return get_peak_memory_usage()
+
+
+def get_peak_memory_usage():
+    '''Determines the peak resident set size (RSS) of the current process.
+
+    Returns
+    -------
+    int
+        maximal resident set size in bytes
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    # Linux reports kilobytes
+    return peak * 1024
+
+
+class MemoryMonitor(object):
+
+    '''Context manager that monitors memory usage of the current process
+    in a background thread.
+
+    Examples
+    --------
+    .. code:: python
+
+        from tmlib.utils import MemoryMonitor
+
+        with MemoryMonitor() as monitor:
+            process_images()
+        print 'peak: %d bytes' % monitor.peak
+        print 'steady state: %d bytes' % monitor.steady_state
+    '''
+
+    def __init__(self, interval=1.0):
+        '''
+        Parameters
+        ----------
+        interval: float, optional
+            time between two measurements in seconds (default: ``1.0``)
+        '''
+        self.interval = interval
+        self._samples = list()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+
+    def _sample(self):
+        while True:
+            self._samples.append(get_memory_usage())
+            if self._stopped.wait(self.interval):
+                break
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, except_type, except_value, except_trace):
+        self._stopped.set()
+        self._thread.join()
+        self._samples.append(get_memory_usage())
+
+    @property
+    def peak(self):
+        '''int: peak resident set size in bytes'''
+        return get_peak_memory_usage()
+
+    @property
+    def steady_state(self):
+        '''int: median resident set size in bytes over the second half of
+        the monitored period, when buffers have been allocated and memory
+        usage should no longer grow
+        '''
+        samples = sorted(self._samples[len(self._samples) // 2:])
+        return samples[len(samples) // 2]
@@ -411,6 +411,21 @@ class WorkflowStepAPI(BasicWorkflowStepAPI):
         '''Deletes the output of a previous submission.'''
         pass
 
+    def delete_outdated_job_output(self, args):
+        '''Deletes the output of a previous submission before batches are
+        created for a new submission. By default, all output gets deleted
+        (see
+        :meth:`delete_previous_job_output <tmlib.workflow.api.WorkflowStepAPI.delete_previous_job_output>`).
+        Steps that reuse parts of the previous output should override this
+        method.
+
+        Parameters
+        ----------
+        args: tmlib.workflow.args.BatchArguments
+            step-specific arguments of the new submission
+        '''
+        self.delete_previous_job_output()
+
     @abstractmethod
     def collect_job_output(self, batch):
         '''Collects the output of jobs and fuse them if necessary.
@@ -45,6 +45,7 @@ from tmlib.workflow.submission import WorkflowSubmissionManager
 from tmlib.workflow.workflow import WorkflowStep
 from tmlib.workflow.jobs import IndependentJobCollection
 from tmlib.log import configure_logging
+from tmlib.utils import MemoryMonitor
 from tmlib.log import map_logging_verbosity
 from tmlib.errors import WorkflowError
 import tmlib.models as tm
@@ -346,6 +347,20 @@ class WorkflowStepCLI(WorkflowSubmissionManager):
         '''Prints the step-specific logo to standard output (console).'''
         print cls.__logo__
 
+    @staticmethod
+    def _log_memory_usage(monitor):
+        '''Logs memory usage of a job.
+
+        Parameters
+        ----------
+        monitor: tmlib.utils.MemoryMonitor
+            monitor that tracked the job
+        '''
+        logger.info(
+            'memory usage: peak RSS %.1f MB, steady-state RSS %.1f MB',
+            monitor.peak / 1024.0**2, monitor.steady_state / 1024.0**2
+        )
+
     @climethod(
         help=(
             'cleans up the output of a previous submission, i.e. removes '
@@ -370,7 +385,7 @@ class WorkflowStepCLI(WorkflowSubmissionManager):
         shutil.rmtree(api.batches_location)
         os.mkdir(api.batches_location)
         logger.info('delete previous job output')
-        api.delete_previous_job_output()
+        api.delete_outdated_job_output(self._batch_args)
         logger.info('create batches for run jobs')
         batches = api.create_run_batches(self._batch_args)
         for index, batch in enumerate(batches):
@@ -397,7 +412,9 @@ class WorkflowStepCLI(WorkflowSubmissionManager):
         api = self.api_instance
         batch = api.get_run_batch(job_id)
         logger.info('run job #%d' % job_id)
-        api.run_job(batch, assume_clean_state)
+        with MemoryMonitor() as monitor:
+            api.run_job(batch, assume_clean_state)
+        self._log_memory_usage(monitor)
 
     @climethod(
         help='prints the description of a given batch job to the console',
@@ -569,4 +586,6 @@ class WorkflowStepCLI(WorkflowSubmissionManager):
         logger.info('read job description from file')
         batch = api.get_collect_batch()
         logger.info('collect job output')
-        api.collect_job_output(batch)
+        with MemoryMonitor() as monitor:
+            api.collect_job_output(batch)
+        self._log_memory_usage(monitor)
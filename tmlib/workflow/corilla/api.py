@@ -14,15 +14,23 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
+import glob
+import random
+import itertools
 import logging
+import collections
 from sqlalchemy import func
 
 import tmlib.models as tm
-from tmlib.utils import notimplemented
-from tmlib.image import IllumstatsContainer
+from tmlib.utils import autocreate_directory_property
+from tmlib.image import ChannelImage
+from tmlib.readers import DatasetPrefetcher
 from tmlib.models.utils import delete_location
 from tmlib.workflow.api import WorkflowStepAPI
 from tmlib.workflow.corilla.stats import OnlineStatistics
+from tmlib.workflow.corilla.stats import build_partial_statistics_filename
+from tmlib.workflow.corilla.stats import merge_partial_statistics
+from tmlib.workflow.corilla.stats import store_statistics
 from tmlib.workflow import register_step_api
 
 logger = logging.getLogger(__name__)
@@ -42,6 +50,13 @@ class IllumstatsCalculator(WorkflowStepAPI):
         '''
         super(IllumstatsCalculator, self).__init__(experiment_id)
 
+    @autocreate_directory_property
+    def partial_stats_location(self):
+        '''str: location where statistics calculated by individual run jobs
+        are stored until they get merged in the collect phase
+        '''
+        return os.path.join(self.step_location, 'partial_stats')
+
     def create_run_batches(self, args):
         '''Creates job descriptions for parallel computing.
 
@@ -54,6 +69,14 @@ class IllumstatsCalculator(WorkflowStepAPI):
         -------
         generator
             job descriptions
+
+        Note
+        ----
+        Image files of each channel are distributed across several jobs.
+        Statistics of the individual jobs get merged in the collect phase.
+        In :attr:`incremental <tmlib.workflow.corilla.args.CorillaBatchArguments.incremental>`
+        mode, only image files that have not yet been accumulated are
+        processed.
         '''
         count = 0
 
@@ -67,53 +90,155 @@ class IllumstatsCalculator(WorkflowStepAPI):
                 # hundreds of thousands of them. Twenty thousand should be more
                 # than enough for robust illumination statistics.
                 limit = 20000
-                n = session.query(tm.ChannelImageFile.id).\
-                    filter_by(channel_id=ch.id).\
-                    count()
-                if n > limit:
+                file_ids = None
+                if args.incremental:
+                    file_ids = self._get_new_image_file_ids(
+                        session, ch, limit, args.downsampling_factor
+                    )
+                incremental = file_ids is not None
+                if incremental:
+                    if not file_ids:
+                        logger.info(
+                            'illumination statistics of channel "%s" are '
+                            'up to date', ch.name
+                        )
+                        continue
                     logger.info(
-                        'using a subset of image files (n=%d) to calculate '
-                        'illumination statistics for channel "%s"', limit,
-                        ch.name
+                        'update illumination statistics of channel "%s" with '
+                        '%d image files', ch.name, len(file_ids)
                     )
-                    file_ids = session.query(tm.ChannelImageFile.id).\
-                        filter_by(channel_id=ch.id).\
-                        order_by(func.random()).\
-                        limit(limit).\
-                        all()
                 else:
-                    if n < 100:
-                        logger.warn(
-                            'calculation of illumnation statistics for channel '
-                            '"%s" on only %d images - this may introduce '
-                            'artifacts upon illumination correction', ch.name, n
-                        )
-                    file_ids = session.query(tm.ChannelImageFile.id).\
-                        filter_by(channel_id=ch.id).\
-                        all()
+                    file_ids = self._get_image_file_ids(session, ch, limit)
                 if not file_ids:
                     logger.warning(
                         'no image files found for channel "%s"', ch.name
                     )
                     continue
 
-                count += 1
-                yield {
-                    'id': count,
-                    'channel_image_files_ids': file_ids,
-                    'channel_id': ch.id,
-                }
+                batches = self._create_batches(file_ids, args.batch_size)
+                for batch in batches:
+                    count += 1
+                    yield {
+                        'id': count,
+                        'channel_image_files_ids': batch,
+                        'channel_id': ch.id,
+                        'incremental': incremental,
+                        'downsampling_factor': args.downsampling_factor
+                    }
+
+    def _get_image_file_ids(self, session, channel, limit):
+        n = session.query(tm.ChannelImageFile.id).\
+            filter_by(channel_id=channel.id).\
+            count()
+        if n > limit:
+            logger.info(
+                'using a subset of image files (n=%d) to calculate '
+                'illumination statistics for channel "%s"', limit,
+                channel.name
+            )
+            file_ids = session.query(tm.ChannelImageFile.id).\
+                filter_by(channel_id=channel.id).\
+                order_by(func.random()).\
+                limit(limit).\
+                all()
+        else:
+            if n < 100:
+                logger.warn(
+                    'calculation of illumnation statistics for channel '
+                    '"%s" on only %d images - this may introduce '
+                    'artifacts upon illumination correction', channel.name, n
+                )
+            file_ids = session.query(tm.ChannelImageFile.id).\
+                filter_by(channel_id=channel.id).\
+                all()
+        return [f.id for f in file_ids]
+
+    def _get_new_image_file_ids(self, session, channel, limit,
+            downsampling_factor):
+        # Statistics can only be updated when all accumulated images still
+        # exist, because pixels of removed images are no longer available
+        # to reverse their contribution.
+        stats_file = session.query(tm.IllumstatsFile).\
+            filter_by(channel_id=channel.id).\
+            one_or_none()
+        if stats_file is None:
+            logger.info(
+                'no illumination statistics found for channel "%s"',
+                channel.name
+            )
+            return None
+        accumulator = stats_file.get_accumulator()
+        if accumulator is None:
+            logger.info(
+                'illumination statistics of channel "%s" cannot be updated',
+                channel.name
+            )
+            return None
+        state, accumulated_file_ids = accumulator
+        if int(state.get('downsampling_factor', 1)) != downsampling_factor:
+            logger.info(
+                'illumination statistics of channel "%s" were calculated with '
+                'a different downsampling factor and need to be recalculated',
+                channel.name
+            )
+            return None
+        accumulated_file_ids = set(accumulated_file_ids)
+        file_ids = session.query(tm.ChannelImageFile.id).\
+            filter_by(channel_id=channel.id).\
+            all()
+        file_ids = set([f.id for f in file_ids])
+        removed_file_ids = accumulated_file_ids - file_ids
+        if removed_file_ids:
+            logger.info(
+                '%d accumulated image files of channel "%s" were removed, '
+                'illumination statistics need to be recalculated',
+                len(removed_file_ids), channel.name
+            )
+            return None
+        new_file_ids = list(file_ids - accumulated_file_ids)
+        n_missing = max(0, limit - len(accumulated_file_ids))
+        if len(new_file_ids) > n_missing:
+            new_file_ids = random.sample(new_file_ids, n_missing)
+        return sorted(new_file_ids)
 
     def delete_previous_job_output(self):
         '''Deletes all :class:`tmlib.models.file.IllumstatsFile` instances
-        of the processed experiment.
+        of the processed experiment as well as statistics of individual
+        run jobs.
         '''
         logger.info('delete existing illumination statistics files')
         with tm.utils.ExperimentSession(self.experiment_id) as session:
             session.query(tm.IllumstatsFile).delete()
+        self.delete_partial_statistics()
+
+    def delete_outdated_job_output(self, args):
+        '''Deletes the output of a previous submission. In
+        :attr:`incremental <tmlib.workflow.corilla.args.CorillaBatchArguments.incremental>`
+        mode, existing :class:`tmlib.models.file.IllumstatsFile` instances
+        are kept, since they are required to update the statistics.
+
+        Parameters
+        ----------
+        args: tmlib.workflow.corilla.args.CorillaBatchArguments
+            step-specific arguments of the new submission
+        '''
+        if args.incremental:
+            self.delete_partial_statistics()
+        else:
+            self.delete_previous_job_output()
+
+    def delete_partial_statistics(self):
+        '''Deletes statistics of individual run jobs, but leaves
+        :class:`tmlib.models.file.IllumstatsFile` instances untouched.
+        '''
+        logger.info('delete existing partial statistics')
+        for filename in glob.glob(
+                os.path.join(self.partial_stats_location, '*.h5')):
+            os.remove(filename)
 
     def run_job(self, batch, assume_clean_state=False):
-        '''Calculates illumination statistics.
+        '''Calculates illumination statistics for a subset of images of
+        a channel.
 
         Parameters
         ----------
@@ -125,27 +250,74 @@ class IllumstatsCalculator(WorkflowStepAPI):
         file_ids = batch['channel_image_files_ids']
         logger.info('calculate illumination statistics')
         with tm.utils.ExperimentSession(self.experiment_id) as session:
-            img_file = session.query(tm.ChannelImageFile).get(file_ids[0])
-            img = img_file.get()
-        stats = OnlineStatistics(image_dimensions=img.dimensions[0:2])
-        for fid in file_ids:
-            with tm.utils.ExperimentSession(self.experiment_id) as session:
-                img_file = session.query(tm.ChannelImageFile).get(fid)
-                logger.info('update statistics for image: %d', img_file.id)
-                img = img_file.get()
-                stats.update(img)
+            image_files = session.query(tm.ChannelImageFile).\
+                filter(tm.ChannelImageFile.id.in_(file_ids)).\
+                all()
+            locations = {f.id: f.location for f in image_files}
+        filenames = [locations[fid] for fid in file_ids]
+        stats = None
+        # Images are read and decompressed in separate threads while
+        # statistics get updated, since neither of them requires the
+        # database or image metadata.
+        with DatasetPrefetcher(filenames, 'array') as prefetcher:
+            for fid, array in itertools.izip(file_ids, prefetcher):
+                logger.debug('update statistics for image: %d', fid)
+                if stats is None:
+                    stats = OnlineStatistics(
+                        image_dimensions=array.shape[0:2],
+                        downsampling_factor=batch.get('downsampling_factor', 1)
+                    )
+                stats.update(ChannelImage(array))
 
-        with tm.utils.ExperimentSession(self.experiment_id) as session:
-            stats_file = session.get_or_create(
-                tm.IllumstatsFile, channel_id=batch['channel_id']
-            )
-            logger.info('write calculated statistics to file')
-            illumstats = IllumstatsContainer(
-                stats.mean, stats.std, stats.percentiles
-            )
-            stats_file.put(illumstats)
+        logger.info('write partial statistics to file')
+        filename = build_partial_statistics_filename(
+            self.partial_stats_location, batch['channel_id'], batch['id']
+        )
+        stats.write(filename)
 
-    @notimplemented
     def collect_job_output(self, batch):
-        pass
+        '''Merges statistics calculated by individual run jobs and stores
+        the illumination statistics of each channel together with the state
+        of the accumulator.
 
+        Parameters
+        ----------
+        batch: dict
+            job description
+        '''
+        try:
+            job_ids = self.get_run_job_ids()
+        except IOError:
+            logger.info('illumination statistics are up to date')
+            return
+        channel_batches = collections.defaultdict(list)
+        for job_id in sorted(job_ids):
+            run_batch = self.get_run_batch(job_id)
+            channel_batches[run_batch['channel_id']].append(run_batch)
+        for channel_id, run_batches in channel_batches.iteritems():
+            logger.info(
+                'merge statistics of %d jobs for channel %d',
+                len(run_batches), channel_id
+            )
+            filenames = list()
+            file_ids = list()
+            for b in run_batches:
+                filenames.append(
+                    build_partial_statistics_filename(
+                        self.partial_stats_location, channel_id, b['id']
+                    )
+                )
+                file_ids.extend(b['channel_image_files_ids'])
+            stats = merge_partial_statistics(filenames)
+
+            with tm.utils.ExperimentSession(self.experiment_id) as session:
+                stats_file = session.get_or_create(
+                    tm.IllumstatsFile, channel_id=channel_id
+                )
+                if run_batches[0].get('incremental', False):
+                    logger.info('merge with existing statistics')
+                    state, accumulated_file_ids = stats_file.get_accumulator()
+                    stats = OnlineStatistics.from_state(state).merge(stats)
+                    file_ids = accumulated_file_ids + file_ids
+                logger.info('write calculated statistics to file')
+                store_statistics(stats_file, stats, file_ids)
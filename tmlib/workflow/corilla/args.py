@@ -13,6 +13,7 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from tmlib.workflow.args import Argument
 from tmlib.workflow.args import BatchArguments
 from tmlib.workflow.args import SubmissionArguments
 from tmlib.workflow import register_step_batch_args
@@ -22,7 +23,32 @@ from tmlib.workflow import register_step_submission_args
 @register_step_batch_args('corilla')
 class CorillaBatchArguments(BatchArguments):
 
-    pass
+    batch_size = Argument(
+        type=int, default=1000, flag='batch-size', short_flag='b',
+        help=(
+            'number of image files that should be processed per job; '
+            'statistics of jobs are merged per channel'
+        )
+    )
+
+    incremental = Argument(
+        type=bool, default=False, short_flag='i',
+        help=(
+            'whether existing statistics should only be updated with image '
+            'files that were added since they were calculated; statistics '
+            'are recalculated for channels whose image files were removed'
+        )
+    )
+
+    downsampling_factor = Argument(
+        type=int, default=1, flag='downsampling-factor', short_flag='d',
+        help=(
+            'size of blocks of pixels along the y and x axis for which '
+            'statistics should be calculated; statistics get upsampled '
+            'upon correction, which reduces memory and storage '
+            'requirements for slowly varying illumination artifacts'
+        )
+    )
 
 
 @register_step_submission_args('corilla')
@@ -20,27 +20,55 @@ References
 ----------
 .. [1] Stoeger T, Battich N, Herrmann MD, Yakimovich Y, Pelkmans L. 2015. "Computer vision for image-based transcriptomics". Methods.
 .. [2] Welford BP. 1962. "Note on a method for calculating corrected sums of squares and products". Technometrics 4(3):419-420.
+.. [3] Chan TF, Golub GH, LeVeque RJ. 1979. "Updating formulae and a pairwise algorithm for computing sample variances". Technical Report STAN-CS-79-773, Stanford University.
 
 '''
 
+import os
 import numpy as np
 import logging
 
 from tmlib.utils import assert_type
 from tmlib.image import IllumstatsImage
+from tmlib.image import IllumstatsContainer
+from tmlib.readers import DatasetReader
+from tmlib.writers import DatasetWriter
 
 logger = logging.getLogger(__name__)
 
 
+def _combine(n_a, mean_a, M2_a, n_b, mean_b, M2_b):
+    # Pairwise update of mean and sum of squared differences [3]
+    n = float(n_a + n_b)
+    delta_mean = mean_b - mean_a
+    mean = mean_a + delta_mean * (n_b / n)
+    M2 = M2_a + M2_b + delta_mean**2 * (n_a * n_b / n)
+    return (mean, M2)
+
+
 class OnlineStatistics(object):
 
     '''Class for calculating online statistics (mean and variance)
     element-by-element on a series of numpy arrays based on
     Welford's method [2] . For more information see Wikipedia article
     `"Algorithms for calculating variance" <https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Online_algorithm>`_.
+
+    Intensity percentiles are calculated over the pixels of all images.
+    Since pixel values are unsigned integers, a histogram with one bin per
+    possible value is accumulated, from which percentiles can be derived
+    exactly without having to sort pixel values.
+
+    Statistics calculated on disjoint subsets of images can be combined
+    with :meth:`merge <tmlib.workflow.corilla.stats.OnlineStatistics.merge>`
+    based on the pairwise algorithm of Chan et al. [3] .
+
+    Since illumination artifacts vary smoothly across the image, mean and
+    variance can be calculated on a grid of non-overlapping blocks
+    of pixels rather than for each individual pixel. In this case, all pixels
+    of a block are considered samples of the same distribution.
     '''
 
-    def __init__(self, image_dimensions, decimals=3):
+    def __init__(self, image_dimensions, decimals=3, downsampling_factor=1):
         '''
         Parameters
         ----------
@@ -49,16 +77,30 @@ class OnlineStatistics(object):
         decimals: int
             precision after the comma that determines the number of percentiles
             that will be calculated
+        downsampling_factor: int, optional
+            size of blocks along the y and x axis for which statistics
+            should be calculated; must be a divisor of `image_dimensions`
+            (default: ``1``)
         '''
         self.n = 0
-        self.image_dimensions = image_dimensions
-        self._mean = np.zeros(image_dimensions, dtype=float)
-        self._M2 = np.zeros(image_dimensions, dtype=float)
+        self.image_dimensions = tuple(image_dimensions)
+        self.decimals = decimals
+        if any([d % downsampling_factor for d in self.image_dimensions]):
+            raise ValueError(
+                'Argument "downsampling_factor" must be a divisor of the '
+                'image dimensions.'
+            )
+        self.downsampling_factor = downsampling_factor
+        dimensions = tuple([
+            d / downsampling_factor for d in self.image_dimensions
+        ])
+        self._mean = np.zeros(dimensions, dtype=float)
+        self._M2 = np.zeros(dimensions, dtype=float)
         if not(0 <= decimals <= 3):
             raise ValueError('Argument "decimals" must lie in range [0, 3].')
         precision = 10**(decimals+2)
         self._q = np.linspace(0, 100, precision)
-        self._percentiles = np.zeros((precision, ), dtype=np.float)
+        self._histogram = np.zeros((2**16, ), dtype=np.int64)
         self._keys = [round(x, decimals) for x in self._q]
 
     @assert_type(image='tmlib.image.ChannelImage')
@@ -72,8 +114,9 @@ class OnlineStatistics(object):
         log_transform: bool, optional
             log10 transform image (default: ``True``)
         '''
-        # Calculate percentiles with unsigned integer data type
-        self._percentiles += np.percentile(image.array, self._q)
+        # Count pixel values with unsigned integer data type
+        counts = np.bincount(image.array.ravel())
+        self._histogram[:counts.shape[0]] += counts
         # The other statistics require float data type
         array = image.array.astype(float)
         if log_transform:
@@ -85,37 +128,263 @@ class OnlineStatistics(object):
             array[is_zero] = 0
         if np.any(np.isinf(array)):
             logger.warn('skip image because it contains infinite values')
+        elif self.downsampling_factor > 1:
+            # Pixels of a block are combined with the block statistics
+            # accumulated so far as a batch of samples.
+            f = self.downsampling_factor
+            height, width = self._mean.shape
+            blocks = array.reshape(height, f, width, f)
+            block_mean = blocks.mean(axis=(1, 3))
+            block_M2 = np.sum(
+                (blocks - block_mean[:, np.newaxis, :, np.newaxis])**2,
+                axis=(1, 3)
+            )
+            self._mean, self._M2 = _combine(
+                self._n_samples, self._mean, self._M2,
+                f**2, block_mean, block_M2
+            )
+            self.n += 1
         else:
             self.n += 1
             delta_mean = array - self._mean
             self._mean = self._mean + delta_mean / self.n
             self._M2 = self._M2 + delta_mean * (array - self._mean)
 
+    @property
+    def _n_samples(self):
+        # Number of samples for each element of the statistics matrices
+        return self.n * self.downsampling_factor**2
+
+    def merge(self, other):
+        '''Merges statistics calculated on another, disjoint set of images.
+
+        Parameters
+        ----------
+        other: tmlib.workflow.corilla.stats.OnlineStatistics
+            statistics that should be merged into the existing object
+
+        Returns
+        -------
+        tmlib.workflow.corilla.stats.OnlineStatistics
+            merged statistics
+
+        Raises
+        ------
+        ValueError
+            when image dimensions or precision of percentiles differ
+        '''
+        if other.image_dimensions != self.image_dimensions:
+            raise ValueError('Image dimensions of statistics must match.')
+        if other.decimals != self.decimals:
+            raise ValueError('Precision of percentiles must match.')
+        if other.downsampling_factor != self.downsampling_factor:
+            raise ValueError('Downsampling factors of statistics must match.')
+        self._histogram += other._histogram
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self._mean = other._mean.copy()
+            self._M2 = other._M2.copy()
+        else:
+            self._mean, self._M2 = _combine(
+                self._n_samples, self._mean, self._M2,
+                other._n_samples, other._mean, other._M2
+            )
+        self.n += other.n
+        return self
+
+    @property
+    def state(self):
+        '''Dict[str, Union[int, numpy.ndarray]]: state of the accumulator,
+        from which statistics can be restored and updated with additional
+        images (see
+        :meth:`from_state <tmlib.workflow.corilla.stats.OnlineStatistics.from_state>`)
+        '''
+        return {
+            'n': self.n,
+            'decimals': self.decimals,
+            'downsampling_factor': self.downsampling_factor,
+            'mean': self._mean,
+            'M2': self._M2,
+            'histogram': self._histogram
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        '''Restores statistics from the state of an accumulator.
+
+        Parameters
+        ----------
+        state: Dict[str, Union[int, numpy.ndarray]]
+            state of the accumulator
+
+        Returns
+        -------
+        tmlib.workflow.corilla.stats.OnlineStatistics
+        '''
+        downsampling_factor = int(state.get('downsampling_factor', 1))
+        image_dimensions = tuple([
+            d * downsampling_factor for d in state['mean'].shape
+        ])
+        stats = cls(
+            image_dimensions, int(state['decimals']), downsampling_factor
+        )
+        stats.n = int(state['n'])
+        stats._mean = state['mean']
+        stats._M2 = state['M2']
+        stats._histogram = state['histogram']
+        return stats
+
+    def write(self, filename):
+        '''Writes the current state to a file, such that statistics can be
+        merged across processes.
+
+        Parameters
+        ----------
+        filename: str
+            absolute path to the HDF5 file
+        '''
+        with DatasetWriter(filename, truncate=True) as f:
+            for name, value in self.state.iteritems():
+                f.write(name, value)
+
+    @classmethod
+    def read(cls, filename):
+        '''Reads a state that was previously written to a file.
+
+        Parameters
+        ----------
+        filename: str
+            absolute path to the HDF5 file
+
+        Returns
+        -------
+        tmlib.workflow.corilla.stats.OnlineStatistics
+        '''
+        with DatasetReader(filename) as f:
+            state = {
+                name: f.read(name) for name in f.list_datasets()
+            }
+        return cls.from_state(state)
+
     @property
     def var(self):
         '''numpy.ndarray[float]: variance'''
         if self.n < 2:
-            var = np.zeros(self.image_dimensions, dtype=float)
+            var = np.zeros(self._mean.shape, dtype=float)
             var[:] = np.nan
         else:
-            var = self._M2 / (self.n - 1)
+            var = self._M2 / (self._n_samples - 1)
         return var
 
     @property
     def mean(self):
-        '''tmlib.image.IllumstatsImage: mean values'''
+        '''tmlib.image.IllumstatsImage: mean values (per block of pixels
+        in case statistics are downsampled)
+        '''
         return IllumstatsImage(self._mean)
 
     @property
     def std(self):
-        '''tmlib.image.IllumstatsImage: standard deviation values'''
+        '''tmlib.image.IllumstatsImage: standard deviation values (per block
+        of pixels in case statistics are downsampled)
+        '''
         return IllumstatsImage(np.sqrt(self.var))
 
     @property
     def percentiles(self):
         '''Dict[float, int]: calculated percentiles (rounded to integer values)
+
+        Note
+        ----
+        Values are identical to those computed by :func:`numpy.percentile`
+        with linear interpolation on the pixels of all images.
+
+        Raises
+        ------
+        ValueError
+            when no image has been added
         '''
+        cumulative_counts = np.cumsum(self._histogram)
+        if cumulative_counts[-1] == 0:
+            raise ValueError(
+                'Percentiles require pixels of at least one image.'
+            )
+        rank = self._q / 100 * (cumulative_counts[-1] - 1)
+        lower_rank = np.floor(rank)
+        upper_rank = np.minimum(lower_rank + 1, cumulative_counts[-1] - 1)
+        # The pixel value at a given rank of the sorted pixels is the first
+        # value whose cumulative count exceeds the rank.
+        lower = np.searchsorted(cumulative_counts, lower_rank, side='right')
+        upper = np.searchsorted(cumulative_counts, upper_rank, side='right')
+        weights = rank - lower_rank
+        values = lower * (1 - weights) + upper * weights
         return {
-            self._keys[i]: int(x/self.n)
-            for i, x in enumerate(self._percentiles)
+            self._keys[i]: int(x) for i, x in enumerate(values)
         }
+
+
+def build_partial_statistics_filename(location, channel_id, job_id):
+    '''Builds the name of the file in which statistics calculated by an
+    individual run job are stored until they get merged.
+
+    Parameters
+    ----------
+    location: str
+        absolute path to the directory where partial statistics are stored
+    channel_id: int
+        ID of the channel for which statistics were calculated
+    job_id: int
+        one-based ID of the job that calculated the statistics
+
+    Returns
+    -------
+    str
+        absolute path to the HDF5 file
+    '''
+    return os.path.join(
+        location, 'channel_%d_job_%.7d.h5' % (channel_id, job_id)
+    )
+
+
+def merge_partial_statistics(filenames):
+    '''Reads and merges statistics that were calculated by individual run jobs
+    on disjoint sets of images.
+
+    Parameters
+    ----------
+    filenames: List[str]
+        absolute paths to the HDF5 files of the partial statistics
+        (see :func:`build_partial_statistics_filename <tmlib.workflow.corilla.stats.build_partial_statistics_filename>`)
+
+    Returns
+    -------
+    tmlib.workflow.corilla.stats.OnlineStatistics
+        merged statistics
+    '''
+    stats = OnlineStatistics.read(filenames[0])
+    for filename in filenames[1:]:
+        stats.merge(OnlineStatistics.read(filename))
+    return stats
+
+
+def store_statistics(stats_file, stats, channel_image_file_ids):
+    '''Stores illumination statistics together with the state of the
+    accumulator, such that they can be updated with additional images.
+
+    Parameters
+    ----------
+    stats_file: tmlib.models.file.IllumstatsFile
+        file into which statistics should be written
+    stats: tmlib.workflow.corilla.stats.OnlineStatistics
+        statistics
+    channel_image_file_ids: List[int]
+        IDs of the channel image files that were accumulated
+    '''
+    illumstats = IllumstatsContainer(
+        stats.mean, stats.std, stats.percentiles, stats.downsampling_factor
+    )
+    stats_file.put(
+        illumstats, accumulator=stats.state,
+        channel_image_file_ids=channel_image_file_ids
+    )
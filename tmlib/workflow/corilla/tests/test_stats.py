@@ -0,0 +1,105 @@
+import pytest
+import numpy as np
+
+from tmlib.image import ChannelImage
+from tmlib.image import IllumstatsContainer
+from tmlib.workflow.corilla.stats import OnlineStatistics
+
+
+def _create_images(n, dimensions=(16, 24)):
+    np.random.seed(5)
+    return [
+        np.random.randint(1, 2**16, dimensions).astype(np.uint16)
+        for i in range(n)
+    ]
+
+
+def test_percentiles():
+    arrays = _create_images(5)
+    stats = OnlineStatistics(arrays[0].shape, decimals=1)
+    for array in arrays:
+        stats.update(ChannelImage(array))
+    pixels = np.concatenate(arrays)
+    expected = np.percentile(pixels, stats._q)
+    percentiles = stats.percentiles
+    for i, key in enumerate(stats._keys):
+        assert percentiles[key] == int(expected[i])
+
+
+def test_percentiles_without_images():
+    stats = OnlineStatistics((16, 24))
+    with pytest.raises(ValueError):
+        stats.percentiles
+
+
+def test_downsampled_statistics():
+    arrays = _create_images(3)
+    stats = OnlineStatistics(arrays[0].shape, downsampling_factor=2)
+    for array in arrays:
+        stats.update(ChannelImage(array))
+    # All pixels of a 2x2 block of all images are samples of the block
+    height, width = arrays[0].shape
+    pixels = np.log10(np.array(arrays, dtype=float))
+    blocks = pixels.reshape(len(arrays), height / 2, 2, width / 2, 2)
+    blocks = blocks.transpose(1, 3, 0, 2, 4).reshape(height / 2, width / 2, -1)
+    np.testing.assert_allclose(stats.mean.array, blocks.mean(axis=2))
+    np.testing.assert_allclose(stats.std.array, blocks.std(axis=2, ddof=1))
+
+    illumstats = IllumstatsContainer(
+        stats.mean, stats.std, stats.percentiles, stats.downsampling_factor
+    )
+    upsampled = illumstats.upsample(arrays[0].shape)
+    assert upsampled.mean.dimensions == arrays[0].shape
+    assert upsampled.std.dimensions == arrays[0].shape
+
+
+def _assert_equal_statistics(stats, expected):
+    assert stats.n == expected.n
+    np.testing.assert_allclose(stats.mean.array, expected.mean.array)
+    np.testing.assert_allclose(stats.std.array, expected.std.array)
+    assert stats.percentiles == expected.percentiles
+
+
+@pytest.mark.parametrize('downsampling_factor', [1, 2])
+def test_merge(downsampling_factor):
+    arrays = _create_images(7)
+    sequential = OnlineStatistics(
+        arrays[0].shape, downsampling_factor=downsampling_factor
+    )
+    for array in arrays:
+        sequential.update(ChannelImage(array))
+    merged = OnlineStatistics(
+        arrays[0].shape, downsampling_factor=downsampling_factor
+    )
+    for subset in [arrays[:3], arrays[3:4], arrays[4:]]:
+        stats = OnlineStatistics(
+            arrays[0].shape, downsampling_factor=downsampling_factor
+        )
+        for array in subset:
+            stats.update(ChannelImage(array))
+        merged.merge(stats)
+    _assert_equal_statistics(merged, sequential)
+
+
+def test_state_round_trip(tmpdir):
+    arrays = _create_images(4)
+    stats = OnlineStatistics(arrays[0].shape, downsampling_factor=2)
+    for array in arrays[:2]:
+        stats.update(ChannelImage(array))
+    restored = OnlineStatistics.from_state(stats.state)
+    _assert_equal_statistics(restored, stats)
+
+    filename = str(tmpdir.join('partial.h5'))
+    stats.write(filename)
+    restored = OnlineStatistics.read(filename)
+    assert restored.downsampling_factor == 2
+    assert restored.image_dimensions == arrays[0].shape
+    _assert_equal_statistics(restored, stats)
+
+    # Restored statistics can be updated with additional images
+    sequential = OnlineStatistics(arrays[0].shape, downsampling_factor=2)
+    for array in arrays:
+        sequential.update(ChannelImage(array))
+    for array in arrays[2:]:
+        restored.update(ChannelImage(array))
+    _assert_equal_statistics(restored, sequential)
@@ -14,10 +14,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
+import zlib
+import base64
 import logging
 import numpy as np
 import collections
 import itertools
+import threading
+import cv2
 import shapely.geometry
 import psycopg2
 import sqlalchemy.orm
@@ -27,12 +31,16 @@ from gc3libs.quantity import Duration
 from gc3libs.quantity import Memory
 
 import tmlib.models as tm
+from tmlib import cfg
 from tmlib.utils import flatten, notimplemented, create_partitions
 from tmlib.image import PyramidTile
 from tmlib.image import Image
+from tmlib.image import ChannelImagePreprocessor
+from tmlib.image import ArrayBufferPool
 from tmlib.errors import DataIntegrityError
 from tmlib.errors import WorkflowError
 from tmlib.models.utils import delete_location
+from tmlib.models.tile import create_tile_store
 from tmlib.workflow.api import WorkflowStepAPI
 from tmlib.workflow.jobs import RunJob
 from tmlib.workflow.jobs import SingleRunPhase
@@ -43,9 +51,202 @@ from tmlib.workflow import register_step_api
 logger = logging.getLogger(__name__)
 
 
+def _calc_hilbert_index(n, y, x):
+    # Calculates the distance of points along a Hilbert curve that fills a
+    # square grid of size "n", which must be a power of two. Points that are
+    # close to each other on the grid tend to be close along the curve.
+    y = np.array(y, dtype=np.int64)
+    x = np.array(x, dtype=np.int64)
+    d = np.zeros(x.shape, dtype=np.int64)
+    s = n / 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant, such that the curve continues appropriately.
+        is_flipped = ~ry & rx
+        x[is_flipped] = n - 1 - x[is_flipped]
+        y[is_flipped] = n - 1 - y[is_flipped]
+        is_swapped = ~ry
+        x[is_swapped], y[is_swapped] = y[is_swapped], x[is_swapped]
+        s /= 2
+    return d
+
+
+def _create_outlines(offsets, sizes):
+    # Creates rectangular outlines of objects given the offsets and sizes of
+    # their bounding boxes as WKT polygons and centroids. The first
+    # coordinate is the x axis and the second the inverted (!) y axis.
+    # We further subtract one pixel such that the polygon defines the exact
+    # boundary of the objects. This is crucial for testing whether other
+    # objects intersect with the border.
+    left = offsets[:, 1] + 1
+    top = -1 * (offsets[:, 0] + 1)
+    right = left + sizes[:, 1] - 3
+    bottom = top - (sizes[:, 0] - 3)
+    polygons = list()
+    centroids = list()
+    for l, t, r, b in zip(left.tolist(), top.tolist(),
+            right.tolist(), bottom.tolist()):
+        # Closed circle with coordinates sorted counter-clockwise
+        polygons.append(
+            'POLYGON((%d %d, %d %d, %d %d, %d %d, %d %d))'
+            % (r, t, l, t, l, b, r, b, r, t)
+        )
+        centroids.append('POINT(%r %r)' % ((l + r) / 2.0, (t + b) / 2.0))
+    return (polygons, centroids)
+
+
+def _encode_array(values):
+    # Integer arrays are delta encoded along the first axis and compressed,
+    # such that job descriptions of large layers remain small. Neighbouring
+    # values tend to be similar, since image files and tiles are ordered by
+    # their position.
+    values = np.asarray(values, dtype='<i8')
+    deltas = values.copy()
+    deltas[1:] -= values[:-1]
+    return {
+        'shape': list(values.shape),
+        'data': base64.b64encode(zlib.compress(deltas.tostring()))
+    }
+
+
+def _decode_array(value):
+    # Decodes arrays encoded by _encode_array().
+    deltas = np.frombuffer(
+        zlib.decompress(base64.b64decode(value['data'])), dtype='<i8'
+    )
+    return deltas.reshape(value['shape']).cumsum(axis=0).tolist()
+
+
+def _expand_tile_range(tile_range, n_cols, n):
+    # Generates the coordinates of tiles whose row-wise index within their
+    # level lies in the given range in lists of at most "n" tiles.
+    start, stop = tile_range
+    for i in xrange(start, stop, n):
+        yield [divmod(j, n_cols) for j in xrange(i, min(i + n, stop))]
+
+
+def _calc_last_tile_size(dimensions, level, zoom_factor):
+    # Tiles at the maximal zoom level have the full size. Tiles of lower
+    # levels are created by shrinking mosaics of the tiles of the next
+    # higher level, such that only tiles of the last row and column of a
+    # level may be smaller. Returns the height of tiles in the last row and
+    # the width of tiles in the last column of the given level.
+    tile_size = PyramidTile.TILE_SIZE
+    size = [tile_size, tile_size]
+    for z in reversed(range(level, len(dimensions) - 1)):
+        for i in range(2):
+            n_children = (
+                dimensions[z + 1][i] - zoom_factor * (dimensions[z][i] - 1)
+            )
+            size[i] = (tile_size * (n_children - 1) + size[i]) / zoom_factor
+    return tuple(size)
+
+
+def _calc_tile_size(dimensions, level, zoom_factor, row, column):
+    # Returns the height and width of the tile with given row and column
+    # index at the given level. Only tiles of the last row and column of a
+    # level may be smaller than the full tile size.
+    tile_size = PyramidTile.TILE_SIZE
+    n_rows, n_cols = dimensions[level]
+    if row < n_rows - 1 and column < n_cols - 1:
+        return (tile_size, tile_size)
+    last_height, last_width = _calc_last_tile_size(
+        dimensions, level, zoom_factor
+    )
+    return (
+        last_height if row == n_rows - 1 else tile_size,
+        last_width if column == n_cols - 1 else tile_size
+    )
+
+
+class _ImageCache(object):
+
+    '''Least recently used cache of preprocessed images. Arrays of evicted
+    images are returned to a buffer pool.
+    '''
+
+    def __init__(self, preprocessor, pool, max_size=16):
+        '''
+        Parameters
+        ----------
+        preprocessor: tmlib.image.ChannelImagePreprocessor
+            preprocessor that gets applied to images upon loading
+        pool: tmlib.image.ArrayBufferPool
+            pool from which the preprocessor acquires arrays
+        max_size: int, optional
+            maximal number of cached images (default: ``16``)
+
+        Raises
+        ------
+        ValueError
+            when `max_size` is smaller than 4
+        '''
+        # A tile may require an image and its three upper left neighbours.
+        if max_size < 4:
+            raise ValueError('Cache must hold at least 4 images.')
+        self.max_size = max_size
+        self._preprocessor = preprocessor
+        self._pool = pool
+        self._images = collections.OrderedDict()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def get(self, image_file):
+        '''Gets a preprocessed image, which is loaded in case it is not
+        cached.
+
+        Parameters
+        ----------
+        image_file: tmlib.models.file.ChannelImageFile
+            image file
+
+        Returns
+        -------
+        tmlib.image.ChannelImage
+            preprocessed image
+
+        Warning
+        -------
+        The pixels array of an image may be recycled once it gets evicted,
+        i.e. after `max_size` other images have been requested.
+        '''
+        image = self._images.pop(image_file.id, None)
+        if image is not None:
+            self.n_hits += 1
+        else:
+            self.n_misses += 1
+            if len(self._images) >= self.max_size:
+                _, evicted_image = self._images.popitem(last=False)
+                self._pool.release(evicted_image.array)
+            logger.debug('preprocess image %d', image_file.id)
+            image = self._preprocessor.process(image_file.get())
+        self._images[image_file.id] = image
+        return image
+
+    def clear(self):
+        '''Removes all images from the cache.'''
+        while self._images:
+            _, image = self._images.popitem()
+            self._pool.release(image.array)
+
+    def __repr__(self):
+        return '<%s(hits=%d, misses=%d)>' % (
+            self.__class__.__name__, self.n_hits, self.n_misses
+        )
+
+
 @register_step_api('illuminati')
 class PyramidBuilder(WorkflowStepAPI):
 
+    #: int: number of tiles of lower zoom levels whose children are fetched
+    #: from the tile store at once
+    _N_PARENT_TILES_PER_QUERY = 256
+
+    #: int: number of static mapobjects that are ingested at once
+    _MAPOBJECT_BATCH_SIZE = 10000
+
     def __init__(self, experiment_id):
         '''
         Parameters
@@ -68,6 +269,18 @@ class PyramidBuilder(WorkflowStepAPI):
         generator
             job descriptions
         '''
+        if args.cache_size < 4:
+            raise ValueError('Argument "cache_size" must be at least 4.')
+        if args.fuse_threshold < 0:
+            raise ValueError('Argument "fuse_threshold" must not be negative.')
+        if args.preview_zoom is not None and args.preview_zoom < 0:
+            raise ValueError('Argument "preview_zoom" must not be negative.')
+        if args.lazy and cfg.tile_store == 'hdf5':
+            # Packed files get truncated when a store writes the first tile
+            # of a zoom level, such that tiles can't be written one by one.
+            raise ValueError(
+                'Argument "lazy" is not supported by the "hdf5" tile store.'
+            )
         logger.info('performing data integrity tests')
         with tm.utils.ExperimentSession(self.experiment_id) as session:
             n_images_per_site = session.query(
@@ -165,6 +378,11 @@ class PyramidBuilder(WorkflowStepAPI):
 
                     layer.max_intensity = clip_max
                     layer.min_intensity = clip_min
+                    # Tiles of lazily built layers are rendered upon request
+                    # and must be preprocessed the same way as by the jobs.
+                    layer.lazy = args.lazy
+                    layer.illumcorr = args.illumcorr
+                    layer.align = args.align
 
                     if count == 0:
                         logger.info('calculate size of pyramid base level')
@@ -176,17 +394,114 @@ class PyramidBuilder(WorkflowStepAPI):
                     count += 1
                     n_levels = experiment.pyramid_depth
                     max_zoomlevel_index = n_levels - 1
+                    subtree_levels = args.subtree_levels
+                    if args.lazy:
+                        # Tiles of the maximal zoom level are not stored,
+                        # therefore the next lower level must be built from
+                        # base tiles kept in memory.
+                        subtree_levels = max(subtree_levels, 1)
+                    subtree_levels = min(subtree_levels, n_levels - 1)
+                    preview_levels = 0
+                    if args.preview_zoom is not None:
+                        preview_levels = (
+                            max_zoomlevel_index - args.preview_zoom
+                        )
+                        if preview_levels > 0:
+                            # Tiles of the preview level are created by the
+                            # jobs of the base level, therefore the levels in
+                            # between are skipped like subtree levels.
+                            subtree_levels = preview_levels
+                        else:
+                            logger.warn(
+                                'preview zoom level %d is not below the '
+                                'maximal zoom level %d: build complete '
+                                'pyramid', args.preview_zoom,
+                                max_zoomlevel_index
+                            )
                     for index, level in enumerate(reversed(range(n_levels))):
-                        logger.info('create batches for pyramid level %d', level)
                         # The layer "level" increases from top to bottom.
                         # We build the layer bottom-up, therefore, the "index"
                         # decreases from top to bottom.
+                        n_tiles = np.prod(layer.dimensions[level])
+                        if (index > subtree_levels and
+                                n_tiles < args.fuse_threshold):
+                            # Levels at the top of the pyramid only have few
+                            # tiles. They are built one after another by
+                            # a single job, which avoids the scheduling
+                            # overhead of a separate round of jobs per level.
+                            logger.info(
+                                'create batch for pyramid levels %d to 0',
+                                level
+                            )
+                            job_count += 1
+                            yield {
+                                'id': job_count,
+                                'layer_id': layer.id,
+                                'level': level,
+                                'index': index,
+                                'levels': range(level, -1, -1)
+                            }
+                            break
+                        if level == max_zoomlevel_index and preview_levels > 0:
+                            logger.info(
+                                'create batches for preview at pyramid level '
+                                '%d', level - preview_levels
+                            )
+                            batch_size = args.batch_size
+                            batches = self._create_subtree_batches(
+                                session, layer, preview_levels, batch_size
+                            )
+                            for blocks, file_ids in batches:
+                                job_count += 1
+                                yield {
+                                    'id': job_count,
+                                    'outputs': {},
+                                    'layer_id': layer.id,
+                                    'level': level,
+                                    'index': index,
+                                    'image_file_ids': _encode_array(file_ids),
+                                    'align': args.align,
+                                    'illumcorr': args.illumcorr,
+                                    'cache_size': args.cache_size,
+                                    'preview_levels': preview_levels,
+                                    'blocks': _encode_array(blocks)
+                                }
+                            continue
+                        if level == max_zoomlevel_index and subtree_levels > 0:
+                            logger.info(
+                                'create batches for pyramid levels %d to %d',
+                                level, level - subtree_levels
+                            )
+                            batch_size = args.batch_size
+                            for blocks, file_ids in self._create_subtree_batches(
+                                    session, layer, subtree_levels, batch_size):
+                                job_count += 1
+                                yield {
+                                    'id': job_count,
+                                    'outputs': {},
+                                    'layer_id': layer.id,
+                                    'level': level,
+                                    'index': index,
+                                    'image_file_ids': _encode_array(file_ids),
+                                    'align': args.align,
+                                    'illumcorr': args.illumcorr,
+                                    'cache_size': args.cache_size,
+                                    'subtree_levels': subtree_levels,
+                                    'blocks': _encode_array(blocks),
+                                    'lazy': args.lazy
+                                }
+                            continue
+                        logger.info('create batches for pyramid level %d', level)
                         if level == max_zoomlevel_index:
                             # For the base level, batches are composed of
                             # image files, which will get chopped into tiles.
                             batch_size = args.batch_size
+                            keys = self._get_image_file_sort_keys(
+                                session, layer
+                            )
                             batches = self._create_batches(
-                                image_file_ids, batch_size
+                                sorted(image_file_ids, key=keys.get),
+                                batch_size
                             )
                         else:
                             # For the subsequent levels, batches are composed of
@@ -196,6 +511,10 @@ class PyramidBuilder(WorkflowStepAPI):
                                 batch_size *= 25
                             else:
                                 batch_size /= 4
+                            if index <= subtree_levels:
+                                # Tiles were already created by the jobs
+                                # of the base level.
+                                continue
                             batches = self._create_batches(
                                 np.arange(np.prod(layer.dimensions[level])),
                                 batch_size
@@ -214,24 +533,92 @@ class PyramidBuilder(WorkflowStepAPI):
                                     'layer_id': layer.id,
                                     'level': level,
                                     'index': index,
-                                    'image_file_ids': batch,
+                                    'image_file_ids': _encode_array(batch),
                                     'align': args.align,
-                                    'illumcorr': args.illumcorr
+                                    'illumcorr': args.illumcorr,
+                                    'cache_size': args.cache_size
                                 }
                             else:
-                                rows = np.arange(layer.dimensions[level][0])
-                                cols = np.arange(layer.dimensions[level][1])
-                                coordinates = np.array(
-                                    list(itertools.product(rows, cols))
-                                )[batch].tolist()
+                                # Tiles are described by the range of their
+                                # row-wise index within the level, which gets
+                                # expanded into coordinates by the job.
                                 yield {
                                     'id': job_count,
                                     'layer_id': layer.id,
                                     'level': level,
                                     'index': index,
-                                    'coordinates': coordinates
+                                    'tile_range': [
+                                        int(batch[0]), int(batch[-1]) + 1
+                                    ]
                                 }
 
+    def _get_image_file_sort_keys(self, session, layer):
+        # Tiles that overlap several images require the neighbouring images
+        # of the same well. Images are therefore ordered by well and within
+        # each well along a Hilbert curve through the sites, such that
+        # neighbouring images tend to be processed by the same job and
+        # shortly after each other.
+        sites = session.query(
+                tm.ChannelImageFile.id, tm.Well.plate_id, tm.Site.well_id,
+                tm.Site.y, tm.Site.x
+            ).\
+            join(tm.Site).\
+            join(tm.Well).\
+            filter(
+                tm.ChannelImageFile.channel_id == layer.channel_id,
+                tm.ChannelImageFile.tpoint == layer.tpoint,
+                tm.ChannelImageFile.zplane == layer.zplane
+            ).\
+            all()
+        if not sites:
+            return dict()
+        n = 2 ** int(np.ceil(np.log2(
+            max([max(s.y, s.x) for s in sites]) + 1
+        )))
+        index = _calc_hilbert_index(
+            n, [s.y for s in sites], [s.x for s in sites]
+        )
+        return {
+            s.id: (s.plate_id, s.well_id, i) for s, i in zip(sites, index)
+        }
+
+    def _create_subtree_batches(self, session, layer, subtree_levels,
+            batch_size):
+        # Base tiles are grouped into square blocks, whose quadtree subtree
+        # gets built by a single job. Each job processes several blocks,
+        # such that it has to process about "batch_size" images. Blocks
+        # that don't contain any image must be processed as well, since
+        # tiles of the next lower levels are built from them. Blocks are
+        # ordered along a Hilbert curve, such that jobs process compact
+        # regions of the layer.
+        block_size = layer.zoom_factor ** subtree_levels
+        keys = self._get_image_file_sort_keys(session, layer)
+        block_file_ids = collections.defaultdict(set)
+        mapping = layer.base_tile_coordinate_to_image_file_map
+        for (y, x), file_ids in mapping.iteritems():
+            block_file_ids[(y / block_size, x / block_size)].update(file_ids)
+        n_rows, n_cols = layer.dimensions[-1]
+        n_block_rows = int(np.ceil(n_rows / float(block_size)))
+        n_block_cols = int(np.ceil(n_cols / float(block_size)))
+        block_coordinates = np.array(list(itertools.product(
+            range(n_block_rows), range(n_block_cols)
+        )))
+        n = 2 ** int(np.ceil(np.log2(max(n_block_rows, n_block_cols))))
+        index = _calc_hilbert_index(
+            n, block_coordinates[:, 0], block_coordinates[:, 1]
+        )
+        blocks = list()
+        file_ids = set()
+        for block in block_coordinates[np.argsort(index)].tolist():
+            blocks.append(block)
+            file_ids.update(block_file_ids[tuple(block)])
+            if len(file_ids) >= batch_size:
+                yield (blocks, sorted(file_ids, key=keys.get))
+                blocks = list()
+                file_ids = set()
+        if blocks:
+            yield (blocks, sorted(file_ids, key=keys.get))
+
     def delete_previous_job_output(self):
         '''Deletes all instances of
         :class:`ChannelLayer <tmlib.models.layer.ChannelLayer>` and
@@ -246,6 +633,9 @@ class PyramidBuilder(WorkflowStepAPI):
         '''
         with tm.utils.ExperimentSession(self.experiment_id, False) as session:
             logger.info('delete existing channel layers')
+            # Tiles may also be stored on disk, depending on the tile store.
+            for layer in session.query(tm.ChannelLayer):
+                delete_location(layer.tiles_location)
             session.query(tm.ChannelLayerTile).delete()
             session.query(tm.ChannelLayer).delete()
             logger.info('delete existing static mapobject types')
@@ -315,7 +705,7 @@ class PyramidBuilder(WorkflowStepAPI):
             batch = self.get_run_batch(j)
             multi_run_jobs[batch['index']].append(j)
 
-        for index, job_ids in multi_run_jobs.iteritems():
+        for index, job_ids in sorted(multi_run_jobs.iteritems()):
             subjob_collection = SingleRunPhase(
                 step_name=self.step_name,
                 index=index,
@@ -363,142 +753,429 @@ class PyramidBuilder(WorkflowStepAPI):
             )
             logger.info('create tiles at zoom level %d', batch['level'])
 
-            if batch['illumcorr']:
-                logger.info('correct images for illumination artifacts')
-                try:
-                    logger.debug('load illumination statistics')
-                    image_file = session.query(tm.ChannelImageFile).get(
-                        batch['image_file_ids'][0]
-                    )
-                    stats_file = session.query(tm.IllumstatsFile).\
-                        filter_by(channel_id=layer.channel_id).\
-                        one()
-                except NoResultFound:
-                    raise WorkflowError(
-                        'No illumination statistics file found for channel %d'
-                        % layer.channel_id
-                    )
-                stats = stats_file.get()
+            pool = ArrayBufferPool()
+            cache = self.create_image_cache(
+                session, layer, batch['illumcorr'], batch['align'],
+                batch.get('cache_size', 16), pool
+            )
+
+            level = batch['level']
+            subtree_levels = batch.get('subtree_levels', 0)
+            if batch.get('preview_levels', 0) > 0:
+                self._create_preview_tiles(session, layer, batch, cache)
+            elif subtree_levels > 0:
+                self._create_subtree_tiles(session, layer, batch, cache)
             else:
-                stats = None
-
-            if batch['align']:
-                logger.info('align images between cycles')
-
-            clip_min = layer.min_intensity
-            clip_max = layer.max_intensity
-
-            for fid in batch['image_file_ids']:
-                file = session.query(tm.ChannelImageFile).get(fid)
-                logger.info('process image %d', file.id)
-                tiles = layer.map_image_to_base_tiles(file)
-                image_store = dict()
-                image = file.get()
-                if batch['illumcorr']:
-                    logger.debug('correct image')
-                    image = image.correct(stats)
-                if batch['align']:
-                    logger.debug('align image')
-                    image = image.align(crop=False)
-                if not image.is_uint8:
-                    image = image.clip(clip_min, clip_max)
-                    image = image.scale(clip_min, clip_max)
-                image_store[file.id] = image
-
-                extra_file_map = layer.map_base_tile_to_images(file.site)
-                for t in tiles:
-                    level = batch['level']
-                    row = t['y']
-                    column = t['x']
-                    logger.debug(
-                        'create tile: z=%d, y=%d, x=%d', level, row, column
-                    )
-                    tile = layer.extract_tile_from_image(
-                        image_store[file.id], t['y_offset'], t['x_offset']
-                    )
+                base_tiles = self.create_base_tiles(
+                    session, layer, _decode_array(batch['image_file_ids']),
+                    cache
+                )
+                store = create_tile_store(session, layer, batch['id'])
+                with store:
+                    for row, column, tile in base_tiles:
+                        channel_layer_tile = tm.ChannelLayerTile(
+                            channel_layer_id=layer.id,
+                            z=level, y=row, x=column, pixels=tile
+                        )
+                        store.add(channel_layer_tile)
 
-                    # Determine files that contain overlapping pixels,
-                    # i.e. pixels falling into the currently processed tile
-                    # that are not contained by the file.
-                    file_coordinate = np.array((file.site.y, file.site.x))
-                    extra_file_ids = extra_file_map[row, column]
-                    if len(extra_file_ids) > 0:
-                        logger.debug('tile overlaps multiple images')
-                    for efid in extra_file_ids:
-                        extra_file = session.query(tm.ChannelImageFile).\
-                            get(efid)
-                        if extra_file.id not in image_store:
-                            image = extra_file.get()
-                            if batch['illumcorr']:
-                                logger.debug('correct image')
-                                image = image.correct(stats)
-                            if batch['align']:
-                                logger.debug('align image')
-                                image = image.align(crop=False)
-                            if not image.is_uint8:
-                                image = image.clip(clip_min, clip_max)
-                                image = image.scale(clip_min, clip_max)
-                            image_store[extra_file.id] = image
-
-                        extra_file_coordinate = np.array((
-                            extra_file.site.y, extra_file.site.x
-                        ))
+            cache.clear()
+            logger.debug('image cache: %r', cache)
+            logger.debug('buffer pool: %r', pool)
 
-                        condition = file_coordinate > extra_file_coordinate
-                        pixels = image_store[extra_file.id]
-                        if all(condition):
-                            logger.debug('insert pixels from top left image')
-                            y = file.site.image_size[0] - abs(t['y_offset'])
-                            x = file.site.image_size[1] - abs(t['x_offset'])
-                            height = abs(t['y_offset'])
-                            width = abs(t['x_offset'])
-                            subtile = PyramidTile(
-                                pixels.extract(y, height, x, width).array
-                            )
-                            tile.insert(subtile, 0, 0)
-                        elif condition[0] and not condition[1]:
-                            logger.debug('insert pixels from top image')
-                            y = file.site.image_size[0] - abs(t['y_offset'])
-                            height = abs(t['y_offset'])
-                            if t['x_offset'] < 0:
-                                x = 0
-                                width = tile.dimensions[1] - abs(t['x_offset'])
-                                x_offset = abs(t['x_offset'])
-                            else:
-                                x = t['x_offset']
-                                width = tile.dimensions[1]
-                                x_offset = 0
-                            subtile = PyramidTile(
-                                pixels.extract(y, height, x, width).array
-                            )
-                            tile.insert(subtile, 0, x_offset)
-                        elif not condition[0] and condition[1]:
-                            logger.debug('insert pixels from left image')
-                            x = file.site.image_size[1] - abs(t['x_offset'])
-                            width = abs(t['x_offset'])
-                            if t['y_offset'] < 0:
-                                y = 0
-                                height = tile.dimensions[0] - abs(t['y_offset'])
-                                y_offset = abs(t['y_offset'])
-                            else:
-                                y = t['y_offset']
-                                height = tile.dimensions[0]
-                                y_offset = 0
-                            subtile = PyramidTile(
-                                pixels.extract(y, height, x, width).array
-                            )
-                            tile.insert(subtile, y_offset, 0)
+    def create_image_cache(self, session, layer, illumcorr, align,
+            cache_size, pool):
+        '''Creates a cache for images of a channel layer, which get
+        preprocessed the same way for all tiles of the layer.
+
+        Parameters
+        ----------
+        session: tmlib.models.utils.ExperimentSession
+            database session
+        layer: tmlib.models.channel.ChannelLayer
+            channel layer whose images should be cached
+        illumcorr: bool
+            whether images should be corrected for illumination artifacts
+        align: bool
+            whether images should be aligned between multiplexing cycles
+        cache_size: int
+            maximal number of preprocessed images that are kept in memory
+        pool: tmlib.image.ArrayBufferPool
+            pool from which arrays of preprocessed images are acquired and
+            to which arrays of evicted images are released
+
+        Returns
+        -------
+        tmlib.workflow.illuminati.api._ImageCache
+            cache, whose ``get()`` method returns the preprocessed image
+            of a :class:`ChannelImageFile <tmlib.models.file.ChannelImageFile>`
+
+        Raises
+        ------
+        tmlib.errors.WorkflowError
+            when `illumcorr` is set, but no illumination statistics exist
+            for the channel of `layer`
+        '''
+        if illumcorr:
+            logger.info('correct images for illumination artifacts')
+            try:
+                logger.debug('load illumination statistics')
+                stats_file = session.query(tm.IllumstatsFile).\
+                    filter_by(channel_id=layer.channel_id).\
+                    one()
+            except NoResultFound:
+                raise WorkflowError(
+                    'No illumination statistics file found for channel %d'
+                    % layer.channel_id
+                )
+            stats = stats_file.get()
+        else:
+            stats = None
+
+        if align:
+            logger.info('align images between cycles')
+
+        # Tiles are 8-bit, so single precision suffices for correction.
+        # Preprocessed images are cached, since neighbouring images are
+        # required for tiles that overlap several images. Arrays of images
+        # evicted from the cache get recycled.
+        preprocessor = ChannelImagePreprocessor(
+            stats=stats, align=align, crop=False,
+            clip_min=layer.min_intensity, clip_max=layer.max_intensity,
+            dtype=np.float32, pool=pool
+        )
+        return _ImageCache(preprocessor, pool, cache_size)
+
+    def create_base_tiles(self, session, layer, image_file_ids, cache,
+            is_included=None, layout=None):
+        '''Creates the tiles at the maximal zoom level that intersect with
+        the given images.
+
+        Parameters
+        ----------
+        session: tmlib.models.utils.ExperimentSession
+            database session
+        layer: tmlib.models.channel.ChannelLayer
+            channel layer whose tiles should be created
+        image_file_ids: List[int]
+            IDs of :class:`ChannelImageFile <tmlib.models.file.ChannelImageFile>`
+            instances whose tiles should be created
+        cache: tmlib.workflow.illuminati.api._ImageCache
+            cache of preprocessed images (see
+            :meth:`create_image_cache <tmlib.workflow.illuminati.api.PyramidBuilder.create_image_cache>`)
+        is_included: function, optional
+            function that returns whether the tile with given row and column
+            index should be created (default: all tiles are created)
+        layout: tmlib.models.channel.ChannelLayerLayout, optional
+            layout of `layer` (default: ``layer.layout``)
+
+        Returns
+        -------
+        generator
+            row and column index and tile (tmlib.image.PyramidTile)
+
+        Note
+        ----
+        Pixel arrays of tiles may be recycled once the next tile is
+        requested. The geometry of all images is computed upfront by the
+        layout rather than querying it for each image separately.
+        '''
+        if layout is None:
+            layout = layer.layout
+        for fid in image_file_ids:
+            tiles = layout.map_image_to_base_tiles(fid)
+            if is_included is not None:
+                tiles = [t for t in tiles if is_included(t['y'], t['x'])]
+                if not tiles:
+                    continue
+            file = session.query(tm.ChannelImageFile).get(fid)
+            logger.info('process image %d', file.id)
+            image = cache.get(file)
+
+            extra_file_map = layout.map_base_tile_to_images(fid)
+            for t in tiles:
+                row = t['y']
+                column = t['x']
+                logger.debug('create tile: y=%d, x=%d', row, column)
+                tile = layer.extract_tile_from_image(
+                    image, t['y_offset'], t['x_offset']
+                )
+
+                # Determine files that contain overlapping pixels,
+                # i.e. pixels falling into the currently processed tile
+                # that are not contained by the file.
+                file_coordinate = np.array((file.site.y, file.site.x))
+                extra_file_ids = extra_file_map[row, column]
+                if len(extra_file_ids) > 0:
+                    logger.debug('tile overlaps multiple images')
+                for efid in extra_file_ids:
+                    extra_file = session.query(tm.ChannelImageFile).\
+                        get(efid)
+
+                    extra_file_coordinate = np.array((
+                        extra_file.site.y, extra_file.site.x
+                    ))
+
+                    condition = file_coordinate > extra_file_coordinate
+                    pixels = cache.get(extra_file)
+                    if all(condition):
+                        logger.debug('insert pixels from top left image')
+                        y = file.site.image_size[0] - abs(t['y_offset'])
+                        x = file.site.image_size[1] - abs(t['x_offset'])
+                        height = abs(t['y_offset'])
+                        width = abs(t['x_offset'])
+                        subtile = PyramidTile(
+                            pixels.extract(y, height, x, width).array
+                        )
+                        tile.insert(subtile, 0, 0)
+                    elif condition[0] and not condition[1]:
+                        logger.debug('insert pixels from top image')
+                        y = file.site.image_size[0] - abs(t['y_offset'])
+                        height = abs(t['y_offset'])
+                        if t['x_offset'] < 0:
+                            x = 0
+                            width = tile.dimensions[1] - abs(t['x_offset'])
+                            x_offset = abs(t['x_offset'])
                         else:
-                            raise IndexError(
-                                'Tile shouldn\'t be in this batch!'
-                            )
+                            x = t['x_offset']
+                            width = tile.dimensions[1]
+                            x_offset = 0
+                        subtile = PyramidTile(
+                            pixels.extract(y, height, x, width).array
+                        )
+                        tile.insert(subtile, 0, x_offset)
+                    elif not condition[0] and condition[1]:
+                        logger.debug('insert pixels from left image')
+                        x = file.site.image_size[1] - abs(t['x_offset'])
+                        width = abs(t['x_offset'])
+                        if t['y_offset'] < 0:
+                            y = 0
+                            height = tile.dimensions[0] - abs(t['y_offset'])
+                            y_offset = abs(t['y_offset'])
+                        else:
+                            y = t['y_offset']
+                            height = tile.dimensions[0]
+                            y_offset = 0
+                        subtile = PyramidTile(
+                            pixels.extract(y, height, x, width).array
+                        )
+                        tile.insert(subtile, y_offset, 0)
+                    else:
+                        raise IndexError(
+                            'Tile shouldn\'t be in this batch!'
+                        )
 
-                    channel_layer_tile = tm.ChannelLayerTile(
-                        channel_layer_id=layer.id,
-                        z=level, y=row, x=column, pixels=tile
-                    )
-                    session.add(channel_layer_tile)
+                yield (row, column, tile)
+
+    def _create_subtree_tiles(self, session, layer, batch, cache):
+        # Subtrees are built one block at a time: tiles of the base level
+        # that lie within the block are kept in memory and used to build the
+        # tiles of the next lower levels, and are released once the block
+        # is done. Images that intersect with several blocks are processed
+        # repeatedly, but are usually still held by the cache.
+        level = batch['level']
+        zoom_factor = layer.zoom_factor
+        subtree_levels = batch['subtree_levels']
+        block_size = zoom_factor ** subtree_levels
+        blocks = [tuple(b) for b in _decode_array(batch['blocks'])]
+        logger.info(
+            'create tiles for %d blocks of %dx%d tiles at zoom levels %d to %d',
+            len(blocks), block_size, block_size, level, level - subtree_levels
+        )
+        lazy = batch.get('lazy', False)
+        if lazy:
+            logger.info(
+                'tiles at zoom level %d are rendered upon request', level
+            )
+
+        # Images keep the order in which they were sorted upon batching.
+        layout = layer.layout
+        block_file_ids = collections.OrderedDict([(b, list()) for b in blocks])
+        for fid in _decode_array(batch['image_file_ids']):
+            for t in layout.map_image_to_base_tiles(fid):
+                file_ids = block_file_ids.get(
+                    (t['y'] / block_size, t['x'] / block_size)
+                )
+                if file_ids is not None and fid not in file_ids[-1:]:
+                    file_ids.append(fid)
+
+        store = create_tile_store(session, layer, batch['id'])
+        for block, file_ids in block_file_ids.iteritems():
+            logger.debug('create tiles for block: y=%d, x=%d', *block)
+
+            def is_included(row, column):
+                return (row / block_size, column / block_size) == block
+
+            tiles = dict()
+            base_tiles = self.create_base_tiles(
+                session, layer, file_ids, cache, is_included, layout
+            )
+            for row, column, tile in base_tiles:
+                channel_layer_tile = tm.ChannelLayerTile(
+                    channel_layer_id=layer.id,
+                    z=level, y=row, x=column, pixels=tile
+                )
+                if not lazy:
+                    store.add(channel_layer_tile)
+                # Only non-empty tiles are kept, since missing tiles are
+                # substituted with background.
+                if not channel_layer_tile.is_empty:
+                    tiles[(row, column)] = tile.array.copy()
+
+            block_row, block_col = block
+            for z in reversed(range(level - subtree_levels, level)):
+                n_tiles = block_size / zoom_factor**(level - z)
+                n_rows, n_cols = layer.dimensions[z]
+                rows = range(
+                    block_row * n_tiles, min((block_row + 1) * n_tiles, n_rows)
+                )
+                cols = range(
+                    block_col * n_tiles, min((block_col + 1) * n_tiles, n_cols)
+                )
+                tiles = self._create_tiles_in_memory(
+                    layer, z, itertools.product(rows, cols), tiles, store
+                )
+        store.close()
+
+    def _create_preview_tiles(self, session, layer, batch, cache):
+        # Images are downsampled straight to the zoom level of the preview
+        # and pasted into its tiles. Each block of base tiles corresponds to
+        # one tile of the preview level. Tiles of the levels in between are
+        # not created.
+        preview_levels = batch['preview_levels']
+        level = batch['level'] - preview_levels
+        factor = layer.zoom_factor ** preview_levels
+        tile_size = PyramidTile.TILE_SIZE
+        blocks = set([tuple(b) for b in _decode_array(batch['blocks'])])
+        logger.info(
+            'create preview tiles at zoom level %d for %d blocks',
+            level, len(blocks)
+        )
+        layout = layer.layout
+        offsets = dict(zip(
+            layout.file_ids.tolist(), (layout.offsets // factor).tolist()
+        ))
+        # Tiles must have the same size as the tiles that would be built
+        # from the tiles of the higher levels.
+        tiles = dict()
+        for fid in _decode_array(batch['image_file_ids']):
+            file = session.query(tm.ChannelImageFile).get(fid)
+            logger.info('process image %d', file.id)
+            image = cache.get(file).shrink(factor, inplace=False)
+            y, x = offsets[fid]
+            h, w = image.dimensions
+            rows = range(y / tile_size, (y + h - 1) / tile_size + 1)
+            cols = range(x / tile_size, (x + w - 1) / tile_size + 1)
+            for row, column in itertools.product(rows, cols):
+                if (row, column) not in blocks:
+                    continue
+                if (row, column) not in tiles:
+                    tiles[(row, column)] = np.zeros(_calc_tile_size(
+                        layer.dimensions, level, layer.zoom_factor,
+                        row, column
+                    ), dtype=np.uint8)
+                tile = tiles[(row, column)]
+                # Region of the tile that is covered by the image
+                tile_y = row * tile_size
+                tile_x = column * tile_size
+                top = max(y - tile_y, 0)
+                left = max(x - tile_x, 0)
+                bottom = min(y + h - tile_y, tile.shape[0])
+                right = min(x + w - tile_x, tile.shape[1])
+                if bottom <= top or right <= left:
+                    continue
+                tile[top:bottom, left:right] = image.array[
+                    tile_y + top - y:tile_y + bottom - y,
+                    tile_x + left - x:tile_x + right - x
+                ]
 
+        store = create_tile_store(session, layer, batch['id'])
+        with store:
+            for row, column in sorted(blocks):
+                pixels = tiles.get((row, column))
+                if pixels is None:
+                    # Blocks without images still require a tile of the
+                    # correct size, since tiles at the border of the layer
+                    # can't be substituted with the background tile.
+                    pixels = np.zeros(_calc_tile_size(
+                        layer.dimensions, level, layer.zoom_factor,
+                        row, column
+                    ), dtype=np.uint8)
+                store.add(tm.ChannelLayerTile(
+                    channel_layer_id=layer.id, z=level, y=row, x=column,
+                    pixels=PyramidTile(pixels)
+                ))
+
+    def _create_tiles_in_memory(self, layer, z, coordinates, tiles, store):
+        # Creates tiles at zoom level "z" from the pixel arrays of the tiles
+        # of the next higher level, which are kept in memory. Tiles are
+        # missing in case they are empty or did not fall into a region of the
+        # map occupied by an image. Returns the pixel arrays of the created
+        # tiles that are not empty.
+        zoom_factor = layer.zoom_factor
+        tile_size = PyramidTile.TILE_SIZE
+        mosaic_buffer = np.zeros(
+            (tile_size * zoom_factor, tile_size * zoom_factor), dtype=np.uint8
+        )
+        background = PyramidTile.create_as_background().array
+
+        def get_tile(r, c):
+            tile = tiles.get((r, c))
+            if tile is None:
+                # Missing tiles only contain background, but may be smaller
+                # at the border of the layer.
+                height, width = _calc_tile_size(
+                    layer.dimensions, z + 1, zoom_factor, r, c
+                )
+                tile = background[:height, :width]
+            return tile
+
+        lower_tiles = dict()
+        for row, column in coordinates:
+            logger.debug('create tile: z=%d, y=%d, x=%d', z, row, column)
+            pre_coordinates = layer.calc_coordinates_of_next_higher_level(
+                z, row, column
+            )
+            # Only tiles with the full size can refer to the background tile.
+            is_full_size = _calc_tile_size(
+                layer.dimensions, z, zoom_factor, row, column
+            ) == (tile_size, tile_size)
+            if is_full_size and not any([c in tiles for c in pre_coordinates]):
+                store.add(tm.ChannelLayerTile(
+                    channel_layer_id=layer.id, z=z, y=row, x=column
+                ))
+                continue
+            mosaic = self._stitch_tiles(
+                pre_coordinates, get_tile, mosaic_buffer
+            )
+            tile = PyramidTile(mosaic.shrink(zoom_factor).array)
+            channel_layer_tile = tm.ChannelLayerTile(
+                channel_layer_id=layer.id, z=z, y=row, x=column, pixels=tile
+            )
+            store.add(channel_layer_tile)
+            if not channel_layer_tile.is_empty:
+                lower_tiles[(row, column)] = tile.array
+        return lower_tiles
+
+    @staticmethod
+    def _stitch_tiles(coordinates, get_tile, mosaic_buffer):
+        # Tiles are written into a preallocated mosaic. Tiles at the border
+        # of the layer may be smaller, in which case only the upper left
+        # part of the buffer is used.
+        rows = np.unique([c[0] for c in coordinates])
+        cols = np.unique([c[1] for c in coordinates])
+        y_offset = 0
+        for r in rows:
+            x_offset = 0
+            for c in cols:
+                tile = get_tile(r, c)
+                height, width = tile.shape
+                mosaic_buffer[
+                    y_offset:y_offset+height, x_offset:x_offset+width
+                ] = tile
+                x_offset += width
+            y_offset += height
+        return Image(mosaic_buffer[:y_offset, :x_offset])
 
     def _create_lower_zoom_level_tiles(self, batch, assume_clean_state):
         exp_id = self.experiment_id
@@ -510,67 +1187,149 @@ class PyramidBuilder(WorkflowStepAPI):
             layer_id = layer.id
             zoom_factor = layer.zoom_factor
 
-            for coordinates in batch['coordinates']:
-                row = coordinates[0]
-                column = coordinates[1]
-                pre_coordinates = layer.calc_coordinates_of_next_higher_level(
-                    level, row, column
+            # Tiles of the next higher level are decoded and copied into a
+            # preallocated mosaic, which then gets shrunken into a
+            # preallocated tile. OpenCV's Python interface can't decode into
+            # an existing array, so each decoded tile is a temporary copy.
+            tile_size = PyramidTile.TILE_SIZE
+            mosaic_buffer = np.zeros(
+                (tile_size * zoom_factor, tile_size * zoom_factor),
+                dtype=np.uint8
+            )
+            tile_buffer = np.zeros((tile_size, tile_size), dtype=np.uint8)
+            background = PyramidTile.create_as_background().array
+            store = create_tile_store(session, layer, batch['id'])
+
+            n_tiles_per_query = self._N_PARENT_TILES_PER_QUERY
+            coordinates_batches = _expand_tile_range(
+                batch['tile_range'], layer.dimensions[level][1],
+                n_tiles_per_query
+            )
+            for coordinates_batch in coordinates_batches:
+                pre_coordinates_lut = dict()
+                for row, column in coordinates_batch:
+                    pre_coordinates_lut[(row, column)] = \
+                        layer.calc_coordinates_of_next_higher_level(
+                            level, row, column
+                        )
+                pre_coordinates = list(
+                    itertools.chain(*pre_coordinates_lut.values())
                 )
+                pre_tiles = store.get_encoded(level+1, pre_coordinates)
+                # Tiles at maxzoom level might not exist in case they did not
+                # fall into a region of the map occupied by an image. They
+                # must exist at the lower zoom levels, though, for subsampling.
+                missing = set(pre_coordinates) - set(pre_tiles.keys())
+                if missing:
+                    if batch['index'] > 1:
+                        raise ValueError(
+                            'Tile "%d-%d-%d" was not created.'
+                            % ((level+1, ) + sorted(missing)[0])
+                        )
+                    logger.debug(
+                        '%d tiles missing at zoom level %d',
+                        len(missing), level+1
+                    )
+
+                def get_tile(r, c):
+                    buf = pre_tiles.get((r, c))
+                    if buf is None:
+                        # Missing and empty tiles only contain background,
+                        # but may be smaller at the border of the layer.
+                        height, width = _calc_tile_size(
+                            layer.dimensions, level + 1, zoom_factor, r, c
+                        )
+                        return background[:height, :width]
+                    return cv2.imdecode(
+                        np.frombuffer(buf, np.uint8), cv2.IMREAD_UNCHANGED
+                    )
+
+                for row, column in coordinates_batch:
+                    logger.debug(
+                        'creating tile: z=%d, y=%d, x=%d', level, row, column
+                    )
+                    # A tile is empty when all of its higher level tiles are
+                    # empty, which doesn't require decoding and encoding.
+                    # Tiles at the border of the layer may be smaller and
+                    # can't refer to the background tile, though.
+                    is_full_size = _calc_tile_size(
+                        layer.dimensions, level, zoom_factor, row, column
+                    ) == (tile_size, tile_size)
+                    if is_full_size and all([
+                            pre_tiles.get(c) is None
+                            for c in pre_coordinates_lut[(row, column)]]):
+                        store.add(tm.ChannelLayerTile(
+                            channel_layer_id=layer_id,
+                            z=level, y=row, x=column
+                        ))
+                        continue
+                    # Build the mosaic by loading required higher level tiles
+                    # (created in a previous run) and stitching them together
+                    mosaic = self._stitch_tiles(
+                        pre_coordinates_lut[(row, column)], get_tile,
+                        mosaic_buffer
+                    )
+                    # Create the tile at the current level by downsampling
+                    # the mosaic image, which is composed of the 4 tiles
+                    # of the next higher zoom level
+                    height, width = mosaic.dimensions
+                    out = tile_buffer[
+                        :height / zoom_factor, :width / zoom_factor
+                    ]
+                    tile = PyramidTile(mosaic.shrink(zoom_factor, out=out).array)
+                    # The tile gets encoded upon assignment, such that the
+                    # buffers can be reused for the next tile.
+                    channel_layer_tile = tm.ChannelLayerTile(
+                        channel_layer_id=layer_id,
+                        z=level, y=row, x=column, pixels=tile
+                    )
+                    store.add(channel_layer_tile)
+            store.close()
+
+    def _create_top_level_tiles(self, batch, assume_clean_state):
+        exp_id = self.experiment_id
+        with tm.utils.ExperimentSession(exp_id, transaction=False) as session:
+            layer = session.query(tm.ChannelLayer).get(batch['layer_id'])
+            logger.info('processing layer for channel %s', layer.channel.name)
+            levels = batch['levels']
+            logger.info(
+                'creating tiles at zoom levels %d to %d',
+                levels[0], levels[-1]
+            )
+            store = create_tile_store(session, layer, batch['id'])
+            # Only the tiles of the next higher level are read from the store.
+            # Tiles of all subsequent levels are built in memory.
+            level = levels[0]
+            n_rows, n_cols = layer.dimensions[level + 1]
+            pre_coordinates = list(
+                itertools.product(range(n_rows), range(n_cols))
+            )
+            pre_tiles = store.get_encoded(level + 1, pre_coordinates)
+            missing = set(pre_coordinates) - set(pre_tiles.keys())
+            if missing:
+                if batch['index'] > 1:
+                    raise ValueError(
+                        'Tile "%d-%d-%d" was not created.'
+                        % ((level + 1, ) + sorted(missing)[0])
+                    )
                 logger.debug(
-                    'creating tile: z=%d, y=%d, x=%d', level, row, column
+                    '%d tiles missing at zoom level %d',
+                    len(missing), level + 1
                 )
-                # Build the mosaic by loading required higher level tiles
-                # (created in a previous run) and stitching them together
-                pre_rows = np.unique([c[0] for c in pre_coordinates])
-                pre_cols = np.unique([c[1] for c in pre_coordinates])
-                for i, r in enumerate(pre_rows):
-                    for j, c in enumerate(pre_cols):
-                        pre_tile = session.query(tm.ChannelLayerTile).\
-                            filter_by(
-                                channel_layer_id=layer_id, z=level+1, y=r, x=c
-                            ).\
-                            one_or_none()
-                        if pre_tile is not None:
-                            pre_tile = pre_tile.pixels
-                        else:
-                            # Tiles at maxzoom level might not exist in
-                            # case they did not fall into a region of
-                            # the map occupied by an image.
-                            # They must exist at the lower zoom levels,
-                            # though, for subsampling.
-                            if batch['index'] > 1:
-                                raise ValueError(
-                                    'Tile "%d-%d-%d" was not created.'
-                                    % (level+1, r, c)
-                                )
-                            logger.debug(
-                                'tile "%d-%d-%d" missing',
-                                 batch['level']+1, r, c
-                            )
-                            pre_tile = PyramidTile.create_as_background()
-                        # We have to temporally treat it as an "image",
-                        # since a tile can per definition not be larger
-                        # than 256x256 pixels.
-                        # FIXME: This can be done more efficiently using
-                        # a predefined array instead of these loops.
-                        img = Image(pre_tile.array)
-                        if j == 0:
-                            row_img = img
-                        else:
-                            row_img = row_img.join(img, 'x')
-                    if i == 0:
-                        mosaic_img = row_img
-                    else:
-                        mosaic_img = mosaic_img.join(row_img, 'y')
-                # Create the tile at the current level by downsampling
-                # the mosaic image, which is composed of the 4 tiles
-                # of the next higher zoom level
-                tile = PyramidTile(mosaic_img.shrink(zoom_factor).array)
-                channel_layer_tile = tm.ChannelLayerTile(
-                    channel_layer_id=layer_id,
-                    z=level, y=row, x=column, pixels=tile
+            tiles = dict()
+            for (row, column), buf in pre_tiles.iteritems():
+                if buf is not None:
+                    tiles[(row, column)] = cv2.imdecode(
+                        np.frombuffer(buf, np.uint8), cv2.IMREAD_UNCHANGED
+                    )
+            for z in levels:
+                logger.info('create tiles at zoom level %d', z)
+                n_rows, n_cols = layer.dimensions[z]
+                coordinates = itertools.product(range(n_rows), range(n_cols))
+                tiles = self._create_tiles_in_memory(
+                    layer, z, coordinates, tiles, store
                 )
-                session.add(channel_layer_tile)
+            store.close()
 
     def run_job(self, batch, assume_clean_state=False):
         '''Creates 8-bit grayscale JPEG layer tiles.
@@ -584,6 +1343,8 @@ class PyramidBuilder(WorkflowStepAPI):
         '''
         if batch['index'] == 0:
             self._create_maxzoom_level_tiles(batch, assume_clean_state)
+        elif 'levels' in batch:
+            self._create_top_level_tiles(batch, assume_clean_state)
         else:
             self._create_lower_zoom_level_tiles(batch, assume_clean_state)
 
@@ -602,11 +1363,49 @@ class PyramidBuilder(WorkflowStepAPI):
         ----------
         batch: dict
             job description
+
+        Raises
+        ------
+        tmlib.errors.WorkflowError
+            when the experiment has no channel layers
         '''
+        with tm.utils.ExperimentSession(self.experiment_id, transaction=False) as session:
+            # Plates, wells and sites are the same for all layers, so the
+            # geometry can be taken from any layer.
+            layer = session.query(tm.ChannelLayer).first()
+            if layer is None:
+                raise WorkflowError(
+                    'No channel layers found for experiment %d'
+                    % self.experiment_id
+                )
+            layout = layer.layout
+            residues = session.query(
+                    tm.Site.id, tm.Site.top_residue, tm.Site.bottom_residue,
+                    tm.Site.left_residue, tm.Site.right_residue
+                ).\
+                order_by(tm.Site.id).\
+                all()
+        # We need to account for the "multiplexing" edge case and use the
+        # aligned offset and size of sites.
+        residues = np.array(residues, dtype=np.int64).reshape(-1, 5)
+        site_offsets = layout.site_offsets + residues[:, [1, 3]]
+        site_sizes = (
+            layout.site_sizes -
+            (residues[:, [1, 3]] + residues[:, [2, 4]])
+        )
         mapobject_mappings = {
-            'Plates': tm.Plate, 'Wells': tm.Well, 'Sites': tm.Site
+            'Plates': (
+                tm.Plate, layout.plate_ids, layout.plate_offsets,
+                layout.plate_sizes
+            ),
+            'Wells': (
+                tm.Well, layout.well_ids, layout.well_offsets,
+                layout.well_sizes
+            ),
+            'Sites': (tm.Site, layout.site_ids, site_offsets, site_sizes)
         }
-        for name, cls in mapobject_mappings.iteritems():
+        for name, (cls, ids, offsets, sizes) in mapobject_mappings.iteritems():
+            ids = ids.tolist()
             with tm.utils.ExperimentSession(self.experiment_id, transaction=False) as session:
                 logger.info(
                     'create static mapobject type "%s" for reference type "%s"',
@@ -620,54 +1419,190 @@ class PyramidBuilder(WorkflowStepAPI):
                 segmentation_layer = session.get_or_create(
                     tm.SegmentationLayer, mapobject_type_id=mapobject_type_id
                 )
-
-                logger.info('create individual mapobjects of type "%s"', name)
-                segmentations = dict()
-                for obj in session.query(cls):
-                    logger.debug(
-                        'create mapobject for reference object #%d', obj.id
-                    )
-                    if name == 'Sites':
-                        # We need to account for the "multiplexing" edge case.
-                        offset = obj.aligned_offset
-                        image_size = obj.aligned_image_size
-                    else:
-                        offset = obj.offset
-                        image_size = obj.image_size
-                    # First element: x axis
-                    # Second element: inverted (!) y axis
-                    # We further subtract one pixel such that the polygon
-                    # defines the exact boundary of the objects. This is
-                    # crucial for testing whether other objects intersect with
-                    # the border.
-                    ul = (offset[1] + 1, -1 * (offset[0] + 1))
-                    ll = (ul[0], ul[1] - (image_size[0] - 3))
-                    ur = (ul[0] + image_size[1] - 3, ul[1])
-                    lr = (ll[0] + image_size[1] - 3, ll[1])
-                    # Closed circle with coordinates sorted counter-clockwise
-                    contour = np.array([ur, ul, ll, lr, ur])
-                    polygon = shapely.geometry.Polygon(contour)
-                    segmentations[obj.id] = {
-                        'segmentation_layer_id': segmentation_layer.id,
-                        'polygon': polygon
-                    }
+                segmentation_layer_id = segmentation_layer.id
 
                 logger.debug('delete existing mapobjects of type "%s"', name)
                 session.query(tm.Mapobject).\
                     filter_by(mapobject_type_id=mapobject_type_id).\
                     delete()
-                logger.debug('add new mapobjects of type "%s"', name)
-                for key, value in segmentations.iteritems():
-                    mapobject = tm.Mapobject(
-                        partition_key=key, mapobject_type_id=mapobject_type_id
-                    )
-                    session.add(mapobject)
-                    session.flush()
-                    logger.debug('add mapobject #%d', mapobject.id)
-                    mapobject_segmentation = tm.MapobjectSegmentation(
-                        partition_key=key, mapobject_id=mapobject.id,
-                        geom_polygon=value['polygon'],
-                        geom_centroid=value['polygon'].centroid,
-                        segmentation_layer_id=value['segmentation_layer_id'],
+
+                logger.info(
+                    'add %d mapobjects of type "%s"', len(ids), name
+                )
+                polygons, centroids = _create_outlines(offsets, sizes)
+                # Mapobjects get their IDs allocated in blocks upon bulk
+                # ingestion, which are then used for the segmentations.
+                partitions = create_partitions(
+                    range(len(ids)), self._MAPOBJECT_BATCH_SIZE
+                )
+                for indices in partitions:
+                    mapobjects = [
+                        tm.Mapobject(
+                            partition_key=ids[i],
+                            mapobject_type_id=mapobject_type_id
+                        )
+                        for i in indices
+                    ]
+                    session.bulk_ingest(mapobjects)
+                    mapobject_segmentations = [
+                        tm.MapobjectSegmentation(
+                            partition_key=ids[i], mapobject_id=mapobject.id,
+                            geom_polygon=polygons[i],
+                            geom_centroid=centroids[i],
+                            segmentation_layer_id=segmentation_layer_id
+                        )
+                        for i, mapobject in zip(indices, mapobjects)
+                    ]
+                    session.bulk_ingest(mapobject_segmentations)
+
+
+class LazyTileRenderer(object):
+
+    '''Renders tiles at the maximal zoom level of a channel layer upon first
+    request and writes them through to the tile store. This is required for
+    layers whose pyramid was built with argument ``lazy``, for which only
+    the lower zoom levels are stored.
+
+    Tiles are created from the channel image files, which are preprocessed
+    the same way as by the jobs of the *illuminati* step. Renders are
+    serialized by a lock within the process and by a *PostgreSQL* advisory
+    lock on the layer across processes. The store is checked again once the
+    locks have been acquired, such that a tile requested by several threads
+    or processes at once is only rendered by the first one.
+
+    Examples
+    --------
+    Readers created by
+    :func:`create_tile_reader <tmlib.models.tile.create_tile_reader>`
+    use a renderer for lazily built layers, which is created from the
+    arguments stored on the layer::
+
+        reader = create_tile_reader(session, layer)
+    '''
+
+    def __init__(self, experiment_id, channel_layer_id, illumcorr=False,
+            align=False, cache_size=16):
+        '''
+        Parameters
+        ----------
+        experiment_id: int
+            ID of the parent experiment
+        channel_layer_id: int
+            ID of the channel layer whose tiles should be rendered
+        illumcorr: bool, optional
+            whether images should be corrected for illumination artifacts
+            (default: ``False``)
+        align: bool, optional
+            whether images should be aligned between multiplexing cycles
+            (default: ``False``)
+        cache_size: int, optional
+            maximal number of preprocessed images that are kept in memory
+            (default: ``16``)
+
+        Note
+        ----
+        `illumcorr` and `align` should be set to the values of the
+        corresponding arguments of the *illuminati* step, such that rendered
+        tiles match the stored lower zoom levels. These values are stored
+        as attributes of
+        :class:`ChannelLayer <tmlib.models.channel.ChannelLayer>`.
+        '''
+        if cache_size < 4:
+            raise ValueError('Argument "cache_size" must be at least 4.')
+        self.experiment_id = experiment_id
+        self.channel_layer_id = channel_layer_id
+        self.illumcorr = illumcorr
+        self.align = align
+        self.cache_size = cache_size
+        self.n_rendered = 0
+        self._builder = PyramidBuilder(experiment_id)
+        self._lock = threading.Lock()
+        self._pool = ArrayBufferPool()
+        self._cache = None
+        self._layout = None
+
+    def render(self, z, coordinates):
+        '''Renders tiles that are not yet stored.
+
+        Parameters
+        ----------
+        z: int
+            zero-based zoom level index
+        coordinates: List[Tuple[int]]
+            zero-based row and column indices of tiles
+
+        Returns
+        -------
+        Dict[Tuple[int], str]
+            *JPEG* encoded pixels for each tile that is stored or could be
+            rendered; ``None`` for empty tiles
+
+        Note
+        ----
+        Only tiles at the maximal zoom level are rendered. Tiles that don't
+        intersect with any image are missing.
+        '''
+        with self._lock:
+            with tm.utils.ExperimentSession(self.experiment_id) as session:
+                layer = session.query(tm.ChannelLayer).\
+                    get(self.channel_layer_id)
+                store = create_tile_store(session, layer)
+                # Tiles may have been rendered while waiting for the lock.
+                tiles = store.get_encoded(z, coordinates)
+                if z != layer.maxzoom_level_index:
+                    return tiles
+                missing = set([
+                    tuple(c) for c in coordinates if tuple(c) not in tiles
+                ])
+                if not missing:
+                    return tiles
+                # Other processes may render tiles of the same layer. The
+                # advisory lock is released together with the transaction,
+                # i.e. once rendered tiles have been written.
+                session.execute(
+                    'SELECT pg_advisory_xact_lock(:channel_layer_id)',
+                    {'channel_layer_id': layer.id}
+                )
+                tiles.update(store.get_encoded(z, list(missing)))
+                missing = set([c for c in missing if c not in tiles])
+                if not missing:
+                    return tiles
+                if self._layout is None:
+                    self._layout = layer.layout
+                    self._cache = self._builder.create_image_cache(
+                        session, layer, self.illumcorr, self.align,
+                        self.cache_size, self._pool
                     )
-                    session.add(mapobject_segmentation)
+                image_file_ids = self._layout.find_images_of_base_tiles(
+                    list(missing)
+                )
+                logger.debug(
+                    'render %d tiles from %d images',
+                    len(missing), len(image_file_ids)
+                )
+                base_tiles = self._builder.create_base_tiles(
+                    session, layer, image_file_ids, self._cache,
+                    lambda row, column: (row, column) in missing,
+                    self._layout
+                )
+                with store:
+                    for row, column, tile in base_tiles:
+                        channel_layer_tile = tm.ChannelLayerTile(
+                            channel_layer_id=layer.id,
+                            z=z, y=row, x=column, pixels=tile
+                        )
+                        store.add(channel_layer_tile)
+                        tiles[(row, column)] = channel_layer_tile.encoded_pixels
+                        self.n_rendered += 1
+        return tiles
+
+    def clear(self):
+        '''Removes all preprocessed images from the cache.'''
+        with self._lock:
+            if self._cache is not None:
+                self._cache.clear()
+
+    def __repr__(self):
+        return '<%s(channel_layer_id=%d, rendered=%d)>' % (
+            self.__class__.__name__, self.channel_layer_id, self.n_rendered
+        )
@@ -57,6 +57,55 @@ class IlluminatiBatchArguments(BatchArguments):
         '''
     )
 
+    subtree_levels = Argument(
+        type=int, default=0, flag='subtree-levels',
+        help='''number of zoom levels below the base level that should be
+            built in memory by the jobs that create the base level; each job
+            processes square blocks of base tiles whose side length is the
+            zoom factor to the power of this number and only the remaining
+            levels are built in subsequent rounds of jobs
+        '''
+    )
+
+    cache_size = Argument(
+        type=int, default=16, flag='cache-size',
+        help='''maximal number of preprocessed images that are kept in memory
+            by each job that creates the base level, such that neighbouring
+            images don't need to be loaded and preprocessed repeatedly
+            (must be at least 4)
+        '''
+    )
+
+    fuse_threshold = Argument(
+        type=int, default=256, flag='fuse-threshold',
+        help='''number of tiles below which the zoom levels at the top of the
+            pyramid are built one after another by a single final job per
+            layer rather than by a separate round of jobs per level
+            (set to 0 to build each level in a separate round)
+        '''
+    )
+
+    lazy = Argument(
+        type=bool, default=False, short_flag='l',
+        help='''whether tiles of the maximal zoom level should not be stored,
+            but rendered from the image files upon first request; the lower
+            zoom levels are built from base tiles that are kept in memory
+            (implies at least one subtree level and is not supported by the
+            "hdf5" tile store)
+        '''
+    )
+
+    preview_zoom = Argument(
+        type=int, flag='preview-zoom',
+        help='''zero-based index of the zoom level at which a low resolution
+            preview should be built; images are downsampled straight to this
+            level and only the levels at and below it are built, such that
+            work at full resolution is skipped (defaults to building the
+            complete pyramid)
+        '''
+    )
+
+
 @register_step_submission_args('illuminati')
 class IlluminatiSubmissionArguments(SubmissionArguments):
 
@@ -0,0 +1,110 @@
+import json
+import itertools
+import numpy as np
+
+from tmlib.workflow.illuminati import api
+
+
+def test_encode_array_image_file_ids():
+    file_ids = [12, 13, 7, 8, 2001, 5, 5]
+    encoded = json.loads(json.dumps(api._encode_array(file_ids)))
+    assert api._decode_array(encoded) == file_ids
+
+
+def test_encode_array_blocks():
+    blocks = [[0, 0], [0, 1], [1, 1], [1, 0], [3, 2]]
+    encoded = json.loads(json.dumps(api._encode_array(blocks)))
+    assert api._decode_array(encoded) == blocks
+
+
+def test_encode_array_empty():
+    assert api._decode_array(api._encode_array([])) == []
+
+
+def test_expand_tile_range():
+    coordinates = list(itertools.product(range(5), range(7)))
+    batches = list(api._expand_tile_range([9, 30], 7, 8))
+    assert [len(b) for b in batches] == [8, 8, 5]
+    assert list(itertools.chain(*batches)) == coordinates[9:30]
+
+
+def test_calc_last_tile_size():
+    # Tiles of each level are built from the tiles of the next higher level
+    dimensions = [(1, 1), (1, 2), (2, 3), (3, 5), (5, 9)]
+    zoom_factor = 2
+    tiles = {
+        c: np.ones((256, 256), dtype=np.uint8)
+        for c in itertools.product(*[range(n) for n in dimensions[-1]])
+    }
+    buffer = np.zeros((512, 512), dtype=np.uint8)
+    for level in reversed(range(len(dimensions) - 1)):
+        n_rows, n_cols = dimensions[level + 1]
+        lower_tiles = dict()
+        n_lower_rows, n_lower_cols = dimensions[level]
+        for row, col in itertools.product(
+                range(n_lower_rows), range(n_lower_cols)):
+            coordinates = [
+                (r, c)
+                for r in range(row * 2, min(row * 2 + 2, n_rows))
+                for c in range(col * 2, min(col * 2 + 2, n_cols))
+            ]
+            mosaic = api.PyramidBuilder._stitch_tiles(
+                coordinates, lambda r, c: tiles[(r, c)], buffer
+            )
+            lower_tiles[(row, col)] = mosaic.shrink(zoom_factor).array.copy()
+        tiles = lower_tiles
+        last_row, last_col = [n - 1 for n in dimensions[level]]
+        height, width = api._calc_last_tile_size(
+            dimensions, level, zoom_factor
+        )
+        assert tiles[(last_row, 0)].shape[0] == height
+        assert tiles[(0, last_col)].shape[1] == width
+        if last_row > 0 and last_col > 0:
+            assert tiles[(0, 0)].shape == (256, 256)
+
+
+class _Layer(object):
+
+    id = 1
+    zoom_factor = 2
+    dimensions = [(1, 1), (1, 2), (2, 3), (3, 5), (5, 9)]
+
+    def calc_coordinates_of_next_higher_level(self, z, y, x):
+        n_rows, n_cols = self.dimensions[z + 1]
+        return [
+            (r, c)
+            for r in range(y * 2, min(y * 2 + 2, n_rows))
+            for c in range(x * 2, min(x * 2 + 2, n_cols))
+        ]
+
+
+class _Store(list):
+
+    def add(self, tile):
+        self.append(tile)
+
+
+def test_create_tiles_in_memory_with_empty_last_column():
+    # Tiles of the last column of the base level are missing, such that all
+    # tiles of the last column of the lower levels are empty as well.
+    layer = _Layer()
+    n_rows, n_cols = layer.dimensions[-1]
+    tiles = {
+        c: np.ones((256, 256), dtype=np.uint8)
+        for c in itertools.product(range(n_rows), range(n_cols - 1))
+    }
+    builder = api.PyramidBuilder.__new__(api.PyramidBuilder)
+    for level in reversed(range(len(layer.dimensions) - 1)):
+        n_rows, n_cols = layer.dimensions[level]
+        store = _Store()
+        tiles = builder._create_tiles_in_memory(
+            layer, level, itertools.product(range(n_rows), range(n_cols)),
+            tiles, store
+        )
+        height, width = api._calc_last_tile_size(
+            layer.dimensions, level, layer.zoom_factor
+        )
+        for tile in store:
+            shape = tile.pixels.dimensions
+            assert shape[0] == (height if tile.y == n_rows - 1 else 256)
+            assert shape[1] == (width if tile.x == n_cols - 1 else 256)
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
+import glob
 import logging
 import collections
 import numpy as np
@@ -22,12 +23,17 @@ from sqlalchemy import func
 
 import tmlib.models as tm
 from tmlib.utils import notimplemented
+from tmlib.utils import autocreate_directory_property
 from tmlib.readers import BFImageReader
 from tmlib.readers import ImageReader
 from tmlib.readers import JavaBridge
 from tmlib.image import ChannelImage
 from tmlib.metadata import ChannelImageMetadata
 from tmlib.workflow.api import WorkflowStepAPI
+from tmlib.workflow.corilla.stats import OnlineStatistics
+from tmlib.workflow.corilla.stats import build_partial_statistics_filename
+from tmlib.workflow.corilla.stats import merge_partial_statistics
+from tmlib.workflow.corilla.stats import store_statistics
 from tmlib.workflow import register_step_api
 
 logger = logging.getLogger(__name__)
@@ -50,6 +56,14 @@ class ImageExtractor(WorkflowStepAPI):
         '''
         super(ImageExtractor, self).__init__(experiment_id)
 
+    @autocreate_directory_property
+    def partial_illumstats_location(self):
+        '''str: location where illumination statistics calculated by
+        individual run jobs are stored until they get merged in the
+        collect phase
+        '''
+        return os.path.join(self.step_location, 'partial_illumstats')
+
     def create_run_batches(self, args):
         '''Creates job descriptions for parallel processing.
 
@@ -68,7 +82,12 @@ class ImageExtractor(WorkflowStepAPI):
             file_ids = [f.id for f in channel_image_files]
             batches = self._create_batches(file_ids, args.batch_size)
             for i, file_ids in enumerate(batches):
-                yield {'id': i+1, 'channel_image_file_ids': file_ids}
+                yield {
+                    'id': i+1,
+                    'channel_image_file_ids': file_ids,
+                    'illumstats': args.illumstats,
+                    'downsampling_factor': args.downsampling_factor
+                }
 
     def create_collect_batch(self, args):
         '''Creates a job description for the *collect* phase.
@@ -83,7 +102,7 @@ class ImageExtractor(WorkflowStepAPI):
         dict
             job description
         '''
-        return {'delete': args.delete}
+        return {'delete': args.delete, 'illumstats': args.illumstats}
 
     def run_job(self, batch, assume_clean_state=False):
         '''Extracts individual planes from microscope image files and writes
@@ -95,7 +114,15 @@ class ImageExtractor(WorkflowStepAPI):
             job description
         assume_clean_state: bool, optional
             assume that output of previous runs has already been cleaned up
+
+        Note
+        ----
+        In case
+        :attr:`illumstats <tmlib.workflow.imextract.args.ImextractBatchArguments.illumstats>`
+        is set, illumination statistics of each channel are updated with
+        the extracted pixels while they are still in memory.
         '''
+        stats = dict()
         with tm.utils.ExperimentSession(self.experiment_id) as session:
             channel_image_file = session.query(tm.ChannelImageFile).\
                 get(batch['channel_image_file_ids'][0])
@@ -155,6 +182,27 @@ class ImageExtractor(WorkflowStepAPI):
                     img = ChannelImage(pixel_array)
                     logger.info('write pixels to file on disk')
                     image_file.put(img)
+                    if batch.get('illumstats', False):
+                        channel_id = image_file.channel_id
+                        if channel_id not in stats:
+                            stats[channel_id] = OnlineStatistics(
+                                image_dimensions=img.dimensions[0:2],
+                                downsampling_factor=batch.get(
+                                    'downsampling_factor', 1
+                                )
+                            )
+                        logger.debug('update illumination statistics')
+                        stats[channel_id].update(img)
+
+        for channel_id, channel_stats in stats.iteritems():
+            logger.info(
+                'write partial illumination statistics of channel %d to file',
+                channel_id
+            )
+            filename = build_partial_statistics_filename(
+                self.partial_illumstats_location, channel_id, batch['id']
+            )
+            channel_stats.write(filename)
 
     def delete_previous_job_output(self):
         '''Deletes all instances of class
@@ -166,9 +214,16 @@ class ImageExtractor(WorkflowStepAPI):
             channels = session.query(tm.Channel).all()
             for ch in channels:
                 ch.remove_image_files()
+        logger.info('delete existing partial illumination statistics')
+        for filename in glob.glob(
+                os.path.join(self.partial_illumstats_location, '*.h5')):
+            os.remove(filename)
 
     def collect_job_output(self, batch):
-        '''Deletes all instances of
+        '''Merges illumination statistics calculated by individual run jobs
+        in case
+        :attr:`illumstats <tmlib.workflow.imextract.args.ImextractBatchArguments.illumstats>`
+        is set to ``True`` and deletes all instances of
         :class:`MicroscopeImageFile <tmlib.models.file.MicroscopeImageFile>`
         in case
         :attr:`delete <tmlib.workflow.imextract.args.ImextractBatchArguments>`
@@ -184,8 +239,52 @@ class ImageExtractor(WorkflowStepAPI):
         Files are only deleted after individual planes have been extracted,
         because it may lead to problems depending on how planes are distributed
         across individual microscope image files.
+
+        The state of the accumulator is stored alongside the illumination
+        statistics, such that the "corilla" step in incremental mode
+        doesn't need to process images that were extracted here.
         '''
+        if batch.get('illumstats', False):
+            self._collect_illumstats()
         if batch['delete']:
             logger.info('delete all microscope image files')
             with tm.utils.ExperimentSession(self.experiment_id) as session:
                 session.query(tm.MicroscopeImageFile).delete()
+
+    def _collect_illumstats(self):
+        channel_file_ids = collections.defaultdict(list)
+        channel_filenames = collections.defaultdict(list)
+        for job_id in sorted(self.get_run_job_ids()):
+            run_batch = self.get_run_batch(job_id)
+            with tm.utils.ExperimentSession(self.experiment_id) as session:
+                image_files = session.query(
+                        tm.ChannelImageFile.id, tm.ChannelImageFile.channel_id
+                    ).\
+                    filter(
+                        tm.ChannelImageFile.id.in_(
+                            run_batch['channel_image_file_ids']
+                        )
+                    ).\
+                    all()
+            for f in image_files:
+                channel_file_ids[f.channel_id].append(f.id)
+            for channel_id in set([f.channel_id for f in image_files]):
+                channel_filenames[channel_id].append(
+                    build_partial_statistics_filename(
+                        self.partial_illumstats_location, channel_id, job_id
+                    )
+                )
+        for channel_id, filenames in channel_filenames.iteritems():
+            logger.info(
+                'merge illumination statistics of %d jobs for channel %d',
+                len(filenames), channel_id
+            )
+            stats = merge_partial_statistics(filenames)
+            with tm.utils.ExperimentSession(self.experiment_id) as session:
+                stats_file = session.get_or_create(
+                    tm.IllumstatsFile, channel_id=channel_id
+                )
+                logger.info('write illumination statistics to file')
+                store_statistics(
+                    stats_file, stats, sorted(channel_file_ids[channel_id])
+                )
@@ -36,6 +36,25 @@ class ImextractBatchArguments(BatchArguments):
         '''
     )
 
+    illumstats = Argument(
+        type=bool, default=False,
+        help='''
+            calculate illumination statistics while pixel data gets
+            extracted, such that images don't need to be read again by
+            the "corilla" step (run "corilla" in incremental mode to only
+            process images that have been added afterwards)
+        '''
+    )
+
+    downsampling_factor = Argument(
+        type=int, default=1, flag='downsampling-factor',
+        help='''
+            size of blocks of pixels along the y and x axis for which
+            illumination statistics should be calculated (must match the
+            value used by the "corilla" step in incremental mode)
+        '''
+    )
+
 
 @register_step_submission_args('imextract')
 class ImextractSubmissionArguments(SubmissionArguments):
@@ -39,6 +39,7 @@ from tmlib.readers import TextReader
 from tmlib.readers import ImageReader
 from tmlib.writers import TextWriter
 from tmlib.models.types import ST_GeomFromText
+from tmlib.image import ChannelImagePreprocessor
 from tmlib.workflow.api import WorkflowStepAPI
 from tmlib.errors import PipelineDescriptionError
 from tmlib.errors import JobDescriptionError
@@ -300,6 +301,9 @@ class ImageAnalysisPipelineEngine(WorkflowStepAPI):
                     stats = stats_file.get()
                 else:
                     stats = None
+                preprocessor = ChannelImagePreprocessor(
+                    stats=stats, align=True, crop=True
+                )
 
                 logger.info('load images for channel "%s"', ch.name)
                 image_files = session.query(tm.ChannelImageFile).\
@@ -308,12 +312,15 @@ class ImageAnalysisPipelineEngine(WorkflowStepAPI):
                 for f in image_files:
                     logger.info('load image %d', f.id)
                     img = f.get()
-                    if ch.correct:
-                        logger.info('correct image %d', f.id)
-                        img = img.correct(stats)
-                    logger.debug('align image %d', f.id)
-                    img = img.align()  # shifted and cropped!
-                    image_array[:, :, f.zplane, f.tpoint] = img.array
+                    logger.debug(
+                        'preprocess image %d (correct: %s, align: %s)',
+                        f.id, preprocessor.correct, preprocessor.align
+                    )
+                    # Pixels are shifted and cropped and written directly
+                    # into the pipeline input array.
+                    preprocessor.process(
+                        img, out=image_array[:, :, f.zplane, f.tpoint]
+                    )
                 store['pipe'][ch.name] = image_array
 
             for obj in objects_input:
@@ -346,7 +346,10 @@ class DatasetWriter(Writer):
         '''
         if isinstance(data, basestring):
             data = np.string_(data)
-        if ((isinstance(data, np.ndarray) or isinstance(data, list)) and
+        # Numeric arrays are not checked element-wise for strings, which
+        # would be slow for large arrays.
+        if ((isinstance(data, np.ndarray) and data.dtype.kind in 'SUO' or
+                isinstance(data, list)) and
                 all([isinstance(d, basestring) for d in data])):
             data = [np.string_(d) for d in data]
         if isinstance(data, list):
@@ -424,7 +427,8 @@ class DatasetWriter(Writer):
         '''
         if isinstance(data, basestring):
             data = np.string_(data)
-        if ((isinstance(data, np.ndarray) or isinstance(data, list)) and
+        if ((isinstance(data, np.ndarray) and data.dtype.kind in 'SUO' or
+                isinstance(data, list)) and
                 all([isinstance(d, basestring) for d in data])):
             data = [np.string_(d) for d in data]
         if isinstance(data, list):
@@ -600,7 +604,7 @@ class DatasetWriter(Writer):
             dset[i] = d.tolist()  # doesn't work with numpy.ndarray!!!
         return dset
 
-    def create(self, path, dims, dtype, max_dims=None):
+    def create(self, path, dims, dtype, max_dims=None, chunks=None):
         '''Creates a dataset with a given size and data type without actually
         writing data to it.
 
@@ -617,6 +621,9 @@ class DatasetWriter(Writer):
             be extendable along one or more dimensions (defaults to `dims`);
             ``(None, None)`` would mean extendable infinitely along both
             dimensions
+        chunks: Tuple[int], optional
+            dimensions of chunks in which the dataset gets stored
+            (defaults to dimensions chosen by *h5py* for extendable datasets)
 
         Returns
         -------
@@ -632,7 +639,8 @@ class DatasetWriter(Writer):
         if self.exists(path):
             raise IOError('Dataset already exists: %s' % path)
         return self._stream.create_dataset(
-                        path, shape=dims, dtype=dtype, maxshape=max_dims)
+                        path, shape=dims, dtype=dtype, maxshape=max_dims,
+                        chunks=chunks)
 
     def append(self, path, data):
         '''Appends data to an existing one-dimensional dataset.
@@ -677,8 +685,7 @@ class DatasetWriter(Writer):
         start_index = len(dset)
         end_index = start_index + len(data)
         dset.resize((len(dset) + len(data), ))
-        self.write(path, data, index=range(start_index, end_index))
-        # dset[start_index:] = data
+        self.write_subset(path, data, index=slice(start_index, end_index))
 
     def vstack(self, path, data):
         '''Vertically appends data to an existing multi-dimensional dataset.